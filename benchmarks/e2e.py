@@ -0,0 +1,472 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+"""
+    benchmarks.e2e
+    ~~~~~~~~~~~~~~
+
+    End-to-end load and throughput benchmark.
+
+    Sets up SSHg on a temporary configuration directory with a SQLite
+    database, generates synthetic repositories, starts the server on
+    localhost and drives concurrent ``hg`` clients over ``ssh`` against it.
+
+    Reports the connection setup latency, the latency percentiles of each
+    operation, the aggregate throughput as accounted by the server and the
+    CPU time used by the server and it's children. Handshakes per second
+    and the server CPU time per handshake can be compared across host key
+    algorithms with ``--host-key-algorithm``.
+
+    Everything is local and the repositories are generated from a fixed
+    seed, so results are comparable across runs on the same machine.
+    Needs ``hg``, ``ssh``, ``ssh-keygen`` and ``twistd`` on the ``PATH``.
+
+    Usage::
+
+        python benchmarks/e2e.py [--clients 8] [--iterations 5]
+                                 [--operations clone,pull,push]
+                                 [--repositories 2] [--repo-size 20]
+                                 [--host-key-algorithm ssh-ed25519]
+
+    :copyright: © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import os
+import random
+import shutil
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from ConfigParser import SafeConfigParser
+from glob import glob
+from optparse import OptionParser
+from os.path import abspath, dirname, isdir, join
+
+import simplejson
+
+ROOT = abspath(join(dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+USERNAME = 'bench'
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def run(args, cwd=None, env=None, stdin=None):
+    """Run a command, raising if it fails. Returns it's output."""
+    process = subprocess.Popen(args, cwd=cwd, env=env, stdin=stdin,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    if process.returncode:
+        raise RuntimeError("%s failed (%d): %s" % (' '.join(args),
+                                                   process.returncode,
+                                                   output.strip()))
+    return output
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def generate_repository(path, seed, size, changesets, files):
+    """Create a mercurial repository at `path` of about `size` bytes of
+    text spread over `files` files and `changesets` changesets."""
+    rng = random.Random(seed)
+    run(['hg', 'init', path])
+    words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz')
+                     for _ in xrange(rng.randint(2, 10)))
+             for _ in xrange(2000)]
+    per_changeset = max(size // changesets, 1)
+    for number in xrange(changesets):
+        written = 0
+        while written < per_changeset:
+            filename = join(path, 'dir%02d' % rng.randint(0, 9),
+                            'file%04d.txt' % rng.randint(0, files - 1))
+            if not isdir(dirname(filename)):
+                os.makedirs(dirname(filename))
+            lines = []
+            for _ in xrange(rng.randint(20, 200)):
+                lines.append(' '.join(rng.choice(words)
+                                      for _ in xrange(12)))
+            data = '\n'.join(lines) + '\n'
+            fd = open(filename, 'a')
+            fd.write(data)
+            fd.close()
+            written += len(data)
+        run(['hg', 'commit', '-A', '-q', '-u', 'bench', '-d', '%d 0' % number,
+             '-m', 'changeset %d' % number], cwd=path)
+
+
+class Server(object):
+    """An SSHg server on a temporary configuration directory."""
+
+    def __init__(self, workdir, options):
+        self.workdir = workdir
+        self.options = options
+        self.confdir = join(workdir, 'config')
+        self.port = free_port()
+        self.web_port = free_port()
+        self.client_key = join(workdir, 'client_key')
+        self.process = None
+
+    def setup(self, repositories):
+        from sshg import application, config, database as db
+        from sshg.service import SSHgOptions, UPGRADES_REPO
+
+        # First run writes the configuration file with the defaults
+        try:
+            SSHgOptions().opt_config_dir(self.confdir)
+        except SystemExit:
+            pass
+        configfile = join(self.confdir, 'sshg.ini')
+        parser = SafeConfigParser()
+        parser.read([configfile])
+        parser.set('main', 'port', str(self.port))
+        parser.set('main', 'app_manager', USERNAME)
+        parser.set('web', 'port', str(self.web_port))
+        parser.set('notification', 'enabled', 'false')
+        for option in self.options.config:
+            # section.option=value
+            key, value = option.split('=', 1)
+            section, name = key.split('.', 1)
+            if not parser.has_section(section):
+                parser.add_section(section)
+            parser.set(section, name, value)
+        parser.write(open(configfile, 'w'))
+        SSHgOptions().opt_config_dir(self.confdir)
+
+        run(['ssh-keygen', '-q', '-t', 'rsa', '-b', '2048', '-m', 'PEM',
+             '-N', '', '-f', config.private_key])
+        run(['ssh-keygen', '-q', '-t', 'rsa', '-b', '2048', '-N', '', '-f',
+             self.client_key])
+        for key_type, path in config.host_keys.iteritems():
+            run(['ssh-keygen', '-q', '-t', key_type, '-m', 'PEM', '-N', '',
+                 '-f', path])
+
+        application.database_engine = db.create_engine()
+        db.metadata.create_all(application.database_engine)
+        session = db.session()
+        user = db.User(USERNAME, USERNAME, 'bench@localhost', is_admin=True)
+        user.keys.append(db.PublicKey(open(self.client_key + '.pub').read()))
+        session.add(user)
+        # Same as the setup command, so the server doesn't ask for upgrades
+        if UPGRADES_REPO is not None:
+            path, version = UPGRADES_REPO.path, UPGRADES_REPO.latest
+        else:
+            path = join(ROOT, 'sshg', 'upgrades')
+            version = max(int(os.path.basename(script).split('_')[0])
+                          for script in glob(join(path, 'versions',
+                                                  '0*_*.py')))
+        session.add(db.SchemaVersion("SSHg Schema Version Control", path,
+                                     version))
+        for name, path in repositories:
+            session.add(db.Repository(name, path))
+        session.commit()
+        session.close()
+
+    def start(self):
+        env = os.environ.copy()
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [
+            ROOT, env.get('PYTHONPATH')]))
+        self.process = subprocess.Popen(
+            ['twistd', '-n', '--pidfile=', '-l', join(self.workdir,
+                                                      'server.log'),
+             'sshg', '-c', self.confdir, 'server'],
+            env=env, cwd=self.workdir)
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("Server exited, see %s" %
+                                   join(self.workdir, 'server.log'))
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 1).close()
+                return
+            except socket.error:
+                time.sleep(0.2)
+        raise RuntimeError("Server did not start listening")
+
+    def cpu_times(self):
+        """Return the server's and it's children CPU seconds, including the
+        children that already exited."""
+        pid = self.process.pid
+        fields = open('/proc/%d/stat' % pid).read().rsplit(')', 1)[1].split()
+        own = (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS)
+        children = (int(fields[13]) + int(fields[14])) / float(CLOCK_TICKS)
+        for stat in glob('/proc/[0-9]*/stat'):
+            try:
+                fields = open(stat).read().rsplit(')', 1)[1].split()
+            except IOError:
+                continue
+            if int(fields[1]) == pid:
+                children += (int(fields[11]) + int(fields[12])) / \
+                                                        float(CLOCK_TICKS)
+        return own, children
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            self.process.wait()
+
+    def traffic(self):
+        """Return the incoming and outgoing bytes accounted by the server."""
+        from sshg import config
+        connection = sqlite3.connect(join(config.db.path, config.db.name))
+        row = connection.execute("SELECT SUM(incoming), SUM(outgoing) "
+                                 "FROM repository_traffic").fetchone()
+        connection.close()
+        return row[0] or 0, row[1] or 0
+
+
+class Client(threading.Thread):
+    """Runs the requested operations against a repository, in turn."""
+
+    def __init__(self, number, server, repository, workdir, operations,
+                 iterations, ssh):
+        threading.Thread.__init__(self)
+        self.number = number
+        self.server = server
+        self.repository = repository
+        self.workdir = workdir
+        self.operations = operations
+        self.iterations = iterations
+        self.ssh = ssh
+        self.url = 'ssh://%s@127.0.0.1:%d/%s' % (USERNAME, server.port,
+                                                 repository)
+        self.results = []
+
+    def hg(self, *args, **kwargs):
+        started = time.time()
+        try:
+            run(['hg', '--ssh', self.ssh] + list(args), **kwargs)
+            ok = True
+        except RuntimeError, err:
+            print >> sys.stderr, "Client %d: %s" % (self.number, err)
+            ok = False
+        return time.time() - started, ok
+
+    def run(self):
+        clone = join(self.workdir, 'client%03d' % self.number)
+        for iteration in xrange(self.iterations):
+            for operation in self.operations:
+                if operation == 'clone' or not isdir(clone):
+                    shutil.rmtree(clone, True)
+                    elapsed, ok = self.hg('clone', '-q', '-U', self.url,
+                                          clone)
+                    self.results.append(('clone', elapsed, ok))
+                    if operation == 'clone':
+                        continue
+                if operation == 'pull':
+                    elapsed, ok = self.hg('pull', '-q', self.url, cwd=clone)
+                elif operation == 'push':
+                    run(['hg', 'update', '-q', '-C', 'tip'], cwd=clone)
+                    filename = join(clone, 'client%03d.txt' % self.number)
+                    fd = open(filename, 'a')
+                    fd.write('iteration %d\n' % iteration)
+                    fd.close()
+                    run(['hg', 'commit', '-A', '-q', '-u', 'bench', '-m',
+                         'push %d.%d' % (self.number, iteration)], cwd=clone)
+                    # Concurrent pushes create new heads
+                    elapsed, ok = self.hg('push', '-q', '-f', self.url,
+                                          cwd=clone)
+                else:
+                    raise ValueError("Unknown operation %s" % operation)
+                self.results.append((operation, elapsed, ok))
+
+
+def measure_connection_setup(server, repository, ssh, samples):
+    """Time opening a session running ``hg serve --stdio`` which gets EOF
+    right away: key exchange, authentication and starting the server."""
+    timings = []
+    devnull = open(os.devnull)
+    for _ in xrange(samples):
+        started = time.time()
+        run(ssh.split() + ['-p', str(server.port),
+                           '%s@127.0.0.1' % USERNAME,
+                           'hg -R %s serve --stdio' % repository],
+            stdin=devnull)
+        timings.append(time.time() - started)
+    devnull.close()
+    return timings
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--clients', type='int', default=8,
+                      help='concurrent clients [default: %default]')
+    parser.add_option('--iterations', type='int', default=5,
+                      help='times each client runs the operations '
+                           '[default: %default]')
+    parser.add_option('--operations', default='clone,pull,push',
+                      help='comma separated operations each client runs in '
+                           'turn [default: %default]')
+    parser.add_option('--repositories', type='int', default=2,
+                      help='repositories, clients are spread over them '
+                           '[default: %default]')
+    parser.add_option('--repo-size', type='int', default=20,
+                      help='size of each repository in MB '
+                           '[default: %default]')
+    parser.add_option('--changesets', type='int', default=200,
+                      help='changesets per repository [default: %default]')
+    parser.add_option('--files', type='int', default=500,
+                      help='files per repository [default: %default]')
+    parser.add_option('--seed', type='int', default=0,
+                      help='random seed for the repositories '
+                           '[default: %default]')
+    parser.add_option('--connect-samples', type='int', default=20,
+                      help='connection setup samples [default: %default]')
+    parser.add_option('--host-key-algorithm', metavar='ALGORITHM',
+                      help='host key algorithm the clients ask for, eg, '
+                           'ssh-ed25519, ecdsa-sha2-nistp256 or ssh-rsa '
+                           '[default: the client\'s preference]')
+    parser.add_option('--ssh-option', action='append', default=[],
+                      dest='ssh_options', metavar='OPTION',
+                      help='extra ssh -o option, can be repeated')
+    parser.add_option('--config', action='append', default=[],
+                      metavar='SECTION.OPTION=VALUE',
+                      help='override a server configuration option, can be '
+                           'repeated')
+    parser.add_option('--json', metavar='FILE',
+                      help='also write the results to FILE')
+    parser.add_option('--keep', action='store_true', default=False,
+                      help="don't remove the working directory")
+    options, _ = parser.parse_args()
+    operations = [op.strip() for op in options.operations.split(',')
+                  if op.strip()]
+
+    workdir = tempfile.mkdtemp(prefix='sshg-bench-')
+    server = Server(workdir, options)
+    try:
+        repositories = []
+        print "Generating %d repositories of %d MB" % (options.repositories,
+                                                       options.repo_size)
+        for index in xrange(options.repositories):
+            name = 'repo%02d' % index
+            path = join(workdir, 'repos', name)
+            generate_repository(path, options.seed + index,
+                                options.repo_size * 1024 * 1024,
+                                options.changesets, options.files)
+            repositories.append((name, path))
+        server.setup(repositories)
+
+        ssh = ' '.join(['ssh', '-i', server.client_key,
+                        '-o', 'StrictHostKeyChecking=no',
+                        '-o', 'UserKnownHostsFile=/dev/null',
+                        '-o', 'BatchMode=yes',
+                        '-o', 'LogLevel=ERROR',
+                        '-o', 'HostKeyAlgorithms=%s' % (
+                                        options.host_key_algorithm or
+                                        '+ssh-rsa'),
+                        '-o', 'PubkeyAcceptedKeyTypes=+ssh-rsa'] +
+                       ['-o %s' % option for option in options.ssh_options])
+
+        server.start()
+        print "Server listening on port %d" % server.port
+
+        cpu_before = server.cpu_times()
+        connect = measure_connection_setup(server, repositories[0][0], ssh,
+                                           options.connect_samples)
+        cpu_after = server.cpu_times()
+        # Only the server's own, the children are the hg processes
+        handshake_cpu = (cpu_after[0] - cpu_before[0]) / len(connect)
+
+        cpu_before = server.cpu_times()
+        clients = [Client(number, server,
+                          repositories[number % len(repositories)][0],
+                          workdir, operations, options.iterations, ssh)
+                   for number in xrange(options.clients)]
+        started = time.time()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.time() - started
+        cpu_after = server.cpu_times()
+        server.stop()
+        incoming, outgoing = server.traffic()
+
+        results = {}
+        failures = 0
+        for client in clients:
+            for operation, seconds, ok in client.results:
+                if ok:
+                    results.setdefault(operation, []).append(seconds)
+                else:
+                    failures += 1
+
+        report = {
+            'clients': options.clients,
+            'elapsed': elapsed,
+            'failures': failures,
+            'connection_setup': dict(
+                (name, percentile(connect, fraction)) for name, fraction in
+                (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1))),
+            'host_key_algorithm': options.host_key_algorithm,
+            'handshakes_per_second': len(connect) / sum(connect),
+            'server_cpu_per_handshake': handshake_cpu,
+            'operations': {},
+            'megabytes_per_second': (incoming + outgoing) / elapsed /
+                                    (1024 * 1024),
+            'incoming_bytes': incoming,
+            'outgoing_bytes': outgoing,
+            'server_cpu': cpu_after[0] - cpu_before[0],
+            'children_cpu': cpu_after[1] - cpu_before[1],
+        }
+        for operation, timings in results.iteritems():
+            report['operations'][operation] = dict(
+                [('count', len(timings))] +
+                [(name, percentile(timings, fraction)) for name, fraction in
+                 (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1))])
+
+        print
+        print "Connection setup: p50 %(p50).3fs  p90 %(p90).3fs  " \
+              "p99 %(p99).3fs  max %(max).3fs" % report['connection_setup']
+        print "Handshakes:       %.1f/s sequential, %.1fms server CPU each " \
+              "(%s)" % (report['handshakes_per_second'], handshake_cpu * 1000,
+                        options.host_key_algorithm or 'client default')
+        print
+        print "%-8s %6s %9s %9s %9s %9s" % ('op', 'count', 'p50', 'p90',
+                                            'p99', 'max')
+        for operation in operations:
+            if operation not in report['operations']:
+                continue
+            stats = report['operations'][operation]
+            print "%-8s %6d %8.3fs %8.3fs %8.3fs %8.3fs" % (
+                operation, stats['count'], stats['p50'], stats['p90'],
+                stats['p99'], stats['max'])
+        print
+        print "Wall time:    %.1fs, %d failed operations" % (elapsed, failures)
+        print "Throughput:   %.2f MB/s (%d bytes in, %d bytes out)" % (
+            report['megabytes_per_second'], incoming, outgoing)
+        print "Server CPU:   %.2fs (%.0f%% of one core)" % (
+            report['server_cpu'], report['server_cpu'] / elapsed * 100)
+        print "Children CPU: %.2fs" % report['children_cpu']
+
+        if options.json:
+            simplejson.dump(report, open(options.json, 'w'), indent=2)
+    finally:
+        server.stop()
+        if options.keep:
+            print "Working directory kept at %s" % workdir
+        else:
+            shutil.rmtree(workdir, True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+"""
+    benchmarks.pwhash
+    ~~~~~~~~~~~~~~~~~
+
+    Password logins per second at each cost of the password hash schemes.
+
+    Checks a password against it's hash, as a password login does, for a
+    while at each cost and reports how many checks per second a single
+    thread and ``--threads`` threads, the size of the server's password
+    hashing pool, get through. Use it to pick the ``[passwords]`` costs.
+
+    Usage::
+
+        python benchmarks/pwhash.py [--seconds 2] [--threads 2]
+                                    [--scheme pbkdf2_sha256 --costs 1000,..]
+
+    :copyright: © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import os
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+
+from sshg.utils.crypto import check_pwhash, gen_pwhash, PWHASH_SCHEMES
+
+DEFAULT_COSTS = {
+    'pbkdf2_sha256': [10000, 50000, 100000, 200000],
+    'scrypt': [12, 14, 15, 16],
+}
+
+
+def logins_per_second(pwhash, seconds, threads):
+    counts = [0] * threads
+    deadline = time.time() + seconds
+
+    def run(index):
+        while time.time() < deadline:
+            check_pwhash(pwhash, 'secret')
+            counts[index] += 1
+
+    workers = [threading.Thread(target=run, args=(index,))
+               for index in xrange(threads)]
+    started = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sum(counts) / (time.time() - started)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--scheme', action='append', default=[],
+                      dest='schemes', help='scheme to measure, can be '
+                                           'repeated [default: all]')
+    parser.add_option('--costs', help='comma separated costs to measure '
+                                      '[default: a few per scheme]')
+    parser.add_option('--seconds', type='float', default=2,
+                      help='time spent on each measurement '
+                           '[default: %default]')
+    parser.add_option('--threads', type='int', default=2,
+                      help='concurrent checks, as the password hashing '
+                           'threads [default: %default]')
+    options, _ = parser.parse_args()
+
+    schemes = options.schemes or sorted(PWHASH_SCHEMES)
+    print "%-14s %8s %10s %12s %12s" % ('scheme', 'cost', 'ms/login',
+                                        'logins/s', 'logins/s (%d)' %
+                                        options.threads)
+    legacy = gen_pwhash('secret', 'sha')
+    rate = logins_per_second(legacy, options.seconds, 1)
+    print "%-14s %8s %10.3f %12.0f %12.0f" % (
+        'sha', '-', 1000 / rate, rate,
+        logins_per_second(legacy, options.seconds, options.threads))
+    for scheme in schemes:
+        if scheme not in PWHASH_SCHEMES:
+            print "%-14s not available" % scheme
+            continue
+        if options.costs:
+            costs = [int(cost) for cost in options.costs.split(',')]
+        else:
+            costs = DEFAULT_COSTS.get(scheme, [PWHASH_SCHEMES[scheme][1]])
+        for cost in costs:
+            pwhash = gen_pwhash('secret', scheme, cost)
+            rate = logins_per_second(pwhash, options.seconds, 1)
+            print "%-14s %8d %10.3f %12.1f %12.1f" % (
+                scheme, cost, 1000 / rate, rate,
+                logins_per_second(pwhash, options.seconds, options.threads))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+"""
+    benchmarks.session_pump
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Micro-benchmark of the session channel data path.
+
+    Pumps a fixed amount of data through ``FixedSSHSession.write`` (the
+    ``hg`` process to SSH client direction) and ``dataReceived`` (the SSH
+    client to ``hg`` process direction) using fake connection and process
+    transports, and reports MB/s per core, ie, bytes moved per second of
+    process CPU time.
+
+    The ``legacy`` figures come from a copy of the previous implementation,
+    which used ``inlineCallbacks`` and logged on every chunk.
+
+    Usage::
+
+        python benchmarks/session_pump.py [--megabytes 256] [--chunk 32768]
+
+    :copyright: © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import logging
+import os
+import sys
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+
+from twisted.conch.ssh import session
+from twisted.internet import defer
+
+from sshg import logger
+from sshg.sessions import FixedSSHSession
+
+log = logger.getLogger('sshg.sessions')
+
+
+class LegacySSHSession(session.SSHSession):
+    """The session channel data path as it was before being rewritten."""
+    in_counter = 0
+    out_counter = 0
+
+    @defer.inlineCallbacks
+    def dataReceived(self, data):
+        self.in_counter += yield len(data)
+        yield log.debug("Current In Counter: %s", self.in_counter)
+        if self.client.transport:
+            yield self.client.transport.write(data)
+
+    @defer.inlineCallbacks
+    def write(self, data):
+        self.out_counter += yield len(data)
+        yield session.SSHSession.write(self, data)
+
+
+class FakeConnection(object):
+    """Stands for the SSH connection; just swallows channel data."""
+    transport = None
+
+    def __init__(self):
+        self.sent = 0
+
+    def sendData(self, channel, data):
+        self.sent += len(data)
+
+    def sendExtendedData(self, channel, dataType, data):
+        self.sent += len(data)
+
+    def sendClose(self, channel):
+        pass
+
+
+class FakeProcessTransport(object):
+    """Stands for the ``hg`` process transport; just swallows stdin data."""
+
+    def __init__(self):
+        self.received = 0
+
+    def write(self, data):
+        self.received += len(data)
+
+    def loseConnection(self):
+        pass
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.transport = FakeProcessTransport()
+
+
+def make_channel(klass, chunk_size):
+    conn = FakeConnection()
+    channel = klass(remoteWindow=sys.maxint, remoteMaxPacket=chunk_size,
+                    conn=conn)
+    channel.client = FakeClient()
+    return channel
+
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def run(klass, direction, total, chunk_size):
+    channel = make_channel(klass, chunk_size)
+    chunk = 'x' * chunk_size
+    iterations = total // chunk_size
+    if direction == 'out':
+        pump = channel.write
+    else:
+        pump = channel.dataReceived
+    started = cpu_time()
+    for _ in xrange(iterations):
+        pump(chunk)
+    elapsed = max(cpu_time() - started, 1e-6)
+    return (iterations * chunk_size) / elapsed / (1024 * 1024)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--megabytes', type='int', default=256,
+                      help='amount of data to pump per run [default: %default]')
+    parser.add_option('--chunk', type='int', default=32768,
+                      help='size of each chunk in bytes [default: %default]')
+    parser.add_option('--debug', action='store_true', default=False,
+                      help='keep debug logging enabled, as it is in '
+                           'production today')
+    options, _ = parser.parse_args()
+
+    if not options.debug:
+        logging.getLogger('sshg').setLevel(logging.INFO)
+
+    total = options.megabytes * 1024 * 1024
+    print "Pumping %d MB in %d byte chunks" % (options.megabytes,
+                                               options.chunk)
+    print "%-10s %-10s %12s" % ('path', 'direction', 'MB/s/core')
+    for name, klass in (('legacy', LegacySSHSession),
+                        ('current', FixedSSHSession)):
+        for direction in ('out', 'in'):
+            rate = run(klass, direction, total, options.chunk)
+            print "%-10s %-10s %12.1f" % (name, direction, rate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+"""
+    sshg.accesslog
+    ~~~~~~~~~~~~~~
+
+    This module writes the access log: one JSON object per line for each
+    SSH session channel, with who opened it, what for, how long it took and
+    how much was transferred.
+
+    Entries are encoded when the channel closes and written by a thread of
+    their own, see `sshg.logger.QueueWriter`. The file is rotated once it
+    grows past a size or gets older than an interval, rotated files are
+    compressed with gzip, and only so many of them are kept.
+
+    :copyright: © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import gzip
+import logging
+import os
+import shutil
+import simplejson
+from glob import glob
+from logging.handlers import BaseRotatingHandler
+from time import time, strftime, localtime
+
+from sshg import logger
+from sshg.logger import QueueWriter
+
+log = logger.getLogger(__name__)
+
+
+class RotatingFileHandler(BaseRotatingHandler):
+    """Rotates `filename` once it's over `max_size` bytes or `interval`
+    seconds old, 0 disabling either. Rotated files are named after when
+    they were rotated, compressed if `compress` is set, and the oldest
+    removed past `backups` of them, 0 keeping them all."""
+
+    def __init__(self, filename, max_size=0, interval=0, backups=0,
+                 compress=True):
+        BaseRotatingHandler.__init__(self, filename, 'a')
+        self.max_size = max_size
+        self.interval = interval
+        self.backups = backups
+        self.compress = compress
+        self.rollover_at = interval and time() + interval or None
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and time() >= self.rollover_at:
+            return True
+        if self.max_size:
+            self.stream.seek(0, 2)
+            return self.stream.tell() + len(record.msg) + 1 > self.max_size
+        return False
+
+    def doRollover(self):
+        self.stream.close()
+        self.stream = None
+        if self.interval:
+            self.rollover_at = time() + self.interval
+        if os.path.exists(self.baseFilename) and \
+                                    os.path.getsize(self.baseFilename):
+            rotated = '%s.%s' % (self.baseFilename,
+                                 strftime('%Y%m%d-%H%M%S', localtime()))
+            suffix = 1
+            while glob(rotated + '*'):
+                # Rotated twice within a second
+                rotated = '%s.%s-%d' % (self.baseFilename,
+                                        strftime('%Y%m%d-%H%M%S', localtime()),
+                                        suffix)
+                suffix += 1
+            os.rename(self.baseFilename, rotated)
+            if self.compress:
+                self._compress(rotated)
+            self._removeOld()
+        self.stream = self._open()
+
+    def _compress(self, path):
+        source = open(path, 'rb')
+        try:
+            target = gzip.open(path + '.gz', 'wb')
+            try:
+                shutil.copyfileobj(source, target)
+            finally:
+                target.close()
+        except (IOError, OSError), err:
+            log.error("Failed to compress %s: %s", path, err)
+            return
+        finally:
+            source.close()
+        os.remove(path)
+
+    def _removeOld(self):
+        if not self.backups:
+            return
+        rotated = sorted(glob(self.baseFilename + '.*'),
+                         key=os.path.getmtime)
+        for path in rotated[:-self.backups]:
+            try:
+                os.remove(path)
+            except OSError, err:
+                log.error("Failed to remove %s: %s", path, err)
+
+
+class AccessLog(object):
+
+    def __init__(self, filename, max_size=0, rotate_interval=0, backups=0,
+                 compress=True):
+        handler = RotatingFileHandler(filename, max_size, rotate_interval,
+                                      backups, compress)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.writer = QueueWriter([handler], name='sshg.accesslog')
+
+    def record(self, **fields):
+        """Write an entry with `fields`, which must be JSON serializable."""
+        self.writer.put(logging.makeLogRecord({
+            'name': __name__, 'levelno': logging.INFO, 'levelname': 'INFO',
+            'msg': simplejson.dumps(fields, separators=(',', ':'))
+        }))
+
+    def stop(self):
+        self.writer.stop()
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+"""
+    sshg.admission
+    ~~~~~~~~~~~~~~
+
+    This module limits how many repositories are served concurrently, in
+    total, per user and per repository.
+
+    Requests over the limits wait on a queue until a slot frees up or their
+    timeout expires. Each user has it's own FIFO queue and users take turns,
+    so a user with lots of waiting requests does not hold back everyone
+    else.
+
+    :copyright: © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+from collections import deque
+from time import time
+
+from twisted.internet import defer, reactor
+
+from sshg import logger
+
+log = logger.getLogger(__name__)
+
+
+class AdmissionTimeout(Exception):
+    """Raised when a request waited too long for a slot"""
+
+
+class Ticket(object):
+    """A request for a slot. It's `deferred` fires with the ticket itself
+    once the slot is granted. Call `release` when done with the slot, or to
+    give up waiting for it."""
+
+    WAITING, GRANTED, RELEASED = range(3)
+
+    def __init__(self, scheduler, username, reponame):
+        self.scheduler = scheduler
+        self.username = username
+        self.reponame = reponame
+        self.deferred = defer.Deferred()
+        self.state = self.WAITING
+        self.requested = time()
+        self.timeout_call = None
+
+    def release(self):
+        self.scheduler.release(self)
+
+    def __repr__(self):
+        return '<Ticket User: "%s" Repository: "%s">' % (self.username,
+                                                         self.reponame)
+
+
+class AdmissionScheduler(object):
+    """Admits requests within the configured limits; a limit of 0 means
+    unlimited."""
+
+    def __init__(self, max_total=0, max_per_user=0, max_per_repository=0,
+                 timeout=60):
+        self.max_total = max_total
+        self.max_per_user = max_per_user
+        self.max_per_repository = max_per_repository
+        self.timeout = timeout
+        self.running = 0
+        self.running_per_user = {}
+        self.running_per_repository = {}
+        # Waiting tickets per user, and the order in which users take turns
+        self.queues = {}
+        self.turns = deque()
+        self.queued = 0
+        # Statistics
+        self.admitted = 0
+        self.queued_total = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def request(self, username, reponame):
+        """Return a `Ticket` for a slot to serve `reponame` to `username`."""
+        ticket = Ticket(self, username, reponame)
+        if not self.queued and self._fits(ticket):
+            self._grant(ticket)
+            return ticket
+        log.debug("Queueing %r; %d running, %d queued", ticket, self.running,
+                  self.queued)
+        if username not in self.queues:
+            self.queues[username] = deque()
+            self.turns.append(username)
+        self.queues[username].append(ticket)
+        self.queued += 1
+        self.queued_total += 1
+        if self.timeout:
+            ticket.timeout_call = reactor.callLater(self.timeout,
+                                                    self._expire, ticket)
+        # Slots might be free for this user even with others queued
+        self._dispatch()
+        return ticket
+
+    def release(self, ticket):
+        if ticket.state == Ticket.WAITING:
+            self._unqueue(ticket)
+            ticket.state = Ticket.RELEASED
+        elif ticket.state == Ticket.GRANTED:
+            ticket.state = Ticket.RELEASED
+            self.running -= 1
+            self._decrement(self.running_per_user, ticket.username)
+            self._decrement(self.running_per_repository, ticket.reponame)
+            self._dispatch()
+
+    def stats(self):
+        admitted = self.admitted or 1
+        return {
+            'running': self.running,
+            'queued': self.queued,
+            'admitted': self.admitted,
+            'queued_total': self.queued_total,
+            'timeouts': self.timeouts,
+            'average_wait': self.total_wait / admitted,
+            'max_wait': self.max_wait,
+            'running_per_user': self.running_per_user.copy(),
+            'running_per_repository': self.running_per_repository.copy(),
+            'queued_per_user': dict((username, len(queue)) for username, queue
+                                    in self.queues.iteritems()),
+        }
+
+    def _fits(self, ticket):
+        if self.max_total and self.running >= self.max_total:
+            return False
+        if self.max_per_user and self.running_per_user.get(
+                                ticket.username, 0) >= self.max_per_user:
+            return False
+        if self.max_per_repository and self.running_per_repository.get(
+                            ticket.reponame, 0) >= self.max_per_repository:
+            return False
+        return True
+
+    def _grant(self, ticket):
+        ticket.state = Ticket.GRANTED
+        self.running += 1
+        self.running_per_user[ticket.username] = \
+                self.running_per_user.get(ticket.username, 0) + 1
+        self.running_per_repository[ticket.reponame] = \
+                self.running_per_repository.get(ticket.reponame, 0) + 1
+        wait = time() - ticket.requested
+        self.admitted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        ticket.deferred.callback(ticket)
+
+    def _dispatch(self):
+        """Grant slots to waiting tickets, taking one ticket per user in
+        turn, until no waiting ticket fits."""
+        granted = True
+        while granted and self.turns:
+            granted = False
+            for username in list(self.turns):
+                ticket = self.queues[username][0]
+                if not self._fits(ticket):
+                    continue
+                self._unqueue(ticket)
+                if username in self.queues:
+                    # Back to the end of the line
+                    self.turns.remove(username)
+                    self.turns.append(username)
+                self._grant(ticket)
+                granted = True
+                break
+
+    def _unqueue(self, ticket):
+        queue = self.queues[ticket.username]
+        queue.remove(ticket)
+        if not queue:
+            del self.queues[ticket.username]
+            self.turns.remove(ticket.username)
+        self.queued -= 1
+        if ticket.timeout_call is not None and ticket.timeout_call.active():
+            ticket.timeout_call.cancel()
+
+    def _expire(self, ticket):
+        ticket.timeout_call = None
+        self._unqueue(ticket)
+        ticket.state = Ticket.RELEASED
+        self.timeouts += 1
+        log.warning("%r waited over %d seconds for a slot", ticket,
+                    self.timeout)
+        ticket.deferred.errback(AdmissionTimeout(
+            "Server too busy, please try again later."))
+
+    def _decrement(self, counts, key):
+        counts[key] -= 1
+        if not counts[key]:
+            del counts[key]
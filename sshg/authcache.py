@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+"""
+    sshg.authcache
+    ~~~~~~~~~~~~~~
+
+    This module implements an in-memory cache of what users are allowed to do
+    on repositories, and of their roles, so that logging in and executing
+    ``hg`` commands needs no database queries on the common case.
+
+    Whatever changes repository memberships, ACL rules, quotas or user roles
+    must invalidate the affected entries. Entries also expire after a while,
+    as a safety net for changes made outside SSHg.
+
+    :copyright: © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import threading
+from time import time
+
+#: User roles, which decide the avatar a user gets
+REGULAR, MANAGER, ADMIN = 'regular', 'manager', 'admin'
+
+
+class RepositoryAuthorization(object):
+    """What a user is allowed to do on a repository."""
+
+    def __init__(self, name, path, size, quota, sources, allow, deny,
+                 incoming_quota=0, outgoing_quota=0):
+        self.name = name
+        self.path = path
+        self.size = size
+        self.quota = quota
+        self.sources = sources
+        self.allow = allow
+        self.deny = deny
+        # Bandwidth limits, in bytes per second
+        self.incoming_quota = incoming_quota
+        self.outgoing_quota = outgoing_quota
+        self.stamp = time()
+
+    @property
+    def over_quota(self):
+        if self.quota == 0:
+            return False
+        return self.size > self.quota
+
+    def __repr__(self):
+        return '<RepositoryAuthorization "%s" Path: "%s">' % (self.name,
+                                                              self.path)
+
+
+class AuthorizationCache(object):
+    """Authorizations keyed by ``(username, repository name)``, and user
+    roles keyed by username.
+
+    The web interface runs on a thread pool, so all access is locked.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._entries = {}
+        self._roles = {}
+        self._lock = threading.Lock()
+
+    def get_role(self, username):
+        entry = self._roles.get(username)
+        if entry is None:
+            return None
+        role, stamp = entry
+        if time() - stamp > self.ttl:
+            self._lock.acquire()
+            try:
+                self._roles.pop(username, None)
+            finally:
+                self._lock.release()
+            return None
+        return role
+
+    def set_role(self, username, role):
+        self._lock.acquire()
+        try:
+            self._roles[username] = (role, time())
+        finally:
+            self._lock.release()
+
+    def get(self, username, reponame):
+        key = (username, reponame)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time() - entry.stamp > self.ttl:
+            self._lock.acquire()
+            try:
+                self._entries.pop(key, None)
+            finally:
+                self._lock.release()
+            return None
+        return entry
+
+    def set(self, username, reponame, authorization):
+        self._lock.acquire()
+        try:
+            self._entries[(username, reponame)] = authorization
+        finally:
+            self._lock.release()
+
+    def invalidate(self, username=None, reponame=None):
+        """Drop the entries of `username`, of `reponame`, or all of them if
+        neither is passed. Roles are dropped along, all of them unless
+        `username` is passed since a repository's managers might have
+        changed."""
+        self._lock.acquire()
+        try:
+            if username is None:
+                self._roles.clear()
+            else:
+                self._roles.pop(username, None)
+            if username is None and reponame is None:
+                self._entries.clear()
+                return
+            for key in self._entries.keys():
+                if (username is None or key[0] == username) and \
+                   (reponame is None or key[1] == reponame):
+                    del self._entries[key]
+        finally:
+            self._lock.release()
+
+    def update_size(self, reponame, size):
+        """Update the repository's size on all of it's entries."""
+        self._lock.acquire()
+        try:
+            for key, entry in self._entries.iteritems():
+                if key[1] == reponame:
+                    entry.size = size
+        finally:
+            self._lock.release()
+
+
+#: The authorizations cache used throughout SSHg
+authorizations = AuthorizationCache()
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+"""
+    sshg.authguard
+    ~~~~~~~~~~~~~~
+
+    This module keeps dictionary scans from reaching the database.
+
+    Usernames found not to exist are remembered for a while, and failed
+    logins are counted per source address and per username. Once too many
+    failures pile up, further attempts from that address or for that user
+    are refused for a time which doubles with each failure, up to a
+    maximum. Refused attempts cost a dictionary lookup.
+
+    Only real failures count: wrong passwords, bad signatures and unknown
+    users. Clients going through their keys until one is accepted don't.
+
+    :copyright: © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+from time import time
+
+from twisted.internet import task
+
+from sshg import logger
+
+log = logger.getLogger(__name__)
+
+
+class Failures(object):
+    """Failed logins from an address or for a user."""
+
+    __slots__ = ('count', 'last', 'blocked_until')
+
+    def __init__(self):
+        self.count = 0
+        self.last = self.blocked_until = 0
+
+
+class AuthGuard(object):
+
+    def __init__(self, unknown_ttl=300, threshold=5, base_delay=1,
+                 max_delay=600, reset_after=3600):
+        self.unknown_ttl = unknown_ttl
+        self.threshold = threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.reset_after = reset_after
+        # Unknown usernames and when they expire
+        self.unknown = {}
+        self.addresses = {}
+        self.users = {}
+        self.refused = 0
+        self._cleanup_task = task.LoopingCall(self.cleanup)
+
+    def start(self):
+        self._cleanup_task.start(60, now=False)
+
+    def stop(self):
+        if self._cleanup_task.running:
+            self._cleanup_task.stop()
+
+    def check(self, address, username):
+        """Return why an attempt from `address` for `username` should be
+        refused right away, or `None` if it may go on."""
+        now = time()
+        expires = self.unknown.get(username)
+        if expires is not None:
+            if expires > now:
+                self.refused += 1
+                return "unknown user"
+            del self.unknown[username]
+        for failures in (self.addresses.get(address),
+                         self.users.get(username)):
+            if failures is not None and failures.blocked_until > now:
+                self.refused += 1
+                return "too many failures"
+        return None
+
+    def failed(self, address, username, unknown=False):
+        """Record a failed attempt; `unknown` if the user does not exist."""
+        now = time()
+        if unknown:
+            self.unknown[username] = now + self.unknown_ttl
+        self._failed(self.addresses, address, now)
+        if not unknown:
+            # Unknown users can't be locked out, no point tracking them
+            self._failed(self.users, username, now)
+
+    def _failed(self, entries, name, now):
+        failures = entries.get(name)
+        if failures is None:
+            failures = entries[name] = Failures()
+        elif now - failures.last > self.reset_after:
+            failures.count = 0
+        failures.count += 1
+        failures.last = now
+        if failures.count >= self.threshold:
+            delay = min(self.base_delay *
+                        2 ** (failures.count - self.threshold),
+                        self.max_delay)
+            failures.blocked_until = now + delay
+            if failures.count == self.threshold:
+                log.warning("Too many failed logins from/for %s, backing off",
+                            name)
+
+    def succeeded(self, address, username):
+        """Record a successful login. The user's failures are forgotten, the
+        address' ones are not since it might be shared."""
+        self.users.pop(username, None)
+
+    def forget(self, name=None):
+        """Forget what's known about the address or username `name`, or
+        everything if not passed."""
+        if name is None:
+            self.unknown.clear()
+            self.addresses.clear()
+            self.users.clear()
+            return
+        self.unknown.pop(name, None)
+        self.addresses.pop(name, None)
+        self.users.pop(name, None)
+
+    def cleanup(self):
+        now = time()
+        for name, expires in self.unknown.items():
+            if expires <= now:
+                del self.unknown[name]
+        for entries in self.addresses, self.users:
+            for name, failures in entries.items():
+                if failures.blocked_until <= now and \
+                                        now - failures.last > self.reset_after:
+                    del entries[name]
+
+    def stats(self):
+        now = time()
+        blocked = lambda entries: dict(
+            (name, (failures.count, failures.blocked_until - now))
+            for name, failures in entries.iteritems()
+            if failures.blocked_until > now)
+        return {
+            'refused': self.refused,
+            'unknown': len(self.unknown),
+            'addresses': len(self.addresses),
+            'users': len(self.users),
+            'blocked_addresses': blocked(self.addresses),
+            'blocked_users': blocked(self.users),
+        }
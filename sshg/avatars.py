@@ -10,141 +10,124 @@
     :license: BSD, see LICENSE for more details.
 """
 
-import binascii
-import shutil
-import tempfile
-from os.path import abspath, join
+from datetime import datetime
+
 from twisted.conch.insults import insults
-from twisted.conch.ssh import keys
 from twisted.conch.ssh.session import ISession
-from twisted.conch.ssh.filetransfer import SFTPError, ISFTPServer
-from twisted.conch.unix import UnixConchUser
+from twisted.conch.ssh.filetransfer import ISFTPServer
 from twisted.conch.avatar import ConchUser
 from twisted.internet import defer
-from twisted.python import components, log
+from twisted.python import components, failure
 
-from sshg import logger
+from sshg import logger, database as db
+from sshg.keycache import parsed_keys
+from sshg.utils.crypto import openssh_key_fingerprint
 from sshg.sessions import (MercurialSession, MercurialAdminSession,
                            FixedSSHSession)
-from sshg.sftp import SFTPFileTransfer, FileTransferServer
+from sshg.sftp import SFTPFileTransfer, FileTransferServer, KeysDirectory
 from sshg.database import require_session, User, PublicKey
 
 log = logger.getLogger(__name__)
 
-def validPublicKey(public_key_contents):
-    try:
-        keys.Key.fromString(data=public_key_contents)
-    except (binascii.Error, keys.BadKeyError):
-        return False
-    return True
-
 class MercurialUser(ConchUser, components.Adapter):
-    homeDir = _user = _keys = keys_file_path = None
+    keys_directory = None
 
     def __init__(self, original, username):
         components.Adapter.__init__(self, original)
         ConchUser.__init__(self)
-        self.username = username
+        self.username = str(username)
+        # The public key used to log in, see `sshg.checkers.AvatarId`
+        self.login_key = getattr(username, 'key', None)
+        # Waiting for the keys directory to load
+        self._waiting = []
         self.channelLookup.update({'session': FixedSSHSession})
         self.subsystemLookup.update({'sftp': FileTransferServer})
 
-    def _runAsUser(self, f, *args, **kw):
-        # Override UnixConchUser._runAsUser because we're not changing
-        # uid's nor gid's.
-        # Home directories are created, destroyed and populated at runtime
-        # because they will only hold the public keys file
-        try:
-            f = iter(f)
-        except TypeError:
-            f = [(f, args, kw)]
-        for i in f:
-            func = i[0]
-            args = len(i)>1 and i[1] or ()
-            kw = len(i)>2 and i[2] or {}
-            try:
-                r = func(*args, **kw)
-            except SFTPError:
-                # Maybe uploading a file bigger than it should be?
-                break
-        return r
-
     @property
     @require_session
     def user(self, session=None):
         return session.query(User).get(self.username)
 
-    @property
-    @require_session
-    def keys(self, session=None):
-        return [k.key.strip() for k in
-                session.query(User).get(self.username).keys]
-
-    def getHomeDir(self):
-        if not self.homeDir:
-            self.homeDir = tempfile.mkdtemp()
-            log.debug('Creating home directory for user "%s": %s' % (
-                      self.username, self.homeDir))
-
-            # Populate keys file with current user's keys
-            self.keys_file_path = abspath(join(self.homeDir, "authorized_keys"))
-            keys_file = open(self.keys_file_path, 'w')
-            for key in self.keys:
-                keys_file.write(key + '\n')
-            keys_file.close()
-        return self.homeDir
+    def getKeysDirectory(self):
+        """Return a deferred firing with the directory served through SFTP,
+        see `sshg.sftp.KeysDirectory`, which is loaded on first use."""
+        if self.keys_directory is not None:
+            return defer.succeed(self.keys_directory)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        if len(self._waiting) == 1:
+            log.debug('Loading keys directory of user "%s"', self.username)
+            load = db.run_in_session(self._loadKeys)
+            load.addBoth(self._cbLoadKeys)
+        return d
+
+    def _loadKeys(self, session):
+        # Runs on the database thread pool
+        table = PublicKey.__table__
+        return [row.key for row in session.execute(
+            db.select([table.c.key], table.c.user_id==self.username))]
+
+    def _cbLoadKeys(self, result):
+        waiting, self._waiting = self._waiting, []
+        if isinstance(result, failure.Failure):
+            for d in waiting:
+                d.errback(result)
+            return
+        self.keys_directory = KeysDirectory(result)
+        for d in waiting:
+            d.callback(self.keys_directory)
 
     def logout(self):
-        return defer.maybeDeferred(self._logout)
-
-    @require_session
-    def _logout(self, session=None):
+        file_keys = None
+        if self.keys_directory is not None and self.keys_directory.changed():
+            file_keys = self.keys_directory.authorized_keys()
+            if file_keys is None:
+                log.debug('User "%s" has no authorized_keys file anymore, '
+                          'leaving the keys untouched', self.username)
+        if file_keys is None:
+            log.debug('User "%s" logged out' % self.username)
+            return defer.succeed(None)
+        return db.run_in_session(self._logout, file_keys)
+
+    def _logout(self, session, uploaded_keys):
+        # Runs on the database thread pool
         log.debug('User "%s" logging out' % self.username)
-        user = session.query(User).get(self.username)
-        pkeys = [k.key.strip() for k in user.keys]
-
-        if self.homeDir:
-            log.debug("Checking if user updated the public keys file")
-            # Perhaps check each file in the user home dir???
-            file_keys = []
-            lineno = 1
-            for line in open(self.keys_file_path):
-                key = line.strip()
-                if not validPublicKey(key):
-                    log.debug("Ignoring line %i. Invalid key" % lineno )
-                elif key == user.last_used_key.key:
-                    log.debug("Key on line %i was used to login. "
-                            "Skipping." % lineno)
-                    if key in pkeys:
-                        pkeys.pop(pkeys.index(key))
-                else:
-                    file_keys.append(key)
-                lineno += 1
-            deleted_keys = 0
-            added_keys = 0
-            for key in file_keys:
-                if key in pkeys:
-                    pkeys.pop(pkeys.index(key))
-                elif key not in pkeys:
-                    # Add new keys to database
-                    added_keys += 1
-                    user.keys.append(PublicKey(key))
-            for dbkey in user.keys:
-                # Any existing keys in self.keys were deleted from file and
-                # thus should be deleted from database
-                if dbkey.key in pkeys:
-                    # Sanity Check
-                    if dbkey.key != user.last_used_key.key:
-                        deleted_keys += 1
-                        session.delete(dbkey)
-
-            session.commit()
-            log.debug("User %s added %s and removed %s keys." % (
-                    self.username, added_keys, deleted_keys))
-            # Now remove any evidences from the file system
-            log.debug("Removing temporary home dir of user %s" % self.username)
-            shutil.rmtree(self.homeDir, True)
-        # Remove last used key from user
-        user.last_used_key = None
+        table = PublicKey.__table__
+        uploaded = dict((openssh_key_fingerprint(key), key)
+                        for key in uploaded_keys)
+        existing = dict(session.execute(db.select(
+            [table.c.fingerprint, table.c.key],
+            table.c.user_id==self.username)).fetchall())
+
+        added = set(uploaded).difference(existing)
+        deleted = set(existing).difference(uploaded)
+        if self.login_key:
+            # Never remove the key used to log in
+            deleted.discard(openssh_key_fingerprint(self.login_key))
+
+        if added:
+            # Keys are unique, skip those some other user has
+            taken = set(row.fingerprint for row in session.execute(db.select(
+                [table.c.fingerprint], table.c.fingerprint.in_(list(added)))))
+            if taken:
+                log.warning('User "%s" uploaded %d keys belonging to other '
+                            'users, ignoring them', self.username, len(taken))
+                added -= taken
+        if added:
+            now = datetime.utcnow()
+            session.execute(table.insert(), [
+                {'key': uploaded[fingerprint], 'fingerprint': fingerprint,
+                 'user_id': self.username, 'added_on': now, 'used_on': now}
+                for fingerprint in added])
+        if deleted:
+            session.execute(table.delete(db.and_(
+                table.c.user_id==self.username,
+                table.c.fingerprint.in_(list(deleted)))))
+            for fingerprint in deleted:
+                parsed_keys.invalidate(existing[fingerprint])
+
+        log.debug("User %s added %s and removed %s keys." % (
+                self.username, len(added), len(deleted)))
         log.debug('User "%s" logged out' % self.username)
 
 
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+"""
+    sshg.bundlecache
+    ~~~~~~~~~~~~~~~~
+
+    This module implements an on-disk cache of the changegroups generated
+    for clones and pulls, keyed by repository, it's heads and the requested
+    changesets, so that clients repeatedly fetching the same changesets
+    don't make mercurial generate and compress them again.
+
+    Entries live under a directory per repository and are evicted least
+    recently used first once the cache grows over it's maximum size. A
+    repository's entries are dropped when a push changes it.
+
+    The cache is shared by the in-process workers, each keeping a running
+    total of it's size. The total is only exact after walking the cache,
+    which is done when it goes over the maximum size, to find what to
+    evict, and every once in a while to account for the other workers.
+
+    :copyright: © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import os
+import threading
+from hashlib import sha1
+from os.path import isdir, join
+from time import time
+
+#: How often, in seconds, the cache's size is walked again
+RESCAN_INTERVAL = 300
+
+
+class CacheWriter(object):
+    """File like object storing a new cache entry. The entry only becomes
+    visible once committed."""
+
+    def __init__(self, cache, filepath):
+        self.cache = cache
+        self.filepath = filepath
+        self.tmppath = '%s.%d.tmp' % (filepath, os.getpid())
+        self.fd = open(self.tmppath, 'wb')
+
+    def write(self, data):
+        self.fd.write(data)
+
+    def commit(self):
+        self.fd.close()
+        try:
+            size = os.path.getsize(self.tmppath)
+            os.rename(self.tmppath, self.filepath)
+        except OSError:
+            # Invalidated meanwhile
+            return
+        self.cache.added(size)
+
+    def abort(self):
+        try:
+            self.fd.close()
+        except IOError:
+            # Failed to flush what's left, it's being removed anyway
+            pass
+        try:
+            os.remove(self.tmppath)
+        except OSError:
+            pass
+
+
+class BundleCache(object):
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        # Running total of the entries' size, None until walked
+        self.size = None
+        self.scanned = 0
+        self._lock = threading.Lock()
+
+    def _repo_dir(self, repo_path):
+        return join(self.path, sha1(repo_path).hexdigest())
+
+    def _entry_path(self, repo_path, state, command, args):
+        key = sha1('\0'.join((command,) + tuple(args))).hexdigest()
+        return join(self._repo_dir(repo_path), '%s-%s.hg' % (state, key))
+
+    def open(self, repo_path, state, command, args):
+        """Return an open file of the cached entry or `None`. `state`
+        identifies the repository's changesets, say, a hash of it's heads."""
+        filepath = self._entry_path(repo_path, state, command, args)
+        try:
+            fd = open(filepath, 'rb')
+        except IOError:
+            return None
+        # Mark it as recently used
+        now = time()
+        try:
+            os.utime(filepath, (now, now))
+        except OSError:
+            pass
+        return fd
+
+    def store(self, repo_path, state, command, args):
+        """Return a `CacheWriter` for a new entry."""
+        repo_dir = self._repo_dir(repo_path)
+        if not isdir(repo_dir):
+            try:
+                os.makedirs(repo_dir, 0700)
+            except OSError:
+                # Created meanwhile by another worker
+                pass
+        return CacheWriter(self, self._entry_path(repo_path, state, command,
+                                                  args))
+
+    def invalidate(self, repo_path, state=None):
+        """Remove the repository's entries which are not for `state`."""
+        repo_dir = self._repo_dir(repo_path)
+        if not isdir(repo_dir):
+            return
+        for filename in os.listdir(repo_dir):
+            if not filename.endswith('.hg'):
+                # Entries being written
+                continue
+            if state is not None and filename.startswith(state + '-'):
+                continue
+            filepath = join(repo_dir, filename)
+            try:
+                size = os.path.getsize(filepath)
+                os.remove(filepath)
+            except OSError:
+                continue
+            self.added(-size, evict=False)
+
+    def added(self, size, evict=True):
+        """Account for `size` bytes added to the cache, negative if
+        removed, evicting entries if it's over it's maximum size."""
+        self._lock.acquire()
+        try:
+            if self.size is not None:
+                self.size = max(self.size + size, 0)
+            rescan = self.size is None or \
+                                time() - self.scanned > RESCAN_INTERVAL or \
+                                (evict and self.size > self.max_size)
+        finally:
+            self._lock.release()
+        if rescan and evict:
+            self.evict()
+
+    def evict(self):
+        """Walk the cache, removing the least recently used entries until it
+        fits on it's maximum size, and set the running total."""
+        entries = []
+        total = 0
+        if not isdir(self.path):
+            return
+        for repo_dir in os.listdir(self.path):
+            repo_dir = join(self.path, repo_dir)
+            if not isdir(repo_dir):
+                continue
+            for filename in os.listdir(repo_dir):
+                if not filename.endswith('.hg'):
+                    continue
+                filepath = join(repo_dir, filename)
+                try:
+                    info = os.stat(filepath)
+                except OSError:
+                    continue
+                entries.append((info.st_mtime, info.st_size, filepath))
+                total += info.st_size
+        if total > self.max_size:
+            entries.sort()
+            for mtime, size, filepath in entries:
+                try:
+                    os.remove(filepath)
+                except OSError:
+                    continue
+                total -= size
+                if total <= self.max_size:
+                    break
+        self._lock.acquire()
+        try:
+            self.size = total
+            self.scanned = time()
+        finally:
+            self._lock.release()
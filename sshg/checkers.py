@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 # vim: sw=4 ts=4 fenc=utf-8 et
 """
-    sshg.factories
-    ~~~~~~~~~~~~~~
+    sshg.checkers
+    ~~~~~~~~~~~~~
 
     This module is responsible the service authentication chekers.
 
@@ -10,52 +10,101 @@
     :license: BSD, see LICENSE for more details.
 """
 
+from time import time
+
 from twisted.conch.error import ValidPublicKey
-from twisted.conch.ssh import keys
 from twisted.cred.checkers import ICredentialsChecker
 from twisted.cred.credentials import IUsernamePassword, ISSHPrivateKey
 from twisted.cred.error import UnauthorizedLogin
-from twisted.internet import defer
+from twisted.internet import reactor, threads
 from twisted.python import failure, log as twlog
+from twisted.python.threadpool import ThreadPool
 
 from zope.interface import implements
 
-from sshg import database as db, logger
+from sshg import application, database as db, logger, metrics
+from sshg.keycache import parsed_keys
+from sshg.utils.crypto import (check_pwhash, gen_pwhash, key_fingerprint,
+                               pwhash_outdated)
 
 log = logger.getLogger(__name__)
 
 
+class UnknownUser(UnauthorizedLogin):
+    """The user trying to log in does not exist."""
+
+
+class AvatarId(str):
+    """The avatar id, ie, the username, along with the public key used to log
+    in, if any, on the OpenSSH format as stored on the database."""
+
+    def __new__(cls, username, key=None):
+        avatarId = str.__new__(cls, username)
+        avatarId.key = key
+        return avatarId
+
+
 class MercurialAuthenticationChekers(object):
     credentialInterfaces = ISSHPrivateKey, IUsernamePassword
     implements(ICredentialsChecker)
 
+    def __init__(self, hash_threads=2):
+        # Password hashes are checked on their own threads, so that they
+        # don't hold database connections while at it
+        self.threadpool = ThreadPool(1, hash_threads, 'sshg.passwords')
+
+    def start(self):
+        self.threadpool.start()
+
+    def stop(self):
+        self.threadpool.stop()
+
     def requestAvatarId(self, credentials):
-        d = defer.maybeDeferred(db.session)
         if hasattr(credentials, 'password'):
-            d.addCallback(self.authenticate, credentials)
+            method = 'password'
+            d = db.run_in_session(self._lookupPassword, credentials.username)
+            d.addCallback(self._cbLookupPassword, credentials)
+            d.addCallback(self._cbAuthenticate)
         else:
-            d.addCallback(self.checkKey, credentials)
+            method = 'publickey'
+            d = db.run_in_session(self.checkKey, credentials)
             d.addCallback(self._cbRequestAvatarId, credentials)
         d.addErrback(self._ebRequestAvatarId)
+        d.addBoth(self._recordAttempt, method, time())
         return d
 
+    def _recordAttempt(self, result, method, started):
+        if not isinstance(result, failure.Failure):
+            outcome = 'success'
+        elif result.check(ValidPublicKey):
+            # The client asked whether it may use a key, it didn't sign yet
+            outcome = 'key_query'
+        else:
+            outcome = 'failure'
+        metrics.auth_attempts.inc(labels=(method, outcome))
+        metrics.auth_seconds.observe(time() - started, (method,))
+        return result
+
     def _ebRequestAvatarId(self, f):
         if not f.check(UnauthorizedLogin):
             twlog.msg(f)
             return failure.Failure(UnauthorizedLogin("unable to get avatar id"))
         return f
 
-    def _cbRequestAvatarId(self, validKey, credentials):
+    def _cbRequestAvatarId(self, key, credentials):
         # Stop deprecation Warnings
-        if not validKey:
+        if not key:
             return failure.Failure(UnauthorizedLogin())
         if not credentials.signature:
             return failure.Failure(ValidPublicKey())
         else:
             try:
-                pubKey = keys.Key.fromString(data = credentials.blob)
+                pubKey = parsed_keys.get(credentials.blob)
                 if pubKey.verify(credentials.signature, credentials.sigData):
-                    return credentials.username
+                    stamps = getattr(application, 'stamps', None)
+                    if stamps is not None:
+                        stamps.key_used(key)
+                    return AvatarId(credentials.username, key)
             except: # any error should be treated as a failed login
                 f = failure.Failure()
                 twlog.err()
@@ -63,28 +112,64 @@ class MercurialAuthenticationChekers(object):
         return failure.Failure(UnauthorizedLogin())
 
     def checkKey(self, session, credentials):
-        user = session.query(db.User).get(credentials.username)
-        log.debug("User %s trying to authenticate", credentials.username)
-        if not user:
-            return False
-        for pubKey in user.keys:
-            if keys.Key.fromString(data=pubKey.key).blob() == credentials.blob:
-                # Update last used timestamp of both the key and the user
-                pubKey.update_stamp()
-                user.last_used_key = pubKey
-                session.commit()
-                return True
-        return False
-
-    def authenticate(self, session, credentials):
-        user = session.query(db.User).get(credentials.username)
+        # Runs on the database thread pool
         log.debug("User %s trying to authenticate", credentials.username)
+        pubKey = session.query(db.PublicKey).filter(db.and_(
+            db.PublicKey.fingerprint==key_fingerprint(credentials.blob),
+            db.PublicKey.user_id==credentials.username)).first()
+        if not pubKey:
+            if not session.query(db.User).get(credentials.username):
+                raise UnknownUser("invalid username")
+            return None
+        # It's last used stamp is only updated once the signature checks out
+        return pubKey.key
+
+    def _lookupPassword(self, session, username):
+        # Runs on the database thread pool
+        user = session.query(db.User).get(username)
+        log.debug("User %s trying to authenticate", username)
         if not user:
-            return defer.fail(UnauthorizedLogin("invalid username"))
-        log.debug(user.authenticate(credentials.password))
-        if user.authenticate(credentials.password):
-            session.commit()
-            session.close()
-            return defer.succeed(credentials.username)
-        return defer.fail(UnauthorizedLogin("unable to verify password"))
+            raise UnknownUser("invalid username")
+        return user.password
+
+    def _cbLookupPassword(self, pwhash, credentials):
+        d = threads.deferToThreadPool(reactor, self.threadpool,
+                                      self._checkPassword, pwhash,
+                                      credentials.password)
+        d.addCallback(self._cbCheckPassword, pwhash, credentials)
+        return d
+
+    def _checkPassword(self, pwhash, password):
+        # Runs on the password hashing thread pool. Returns the password's
+        # new hash if the current one is outdated.
+        if not check_pwhash(pwhash, password):
+            raise UnauthorizedLogin("unable to verify password")
+        if pwhash_outdated(pwhash):
+            return gen_pwhash(password)
+
+    def _cbCheckPassword(self, newhash, pwhash, credentials):
+        if newhash is not None:
+            # No need to hold the login until it's stored
+            d = db.run_in_session(self._upgradePassword, credentials.username,
+                                  pwhash, newhash)
+            d.addErrback(self._ebUpgradePassword, credentials.username)
+        return AvatarId(credentials.username)
+
+    def _upgradePassword(self, session, username, pwhash, newhash):
+        # Runs on the database thread pool. Unless the password was changed
+        # meanwhile.
+        table = db.User.__table__
+        session.execute(table.update(
+            db.and_(table.c.username==username, table.c.password==pwhash),
+            values={table.c.password: newhash}))
+
+    def _ebUpgradePassword(self, failure, username):
+        log.error("Failed to upgrade the password hash of %s: %s", username,
+                  failure.getErrorMessage())
+
+    def _cbAuthenticate(self, avatarId):
+        stamps = getattr(application, 'stamps', None)
+        if stamps is not None:
+            stamps.user_logged_in(avatarId)
+        return avatarId
 
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+"""
+    sshg.connections
+    ~~~~~~~~~~~~~~~~
+
+    This module is responsible for the ssh transport, authentication and
+    connection services.
+
+    :copyright: © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+from twisted.conch.ssh import connection, transport, userauth
+from twisted.cred.error import UnauthorizedLogin
+from twisted.internet import defer
+
+from sshg import application, metrics
+from sshg.checkers import UnknownUser
+
+
+def prefer(preferred, supported):
+    """Return `supported` with the `preferred` algorithms, those supported,
+    moved first and in the given order."""
+    return [name for name in preferred if name in supported] + \
+           [name for name in supported if name not in preferred]
+
+#: Algorithms preferred, cheapest first
+KEX_PREFERENCE = ['curve25519-sha256', 'curve25519-sha256@libssh.org',
+                  'ecdh-sha2-nistp256', 'diffie-hellman-group14-sha256']
+HOST_KEY_PREFERENCE = ['ssh-ed25519', 'ecdsa-sha2-nistp256',
+                       'rsa-sha2-256', 'rsa-sha2-512', 'ssh-rsa']
+CIPHER_PREFERENCE = ['aes128-ctr', 'aes256-ctr', 'aes192-ctr']
+MAC_PREFERENCE = ['hmac-sha2-256', 'hmac-sha1', 'hmac-sha2-512']
+
+
+class MercurialServerTransport(transport.SSHServerTransport):
+    """SSH server transport keeping track of the open connections and
+    offering the cheapest algorithms first. The host key algorithms are
+    ordered by the factory, which sets them from it's keys."""
+
+    supportedKeyExchanges = prefer(
+        KEX_PREFERENCE, transport.SSHServerTransport.supportedKeyExchanges)
+    supportedCiphers = prefer(
+        CIPHER_PREFERENCE, transport.SSHServerTransport.supportedCiphers)
+    supportedMACs = prefer(
+        MAC_PREFERENCE, transport.SSHServerTransport.supportedMACs)
+
+    def connectionMade(self):
+        metrics.ssh_connections.inc()
+        metrics.ssh_connections_total.inc()
+        transport.SSHServerTransport.connectionMade(self)
+
+    def connectionLost(self, reason):
+        metrics.ssh_connections.dec()
+        transport.SSHServerTransport.connectionLost(self, reason)
+
+
+class GuardedSSHUserAuthServer(userauth.SSHUserAuthServer):
+    """User authentication service which checks attempts against the
+    `sshg.authguard.AuthGuard` before they get to the database."""
+
+    def tryAuth(self, kind, user, data):
+        guard = getattr(application, 'authguard', None)
+        if guard is None or kind == 'none':
+            return userauth.SSHUserAuthServer.tryAuth(self, kind, user, data)
+        address = self.transport.transport.getPeer().host
+        reason = guard.check(address, user)
+        if reason is not None:
+            return defer.fail(UnauthorizedLogin(reason))
+        d = userauth.SSHUserAuthServer.tryAuth(self, kind, user, data)
+        if d:
+            # Key queries, ie, public keys without a signature, which fail
+            # are just the client going through it's keys
+            counts = kind != 'publickey' or bool(ord(data[0]))
+            d.addCallbacks(self._cbGuardedAuth, self._ebGuardedAuth,
+                           callbackArgs=(guard, address, user),
+                           errbackArgs=(guard, address, user, counts))
+        return d
+
+    def _cbGuardedAuth(self, result, guard, address, user):
+        guard.succeeded(address, user)
+        return result
+
+    def _ebGuardedAuth(self, failure, guard, address, user, counts):
+        if failure.check(UnknownUser):
+            guard.failed(address, user, unknown=True)
+        elif counts and failure.check(UnauthorizedLogin):
+            guard.failed(address, user)
+        return failure
+
+
+class FlowControlledSSHConnection(connection.SSHConnection):
+    """SSH connection which lets channels hold back their window.
+
+    Twisted re-opens a channel's window as soon as half of it is used, no
+    matter if the channel can do anything with more data. Channels with an
+    ``inputPaused`` attribute set to a true value don't get their window
+    adjusted; they do it themselves once they're ready for more data.
+    """
+
+    def adjustWindow(self, channel, bytesToAdd):
+        if getattr(channel, 'inputPaused', False):
+            return
+        connection.SSHConnection.adjustWindow(self, channel, bytesToAdd)
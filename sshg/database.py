@@ -5,7 +5,11 @@
     ~~~~~~~~~~~~~
 
     This module is a layer on top of SQLAlchemy to provide asynchronous
-    access to the database and has the used tables/models used in SSHg
+    access to the database and has the used tables/models used in SSHg.
+
+    Code running on the reactor must not query the database directly, since
+    a slow query or commit would stall every connection; it should use
+    :func:`run_in_session` instead.
 
     :copyright: © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
     :license: BSD, see LICENSE for more details.
@@ -15,20 +19,29 @@ import os
 import sys
 from os import path
 from datetime import datetime
+from time import time
 from types import ModuleType
 from uuid import uuid4
 
 import sqlalchemy
-from sqlalchemy import and_, or_
+from sqlalchemy import and_, or_, select, exists, bindparam
 from sqlalchemy import orm
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.engine.url import make_url, URL
+try:
+    from sqlalchemy.interfaces import ConnectionProxy
+except ImportError:
+    ConnectionProxy = None
 
-from sshg import logger, exceptions, config
-from sshg.utils.crypto import gen_pwhash, check_pwhash
+from sshg import logger, exceptions, config, metrics
+from sshg.utils import directory_size
+from sshg.utils.crypto import (gen_pwhash, check_pwhash, key_fingerprint,
+                               pwhash_outdated)
 
 from twisted.conch.ssh.keys import Key
+from twisted.internet import reactor, threads
 from twisted.python import log as twlog
+from twisted.python.threadpool import ThreadPool
 
 log = logger.getLogger(__name__)
 
@@ -67,11 +80,66 @@ def create_engine():
         value = os.environ.get('SSHG_DATABASE_' + key.upper())
         if value is not None:
             options[key] = int(value)
+    if ConnectionProxy is not None:
+        options['proxy'] = CountingProxy()
     return sqlalchemy.create_engine(info, **options)
 
+if ConnectionProxy is not None:
+    class CountingProxy(ConnectionProxy):
+        """Counts the statements executed, see `sshg.metrics`."""
+
+        def cursor_execute(self, execute, cursor, statement, parameters,
+                           context, executemany):
+            metrics.db_queries.inc()
+            return execute(cursor, statement, parameters, context)
+
 def session():
     return orm.create_session(get_engine(), autoflush=True, autocommit=False)
 
+#: Thread pool where the database work of the SSH server runs
+_threadpool = None
+
+def start_pool(min_threads=1, max_threads=4):
+    """Start the thread pool used by :func:`run_in_session`. It is stopped
+    when the reactor shuts down."""
+    global _threadpool
+    if _threadpool is None:
+        _threadpool = ThreadPool(min_threads, max_threads, 'sshg.database')
+        _threadpool.start()
+        reactor.addSystemEventTrigger('after', 'shutdown', stop_pool)
+    return _threadpool
+
+def stop_pool():
+    global _threadpool
+    if _threadpool is not None:
+        _threadpool.stop()
+        _threadpool = None
+
+def _run_in_session(func, *args, **kwargs):
+    current_session = session()
+    try:
+        result = func(current_session, *args, **kwargs)
+        started = time()
+        current_session.commit()
+        metrics.db_commit_seconds.observe(time() - started)
+        return result
+    except:
+        current_session.rollback()
+        raise
+    finally:
+        current_session.close()
+
+def run_in_session(func, *args, **kwargs):
+    """Run ``func(session, *args, **kwargs)`` on the database thread pool and
+    return a deferred which fires with it's result.
+
+    The session is committed when `func` returns and rolled back if it
+    raises. Since it's closed afterwards, `func` should return plain data,
+    not objects still bound to the session.
+    """
+    return threads.deferToThreadPool(reactor, start_pool(), _run_in_session,
+                                     func, *args, **kwargs)
+
 def require_session(f):
     def wrapper(*args, **kwargs):
         current_session = session()
@@ -95,6 +163,9 @@ for mod in sqlalchemy, orm:
 del key, mod, value
 db.and_ = and_
 db.or_ = or_
+db.select = select
+db.exists = exists
+db.bindparam = bindparam
 #del and_, or_
 
 
@@ -150,6 +221,10 @@ class Repository(DeclarativeBase):
     traffic  = db.relation("RepositoryTraffic",
                            backref=orm.backref("repo", lazy='dynamic'),
                            cascade="all, delete, delete-orphan")
+    hourly_traffic = db.relation("RepositoryTrafficHourly", lazy='dynamic',
+                                 cascade="all, delete, delete-orphan")
+    daily_traffic  = db.relation("RepositoryTrafficDaily", lazy='dynamic',
+                                 cascade="all, delete, delete-orphan")
     rules    = db.relation("AclRule", backref="repo", lazy='dynamic',
                            cascade="all, delete, delete-orphan")
     added_by = db.relation("User", backref="added_repos", uselist=False,
@@ -170,12 +245,7 @@ class Repository(DeclarativeBase):
         self.size = self.calculate_size()
 
     def calculate_size(self):
-        dir_size = 0
-        for (dirname, _, files) in os.walk(self.path):
-            for filename in files:
-                filepath = path.join(dirname, filename)
-                dir_size += path.getsize(filepath)
-        self.size = dir_size
+        self.size = directory_size(self.path)
         return self.size
 
     @property
@@ -193,12 +263,60 @@ class RepositoryTraffic(DeclarativeBase):
     """Repository Traffic"""
 
     __tablename__ = 'repository_traffic'
-    stamp    = db.Column(db.DateTime, default=datetime.utcnow, primary_key=True)
+    id       = db.Column(db.Integer, primary_key=True)
+    stamp    = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    incoming = db.Column(db.Integer, default=0)
+    outgoing = db.Column(db.Integer, default=0)
+    repo_id  = db.Column(db.ForeignKey('repositories.name'))
+    user_id  = db.Column(db.ForeignKey('repousers.username',
+                                       ondelete='SET NULL'))
+    # Whether it's accounted on the hourly and daily traffic tables
+    rolled_up = db.Column(db.Boolean, default=False, index=True)
+
+    def __init__(self, incoming=0, outgoing=0, user_id=None):
+        self.incoming = incoming
+        self.outgoing = outgoing
+        self.user_id = user_id
+
+
+class RepositoryTrafficHourly(DeclarativeBase):
+    """Repository Traffic per hour and user"""
+
+    __tablename__ = 'repository_traffic_hourly'
+    __table_args__ = (db.UniqueConstraint('period', 'repo_id', 'user_id'), {})
+    id       = db.Column(db.Integer, primary_key=True)
+    period   = db.Column(db.DateTime, index=True)
+    incoming = db.Column(db.Integer, default=0)
+    outgoing = db.Column(db.Integer, default=0)
+    repo_id  = db.Column(db.ForeignKey('repositories.name'))
+    user_id  = db.Column(db.ForeignKey('repousers.username',
+                                       ondelete='SET NULL'))
+
+    def __init__(self, period, repo_id, user_id, incoming=0, outgoing=0):
+        self.period = period
+        self.repo_id = repo_id
+        self.user_id = user_id
+        self.incoming = incoming
+        self.outgoing = outgoing
+
+
+class RepositoryTrafficDaily(DeclarativeBase):
+    """Repository Traffic per day and user"""
+
+    __tablename__ = 'repository_traffic_daily'
+    __table_args__ = (db.UniqueConstraint('period', 'repo_id', 'user_id'), {})
+    id       = db.Column(db.Integer, primary_key=True)
+    period   = db.Column(db.DateTime, index=True)
     incoming = db.Column(db.Integer, default=0)
     outgoing = db.Column(db.Integer, default=0)
     repo_id  = db.Column(db.ForeignKey('repositories.name'))
+    user_id  = db.Column(db.ForeignKey('repousers.username',
+                                       ondelete='SET NULL'))
 
-    def __init__(self, incoming=0, outgoing=0):
+    def __init__(self, period, repo_id, user_id, incoming=0, outgoing=0):
+        self.period = period
+        self.repo_id = repo_id
+        self.user_id = user_id
         self.incoming = incoming
         self.outgoing = outgoing
 
@@ -209,6 +327,7 @@ class PublicKey(DeclarativeBase):
     __tablename__ = 'pubkeys'
 
     key         = db.Column(db.String, primary_key=True)
+    fingerprint = db.Column(db.String(64), index=True)
     added_on    = db.Column(db.DateTime, default=datetime.utcnow)
     used_on     = db.Column(db.DateTime, default=datetime.utcnow)
     user_id     = db.Column(db.ForeignKey('repousers.username'))
@@ -217,9 +336,11 @@ class PublicKey(DeclarativeBase):
     owner = None
 
     def __init__(self, key_contents):
-        self.key = Key.fromString(key_contents).toString("OPENSSH")
+        key = Key.fromString(key_contents)
+        self.key = key.toString("OPENSSH")
         if not self.key:
             raise Exception("Invalid Key")
+        self.fingerprint = key_fingerprint(key.blob())
 
     def update_stamp(self):
         self.used_on = datetime.utcnow()
@@ -249,7 +370,6 @@ class User(DeclarativeBase):
                                        remote_side="User.username"))
     keys             = db.relation("PublicKey", backref="owner",
                                    cascade="all, delete, delete-orphan")
-    last_used_key    = db.relation("PublicKey", uselist=False)
     rules            = db.relation("AclRule", backref="user", lazy='dynamic',
                                    cascade="all, delete, delete-orphan")
     session          = db.relation("Session", lazy=True, uselist=False,
@@ -274,6 +394,8 @@ class User(DeclarativeBase):
         valid = check_pwhash(self.password, password)
         if valid:
             self.last_login = datetime.utcnow()
+            if pwhash_outdated(self.password):
+                self.password = gen_pwhash(password)
         return valid
 
     def change_password(self, password):
@@ -10,26 +10,57 @@
     :license: BSD, see LICENSE for more details.
 """
 
+from os.path import isfile
+
 from twisted.conch.ssh import factory, keys
 from sshg import config, logger
+from sshg.connections import (FlowControlledSSHConnection,
+                              GuardedSSHUserAuthServer,
+                              MercurialServerTransport, HOST_KEY_PREFERENCE,
+                              prefer)
 
 log = logger.getLogger(__name__)
 
+def key_type(key):
+    """Return the SSH public key algorithm name of `key`."""
+    if hasattr(key, 'sshType'):
+        return key.sshType()
+    # Older Twisted only knows about RSA and DSA keys
+    return {'RSA': 'ssh-rsa', 'DSA': 'ssh-dss'}[key.type()]
+
 class MercurialReposFactory(factory.SSHFactory):
+    protocol = MercurialServerTransport
+    services = {
+        'ssh-userauth': GuardedSSHUserAuthServer,
+        'ssh-connection': FlowControlledSSHConnection
+    }
 
     def __init__(self, realm, portal):
         realm.factory = portal.factory = self
         self.realm = realm
         self.portal = portal
 
-        self._privateKey = keys.Key.fromString(open(config.private_key).read())
-        self._publicKey = self._privateKey.public()
+        self._privateKeys = {}
+        for path in [config.private_key] + sorted(config.host_keys.values()):
+            if not isfile(path):
+                log.warning("Host key %s does not exist, not offering it", path)
+                continue
+            key = keys.Key.fromString(open(path).read())
+            self._privateKeys[key_type(key)] = key
+        self._publicKeys = dict((name, key.public()) for name, key
+                                in self._privateKeys.iteritems())
+
+    def buildProtocol(self, addr):
+        transport = factory.SSHFactory.buildProtocol(self, addr)
+        transport.supportedPublicKeys = prefer(
+            HOST_KEY_PREFERENCE, list(transport.supportedPublicKeys))
+        return transport
 
     def getPublicKeys(self):
-        return {'ssh-rsa': self._publicKey}
+        return self._publicKeys
 
     def getPrivateKeys(self):
-        return {'ssh-rsa': self._privateKey}
+        return self._privateKeys
 
     def __repr__(self):
         return '<Mercurial Repositories Factory from %s>' % self.__class__
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+"""
+    sshg.hgworker
+    ~~~~~~~~~~~~~
+
+    Long lived process serving mercurial repositories over the ssh wire
+    protocol, using mercurial's own ``sshserver``.
+
+    Repositories are kept open across requests, so their revlog indexes,
+    branch and tags caches are only read once, as long as the repository
+    does not change.
+
+    The worker accepts one connection at a time on an unix socket. The
+    client first sends a JSON encoded header line with the repository path
+    and the environment to set for the request (which the ACL hook uses),
+    followed by the raw ssh wire protocol stream. Everything the worker
+    sends back is framed as a channel letter plus a 4 bytes big endian
+    length followed by the data: ``o`` for output, ``e`` for error output
+    and ``r`` for the request's exit code, which is always the last frame.
+
+    When given a bundle cache directory, changegroups are served from and
+    stored on a :class:`~sshg.bundlecache.BundleCache`.
+
+    Usage::
+
+        python -m sshg.hgworker <socket path> [<cache dir> <cache max bytes>]
+
+    :copyright: © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import os
+import socket
+import struct
+import sys
+import traceback
+from hashlib import sha1
+from os.path import exists, join
+
+import simplejson
+from mercurial import hg, sshserver, ui as uimod
+from mercurial.node import bin, hex
+
+from sshg.bundlecache import BundleCache
+from sshg.utils import changelog_stamp
+
+
+class ChannelledOutput(object):
+    """File like object writing framed data to a channel of the socket."""
+
+    def __init__(self, sock, channel):
+        self.sock = sock
+        self.channel = channel
+
+    def write(self, data):
+        if data:
+            self.sock.sendall(struct.pack('>cI', self.channel, len(data)) +
+                              data)
+
+    def writelines(self, lines):
+        self.write(''.join(lines))
+
+    def flush(self):
+        pass
+
+
+class CachingSSHServer(sshserver.sshserver):
+    """Mercurial's sshserver serving changegroups through the bundle cache.
+
+    Note that on cache hits the ``preoutgoing`` and ``outgoing`` hooks don't
+    run since no changegroup is generated."""
+    cache = None
+    repo_path = None
+
+    def do_changegroup(self):
+        roots = self.getarg()[1]
+        self.serve_changegroup('changegroup', (roots,),
+                               lambda: self.repo.changegroup(
+                                   map(bin, roots.split(' ')), 'serve'))
+
+    def do_changegroupsubset(self):
+        argmap = dict([self.getarg(), self.getarg()])
+        bases = [bin(n) for n in argmap['bases'].split(' ')]
+        heads = [bin(n) for n in argmap['heads'].split(' ')]
+        self.serve_changegroup('changegroupsubset',
+                               (argmap['bases'], argmap['heads']),
+                               lambda: self.repo.changegroupsubset(
+                                   bases, heads, 'serve'))
+
+    def serve_changegroup(self, command, args, generate):
+        changelog = self.repo.changelog
+        # A strip or rollback can leave the tip as it was, not the heads
+        state = sha1('%d %s' % (len(changelog), ' '.join(
+                        sorted(map(hex, changelog.heads()))))).hexdigest()
+        cached = self.cache.open(self.repo_path, state, command, args)
+        if cached is not None:
+            try:
+                while True:
+                    data = cached.read(65536)
+                    if not data:
+                        break
+                    self.fout.write(data)
+            finally:
+                cached.close()
+            self.fout.flush()
+            return
+
+        # The cache failing, say with a full disk, must not fail the request
+        try:
+            writer = self.cache.store(self.repo_path, state, command, args)
+        except (IOError, OSError), err:
+            self.cache_failed(err)
+            writer = None
+        try:
+            cg = generate()
+            while True:
+                data = cg.read(4096)
+                if not data:
+                    break
+                self.fout.write(data)
+                if writer is not None:
+                    try:
+                        writer.write(data)
+                    except (IOError, OSError), err:
+                        self.cache_failed(err)
+                        writer.abort()
+                        writer = None
+        except:
+            if writer is not None:
+                writer.abort()
+            raise
+        if writer is not None:
+            try:
+                writer.commit()
+            except (IOError, OSError), err:
+                self.cache_failed(err)
+                writer.abort()
+        self.fout.flush()
+
+    def cache_failed(self, err):
+        sys.__stderr__.write("Not caching the changegroup of %s: %s\n" %
+                             (self.repo_path, err))
+
+
+class Worker(object):
+
+    def __init__(self, socket_path, cache=None):
+        self.socket_path = socket_path
+        self.cache = cache
+        self.repositories = {}
+
+    def repository_stamp(self, path):
+        hgrc = join(path, '.hg', 'hgrc')
+        return (changelog_stamp(path),
+                exists(hgrc) and os.stat(hgrc).st_mtime or None)
+
+    def repository(self, path):
+        """Return the open repository at `path`, re-opening it if it changed
+        since it was opened."""
+        stamp = self.repository_stamp(path)
+        cached = self.repositories.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        repo = hg.repository(uimod.ui(), path)
+        self.repositories[path] = (stamp, repo)
+        return repo
+
+    def serve_forever(self):
+        if exists(self.socket_path):
+            os.unlink(self.socket_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        listener.listen(1)
+        # Tell our parent we're ready
+        sys.__stdout__.write('ready\n')
+        sys.__stdout__.flush()
+        while True:
+            conn = listener.accept()[0]
+            try:
+                exit_code = self.handle(conn)
+                conn.sendall(struct.pack('>cII', 'r', 4, exit_code))
+            except Exception:
+                traceback.print_exc(file=sys.__stderr__)
+            conn.close()
+
+    def handle(self, conn):
+        fin = conn.makefile('rb')
+        header = simplejson.loads(fin.readline())
+        fout = ChannelledOutput(conn, 'o')
+        ferr = ChannelledOutput(conn, 'e')
+        environ = dict((str(key), str(value)) for key, value in
+                       header.get('env', {}).iteritems())
+        previous_environ = os.environ.copy()
+        os.environ.update(environ)
+        try:
+            try:
+                repo = self.repository(header['path'])
+            except Exception, err:
+                ferr.write("SSHg -> %s\n" % err)
+                return 255
+            if self.cache is not None:
+                server = CachingSSHServer(repo.ui, repo)
+                server.cache = self.cache
+                server.repo_path = header['path']
+            else:
+                server = sshserver.sshserver(repo.ui, repo)
+            # sshserver reads and writes to the process' standard streams;
+            # point it to the socket instead
+            server.fin = fin
+            server.fout = fout
+            sys.stdout = sys.stderr = ferr
+            for attr, stream in (('fout', ferr), ('ferr', ferr)):
+                # Newer mercurial versions write through the ui's streams
+                if hasattr(repo.ui, attr):
+                    setattr(repo.ui, attr, stream)
+            try:
+                while server.serve_one():
+                    pass
+            finally:
+                if getattr(server, 'lock', None):
+                    server.lock.release()
+                    server.lock = None
+            return 0
+        except Exception, err:
+            ferr.write("SSHg -> %s\n" % err)
+            traceback.print_exc(file=sys.__stderr__)
+            return 255
+        finally:
+            sys.stdout = sys.__stdout__
+            sys.stderr = sys.__stderr__
+            os.environ.clear()
+            os.environ.update(previous_environ)
+
+
+def main():
+    if len(sys.argv) not in (2, 4):
+        print >> sys.stderr, ("Usage: %s <socket path> "
+                              "[<cache dir> <cache max bytes>]" % sys.argv[0])
+        sys.exit(1)
+    cache = None
+    if len(sys.argv) == 4:
+        cache = BundleCache(sys.argv[2], int(sys.argv[3]))
+    Worker(sys.argv[1], cache).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -19,6 +19,30 @@ def buildmatch(ui, repo, username, pats):
     return util.never
 
 
+def load_rules():
+    '''return tuple of (allow, deny, sources, username).
+
+    Processes spawned for a single session get the rules on their environment.
+    Pre-started workers get the path of a file which is filled with the rules
+    once the worker is handed to a session.'''
+    acl_file = environ.get('SSHg.ACL_FILE', None)
+    if acl_file:
+        try:
+            rules = simplejson.load(open(acl_file))
+        except (IOError, ValueError):
+            return None, None, None, None
+        return (rules.get('allow'), rules.get('deny'), rules.get('sources'),
+                rules.get('username'))
+
+    def loads(key):
+        value = environ.get(key, None)
+        if value is None:
+            return None
+        return simplejson.loads(value)
+    return (loads('SSHg.ALLOW'), loads('SSHg.DENY'), loads('SSHg.SOURCES'),
+            environ.get('SSHg.USERNAME', None))
+
+
 def hook(ui, repo, hooktype, node=None, source=None, **kwargs):
     if hooktype != 'pretxnchangegroup':
         raise util.Abort(_('config error - hook type "%s" cannot stop '
@@ -31,23 +55,21 @@ def hook(ui, repo, hooktype, node=None, source=None, **kwargs):
 #    print source
 
     # Who's pushing
-    allow_rules = environ.get('SSHg.ALLOW', None)
-    deny_rules = environ.get('SSHg.DENY', None)
-    username = environ.get('SSHg.USERNAME', None)
-    source_rules = environ.get('SSHg.SOURCES', None)
-    if not allow_rules or not deny_rules or not source_rules or not username:
+    allow_rules, deny_rules, source_rules, username = load_rules()
+    if allow_rules is None or deny_rules is None or source_rules is None \
+                                                            or not username:
         raise util.Abort("Something's wrong with your setup. At least one of "
                          "the necessary environment keys is not present.")
 
     # How should I handle source too?
-    if source not in simplejson.loads(source_rules):
+    if source not in source_rules:
         ui.debug(_('acl: changes have source "%s" - skipping\n') % source)
         return
 
 
     # Get Allow/Deny Rules
-    allow = buildmatch(ui, repo, username, simplejson.loads(allow_rules))
-    deny = buildmatch(ui, repo, username, simplejson.loads(deny_rules))
+    allow = buildmatch(ui, repo, username, allow_rules)
+    deny = buildmatch(ui, repo, username, deny_rules)
 
 #    raise util.Abort("I just need to stop this")
 
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+"""
+    sshg.keycache
+    ~~~~~~~~~~~~~
+
+    This module implements a bounded cache of parsed public keys, keyed by
+    their blob, so that clients reconnecting with the same keys don't have
+    them parsed over and over just to check their signatures.
+
+    Signatures themselves can't be cached since what's signed includes the
+    connection's session identifier.
+
+    :copyright: © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import threading
+
+from twisted.conch.ssh import keys
+
+from sshg.utils.crypto import openssh_key_blob
+
+
+# Fields of the entries' links
+PREV, NEXT, BLOB, KEY = 0, 1, 2, 3
+
+class KeyCache(object):
+    """Least recently used parsed keys, at most `max_size` of them.
+
+    Entries are kept on a dictionary and, from least to most recently used,
+    on a circular doubly linked list of ``[prev, next, blob, key]`` links.
+
+    Keys are deleted through the web interface, which runs on a thread pool,
+    so all access is locked.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = self.misses = 0
+        self._entries = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+        self._lock = threading.Lock()
+
+    def _unlink(self, link):
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+
+    def _append(self, link):
+        last = self._root[PREV]
+        link[PREV], link[NEXT] = last, self._root
+        last[NEXT] = self._root[PREV] = link
+
+    def get(self, blob):
+        """Return the parsed key of `blob`."""
+        self._lock.acquire()
+        try:
+            link = self._entries.get(blob)
+            if link is not None:
+                self.hits += 1
+                self._unlink(link)
+                self._append(link)
+                return link[KEY]
+            self.misses += 1
+        finally:
+            self._lock.release()
+
+        key = keys.Key.fromString(data=blob)
+        self._lock.acquire()
+        try:
+            if blob not in self._entries:
+                link = [None, None, blob, key]
+                self._entries[blob] = link
+                self._append(link)
+                while len(self._entries) > self.max_size:
+                    oldest = self._root[NEXT]
+                    self._unlink(oldest)
+                    del self._entries[oldest[BLOB]]
+        finally:
+            self._lock.release()
+        return key
+
+    def invalidate(self, key=None):
+        """Drop `key`, on the OpenSSH format as stored on the database, or all
+        of them if not passed."""
+        self._lock.acquire()
+        try:
+            if key is None:
+                self._entries.clear()
+                self._root[:] = [self._root, self._root, None, None]
+            else:
+                link = self._entries.pop(openssh_key_blob(key), None)
+                if link is not None:
+                    self._unlink(link)
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+#: The parsed keys cache used throughout SSHg
+parsed_keys = KeyCache()
@@ -6,48 +6,218 @@
 # License: BSD - Please view the LICENSE file for additional information.
 # ==============================================================================
 
+import atexit
 import logging
+import os
+import sys
+import threading
+from Queue import Queue, Full
 from twisted.python.log import PythonLoggingObserver
-from twisted.internet import defer
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s [%(name)s] %(levelname)-5.5s: %(message)s'
-)
+FORMAT = '%(asctime)s [%(name)s] %(levelname)-5.5s: %(message)s'
+
+LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'critical': logging.CRITICAL,
+}
+
+def parse_level(name):
+    try:
+        return LEVELS[name.strip().lower()]
+    except KeyError:
+        raise ValueError('unknown log level %r' % name)
+
+
+class QueueWriter(object):
+    """Writes log records to `handlers` from a thread of it's own, so that
+    whoever logs never waits on the disk or the terminal.
+
+    The thread is started by the first record, and again in a forked child,
+    since threads don't survive forking and twistd forks after reading the
+    configuration. If records come in faster than they're written, once
+    `max_size` are queued further ones are dropped and counted.
+    """
+
+    _stop = object()
+
+    def __init__(self, handlers, max_size=10000, name='sshg.logging'):
+        self.handlers = handlers
+        self.name = name
+        self.queue = Queue(max_size)
+        self.dropped = 0
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def put(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def _start(self):
+        self._lock.acquire()
+        try:
+            if self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name=self.name)
+            self._thread.setDaemon(True)
+            self._thread.start()
+            self._pid = os.getpid()
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is self._stop:
+                break
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                logging.getLogger(__name__).warning(
+                    'Dropped %d records, written too slowly', dropped)
+            self._write(record)
+        for handler in self.handlers:
+            handler.flush()
+
+    def _write(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def stop(self, timeout=5):
+        """Write what's queued and stop the thread."""
+        if self._pid != os.getpid() or not self._thread.isAlive():
+            return
+        self.queue.put(self._stop)
+        self._thread.join(timeout)
+        self._pid = None
+
+
+class QueueHandler(logging.Handler):
+    """Hands records to a `QueueWriter`.
+
+    Messages are merged with their arguments, and tracebacks rendered, right
+    away, since what they refer to might change or be gone by the time the
+    record is written; everything else is left to the writer's thread.
+    """
+
+    def __init__(self, writer):
+        logging.Handler.__init__(self)
+        self.writer = writer
+
+    def emit(self, record):
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(
+                                                            record.exc_info)
+                record.exc_info = None
+            self.writer.put(record)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
 
 class PythonLogObserver(PythonLoggingObserver):
+    """Passes Twisted's log events on to the logging module, skipping the
+    events of disabled levels before formatting them."""
 
     def __init__(self, logger_name='sshg'):
-        self.logger = logging.getLogger("sshg")
+        self.logger = logging.getLogger(logger_name)
 
-    def emit(self, event_dict):
-        def emit():
-            PythonLoggingObserver.emit(self, event_dict)
-        return defer.maybeDeferred(emit)
+    def emit(self, eventDict):
+        if 'logLevel' in eventDict:
+            level = eventDict['logLevel']
+        elif eventDict['isError']:
+            level = logging.ERROR
+        else:
+            level = logging.INFO
+        if self.logger.isEnabledFor(level):
+            PythonLoggingObserver.emit(self, eventDict)
+
+
+def _noop(*args, **kwargs):
+    pass
 
 
 class Logging(object):
+    """The loggers used throughout SSHg.
+
+    The methods of the levels which are disabled are replaced by a function
+    doing nothing, so a disabled call costs no more than that; it's done
+    again whenever `setup` changes the levels.
+    """
+
     def __init__(self, logger_name='sshg'):
         self.logger = logging.getLogger(logger_name)
+        self.update()
+
+    def update(self):
+        enabled = self.logger.isEnabledFor
+        for name, level in (('debug', logging.DEBUG), ('info', logging.INFO),
+                            ('warning', logging.WARNING),
+                            ('error', logging.ERROR),
+                            ('critical', logging.CRITICAL),
+                            ('exception', logging.ERROR)):
+            if enabled(level):
+                setattr(self, name, getattr(self.logger, name))
+            else:
+                setattr(self, name, _noop)
 
-    def debug(self, msg, *args, **kwargs):
-        defer.maybeDeferred(self.logger.debug, msg, *args, **kwargs)
+    def isEnabledFor(self, level):
+        return self.logger.isEnabledFor(level)
 
-    def info(self, msg, *args, **kwargs):
-        defer.maybeDeferred(self.logger.info, msg, *args, **kwargs)
 
-    def warning(self, msg, *args, **kwargs):
-        defer.maybeDeferred(self.logger.warning, msg, *args, **kwargs)
+_loggers = {}
 
-    def error(self, msg, *args, **kwargs):
-        defer.maybeDeferred(self.logger.error, msg, *args, **kwargs)
+def getLogger(logger_name):
+    logger = _loggers.get(logger_name)
+    if logger is None:
+        logger = _loggers[logger_name] = Logging(logger_name)
+    return logger
 
-    def critical(self, msg, *args, **kwargs):
-        defer.maybeDeferred(self.logger.critical, msg, *args, **kwargs)
 
-    def exception(self, msg, *args, **kwargs):
-        defer.maybeDeferred(self.logger.exception, msg, *args, **kwargs)
+_writer = None
 
+def setup(level=logging.INFO, modules=(), filename=None):
+    """Log records of `level` and above, or of the levels given to some
+    modules, by name, on `modules`, to `filename` or, if not passed, to
+    standard error."""
+    global _writer
+    root = logging.getLogger()
+    if _writer is not None:
+        # Set up again, replace the previous handler
+        for handler in root.handlers[:]:
+            if isinstance(handler, QueueHandler):
+                root.removeHandler(handler)
+        _writer.stop()
 
-def getLogger(logger_name):
-    return Logging(logger_name)
+    if filename:
+        handler = logging.FileHandler(filename)
+    else:
+        handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    _writer = QueueWriter([handler])
+    root.addHandler(QueueHandler(_writer))
+    root.setLevel(level)
+    for name, module_level in modules:
+        logging.getLogger(name).setLevel(module_level)
+
+    for logger in _loggers.itervalues():
+        logger.update()
+
+def shutdown():
+    """Write whatever log records are still queued."""
+    if _writer is not None:
+        _writer.stop()
+
+atexit.register(shutdown)
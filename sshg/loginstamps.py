@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+"""
+    sshg.loginstamps
+    ~~~~~~~~~~~~~~~~
+
+    This module records when public keys were last used and when users last
+    logged in with a password.
+
+    Logins only update the stamps in memory, the latest per key and user;
+    they're written to the database in bulk, periodically, so that
+    authenticating never waits on a database write. Whatever is pending
+    gets written before the server shuts down. Stamps which fail to be
+    written are retried on the next flushes, and dropped after
+    `max_retries` of them failed in a row.
+
+    :copyright: © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+from datetime import datetime
+
+from twisted.internet import defer, task
+
+from sshg import logger, database as db
+
+log = logger.getLogger(__name__)
+
+
+class LoginStamps(object):
+
+    def __init__(self, flush_interval=30, max_retries=5):
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.keys = {}
+        self.users = {}
+        # Flushes failed in a row
+        self.failures = 0
+        self._flush_task = task.LoopingCall(self.flush)
+
+    def start(self):
+        self._flush_task.start(self.flush_interval, now=False)
+
+    def stop(self):
+        if self._flush_task.running:
+            self._flush_task.stop()
+        return self.flush()
+
+    def key_used(self, key):
+        """Record that `key`, on the OpenSSH format as stored on the database,
+        was used to log in."""
+        self.keys[key] = datetime.utcnow()
+
+    def user_logged_in(self, username):
+        """Record that `username` logged in with it's password."""
+        self.users[username] = datetime.utcnow()
+
+    def flush(self):
+        """Write the pending stamps to the database. Returns a deferred which
+        fires once they're written."""
+        if not self.keys and not self.users:
+            return defer.succeed(None)
+        keys, self.keys = self.keys, {}
+        users, self.users = self.users, {}
+        d = db.run_in_session(self._update, keys, users)
+        d.addCallbacks(self._cbFlush, self._ebFlush,
+                       errbackArgs=(keys, users))
+        return d
+
+    def _update(self, session, keys, users):
+        # Runs on the database thread pool
+        if keys:
+            table = db.PublicKey.__table__
+            session.execute(table.update(
+                table.c.key==db.bindparam('_key'),
+                values={table.c.used_on: db.bindparam('_stamp')}
+            ), [{'_key': key, '_stamp': stamp}
+                for key, stamp in keys.iteritems()])
+        if users:
+            table = db.User.__table__
+            session.execute(table.update(
+                table.c.username==db.bindparam('_username'),
+                values={table.c.last_login: db.bindparam('_stamp')}
+            ), [{'_username': username, '_stamp': stamp}
+                for username, stamp in users.iteritems()])
+
+    def _cbFlush(self, result):
+        self.failures = 0
+
+    def _ebFlush(self, failure, keys, users):
+        self.failures += 1
+        if self.failures >= self.max_retries:
+            log.error("Failed to write %d login stamps %d times, dropping "
+                      "them: %s", len(keys) + len(users), self.failures,
+                      failure.getErrorMessage())
+            self.failures = 0
+            return
+        log.error("Failed to write %d login stamps, will retry: %s",
+                  len(keys) + len(users), failure.getErrorMessage())
+        # Put them back unless newer ones were recorded meanwhile
+        for pending, failed in (self.keys, keys), (self.users, users):
+            for name, stamp in failed.iteritems():
+                pending.setdefault(name, stamp)
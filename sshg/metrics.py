@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+"""
+    sshg.metrics
+    ~~~~~~~~~~~~
+
+    This module keeps the server's counters and renders them on the
+    Prometheus text format, served by the web interface at ``/metrics``.
+
+    Recording a value is a dictionary update under a lock, cheap enough for
+    the places it's done from: once per connection, authentication attempt,
+    process, session or database statement, never per packet. Values which
+    are only interesting when scraped, like thread pool queues, are read
+    when rendering.
+
+    :copyright: © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+from bisect import bisect_left
+from threading import Lock
+from time import time
+
+from twisted.internet import task
+
+from sshg import application, logger
+from sshg.keycache import parsed_keys
+
+log = logger.getLogger(__name__)
+
+#: Default histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, unicode(value).replace('\\', r'\\')
+                                         .replace('"', r'\"')
+                                         .replace('\n', r'\n'))
+        for name, value in pairs)
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Metric(object):
+    """Base of the metrics. Counters and gauges given a `func` call it when
+    rendered instead of being updated; it returns the value or, for labelled
+    metrics, a dictionary of values keyed by label values."""
+    type = None
+
+    def __init__(self, name, help, labels=(), func=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.func = func
+        # Unlabelled metrics are always rendered, even before being updated
+        self.values = labels and {} or {(): 0}
+        self._lock = Lock()
+
+    def samples(self):
+        """Return ``(name, labels, value)`` tuples to render."""
+        if self.func is not None:
+            values = self.func()
+            if not isinstance(values, dict):
+                values = {(): values}
+            self.values = values
+        return [(self.name, _format_labels(self.labels, labels), value)
+                for labels, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for name, labels, value in self.samples():
+            lines.append('%s%s %s' % (name, labels, _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        self._lock.acquire()
+        try:
+            self.values[labels] = self.values.get(labels, 0) + amount
+        finally:
+            self._lock.release()
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, amount=1, labels=()):
+        self._lock.acquire()
+        try:
+            self.values[labels] = self.values.get(labels, 0) + amount
+        finally:
+            self._lock.release()
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+    def set(self, value, labels=()):
+        self._lock.acquire()
+        try:
+            self.values[labels] = value
+        finally:
+            self._lock.release()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.values = {}
+        self.buckets = buckets
+
+    def observe(self, value, labels=()):
+        index = bisect_left(self.buckets, value)
+        self._lock.acquire()
+        try:
+            entry = self.values.get(labels)
+            if entry is None:
+                # Per bucket counts, the +Inf bucket, and the sum
+                entry = self.values[labels] = [0] * (len(self.buckets) + 1) + \
+                                              [0.0]
+            entry[index] += 1
+            entry[-1] += value
+        finally:
+            self._lock.release()
+
+    def samples(self):
+        samples = []
+        for labels, entry in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), entry[:-1]):
+                cumulative += count
+                samples.append((self.name + '_bucket',
+                                _format_labels(self.labels, labels,
+                                               [('le', bound)]),
+                                cumulative))
+            formatted = _format_labels(self.labels, labels)
+            samples.append((self.name + '_sum', formatted, entry[-1]))
+            samples.append((self.name + '_count', formatted, cumulative))
+        return samples
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception, err:
+                log.error("Failed to render metric %s: %s", metric.name, err)
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+
+# Thread pools whose queues are reported, by name
+threadpools = {}
+
+def watch_threadpool(name, threadpool):
+    threadpools[name] = threadpool
+
+def _threadpool_queued():
+    values = {}
+    for name, threadpool in threadpools.iteritems():
+        team = getattr(threadpool, '_team', None)
+        if team is not None:
+            values[(name,)] = team.statistics().backloggedWorkCount
+        else:
+            values[(name,)] = threadpool.q.qsize()
+    return values
+
+def _threadpool_busy():
+    return dict(((name,), len(threadpool.working))
+                for name, threadpool in threadpools.iteritems())
+
+def _authguard(key):
+    def collect():
+        authguard = getattr(application, 'authguard', None)
+        if authguard is None:
+            return 0
+        return authguard.stats()[key]
+    return collect
+
+def _admission(key):
+    def collect():
+        admission = getattr(application, 'admission', None)
+        if admission is None:
+            return {}
+        return admission.stats()[key]
+    return collect
+
+
+ssh_connections = registry.gauge(
+    'sshg_ssh_connections', 'Open SSH connections')
+ssh_connections_total = registry.counter(
+    'sshg_ssh_connections_total', 'SSH connections accepted')
+auth_attempts = registry.counter(
+    'sshg_auth_attempts_total', 'Authentication attempts',
+    ('method', 'result'))
+auth_seconds = registry.histogram(
+    'sshg_auth_seconds', 'Time taken to check credentials', ('method',))
+auth_refused = registry.counter(
+    'sshg_auth_refused_total', 'Authentication attempts refused without '
+                               'checking them', func=_authguard('refused'))
+auth_unknown_users = registry.gauge(
+    'sshg_auth_unknown_users', 'Unknown usernames remembered',
+    func=_authguard('unknown'))
+hg_processes = registry.gauge(
+    'sshg_hg_processes', 'Running hg serve processes and workers serving '
+                         'sessions')
+repository_bytes = registry.counter(
+    'sshg_repository_bytes_total', 'Bytes transferred by finished sessions',
+    ('repository', 'direction'))
+threadpool_queued = registry.gauge(
+    'sshg_threadpool_queued', 'Work waiting for a thread', ('pool',),
+    func=_threadpool_queued)
+threadpool_busy = registry.gauge(
+    'sshg_threadpool_busy', 'Threads doing work', ('pool',),
+    func=_threadpool_busy)
+db_queries = registry.counter(
+    'sshg_db_queries_total', 'Database statements executed')
+db_commit_seconds = registry.histogram(
+    'sshg_db_commit_seconds', 'Time taken to commit the SSH server\'s '
+                              'database sessions')
+key_cache_hits = registry.counter(
+    'sshg_key_cache_hits_total', 'Public keys found already parsed',
+    func=lambda: parsed_keys.hits)
+key_cache_misses = registry.counter(
+    'sshg_key_cache_misses_total', 'Public keys which had to be parsed',
+    func=lambda: parsed_keys.misses)
+key_cache_size = registry.gauge(
+    'sshg_key_cache_size', 'Parsed public keys cached',
+    func=lambda: len(parsed_keys))
+reactor_lag_seconds = registry.histogram(
+    'sshg_reactor_lag_seconds', 'How late the reactor ran timed calls')
+admission_running = registry.gauge(
+    'sshg_admission_running', 'Sessions admitted and running',
+    func=_admission('running'))
+admission_queued = registry.gauge(
+    'sshg_admission_queued', 'Sessions waiting to be admitted',
+    func=_admission('queued'))
+admission_timeouts = registry.counter(
+    'sshg_admission_timeouts_total', 'Sessions which gave up waiting to be '
+                                     'admitted', func=_admission('timeouts'))
+
+
+class ReactorLagProbe(object):
+    """Schedules a call every `interval` seconds and records how late it
+    runs, which is how long the reactor was kept busy."""
+
+    def __init__(self, interval=1):
+        self.interval = interval
+        self.expected = None
+        self._task = task.LoopingCall(self.probe)
+
+    def start(self):
+        self.expected = time() + self.interval
+        self._task.start(self.interval, now=False)
+
+    def stop(self):
+        if self._task.running:
+            self._task.stop()
+
+    def probe(self):
+        now = time()
+        reactor_lag_seconds.observe(max(now - self.expected, 0))
+        self.expected = now + self.interval
@@ -16,40 +16,64 @@ from twisted.conch.ssh.session import ISession
 from twisted.internet import defer
 from twisted.python import components, log as twlog
 
+from sshg.authcache import authorizations, REGULAR, MANAGER, ADMIN
 from sshg.avatars import MercurialUser, MercurialAdmin
 from sshg.sessions import MercurialSession, MercurialAdminSession
 from sshg import logger, database as db
 
 log = logger.getLogger(__name__)
 
+#: The avatar and session factories of each role
+AVATAR_FACTORIES = {
+    REGULAR:    (MercurialUser, MercurialSession),
+    MANAGER:    (MercurialAdmin, MercurialAdminSession),
+    ADMIN:      (MercurialAdmin, MercurialAdminSession),
+}
+
 class MercurialRepositoriesRealm(TerminalRealm):
 
     def requestAvatar(self, avatarId, mind, *interfaces):
         if IConchUser in interfaces:
-            d = defer.maybeDeferred(db.session)
+            role = authorizations.get_role(avatarId)
+            if role is not None:
+                d = defer.succeed(role)
+            else:
+                d = db.run_in_session(self._lookupRole, avatarId)
+                d.addCallback(self._cbLookupRole, avatarId)
             d.addCallback(self._cbRequestAvatar, avatarId)
             d.addErrback(self._ebRequestAvatar)
             return d
         raise Exception("No supported interfaces found.")
 
-    def _cbRequestAvatar(self, session, avatarId):
-        user = session.query(db.User).get(avatarId)
-        if not user:
-            return defer.fail(Exception("User is not known"))
-        elif user.locked_out:
-            return defer.fail(Exception("User locked out"))
-        elif user.is_manager:
-            log.debug("User %s is %s", avatarId,
-                      user.is_admin and 'admin' or 'manager')
-            self.userFactory = MercurialAdmin
-            self.sessionFactory = MercurialAdminSession
+    def _lookupRole(self, session, avatarId):
+        # Runs on the database thread pool
+        users = db.User.__table__
+        managers = db.repomanagers_association
+        row = session.execute(db.select(
+            [users.c.is_admin, users.c.locked_out,
+             db.exists([managers.c.repo_id],
+                       managers.c.user_id==users.c.username).label('manages')],
+            users.c.username==avatarId)).fetchone()
+        if not row:
+            raise Exception("User is not known")
+        elif row.locked_out:
+            raise Exception("User locked out")
+        elif row.is_admin:
+            role = ADMIN
+        elif row.manages:
+            role = MANAGER
         else:
-            log.debug("User %s is a regular user", avatarId)
-            self.userFactory = MercurialUser
-            self.sessionFactory = MercurialSession
-        session.close()
-        avatar = self._getAvatar(avatarId)
-        return defer.succeed((IConchUser, avatar, avatar.logout))
+            role = REGULAR
+        log.debug("User %s is %s", avatarId, role)
+        return role
+
+    def _cbLookupRole(self, role, avatarId):
+        authorizations.set_role(avatarId, role)
+        return role
+
+    def _cbRequestAvatar(self, role, avatarId):
+        avatar = self._getAvatar(avatarId, role)
+        return (IConchUser, avatar, avatar.logout)
 
     def _ebRequestAvatar(self, failure):
         try:
@@ -58,11 +82,12 @@ class MercurialRepositoriesRealm(TerminalRealm):
             log.error(failure)
         return failure
 
-    def _getAvatar(self, avatarId):
+    def _getAvatar(self, avatarId, role=REGULAR):
+        userFactory, sessionFactory = AVATAR_FACTORIES[role]
         comp = components.Componentized()
-        user = self.userFactory(comp, avatarId)
+        user = userFactory(comp, avatarId)
 
-        sess = self.sessionFactory(comp, user)
+        sess = sessionFactory(comp, user)
         sess.transportFactory = self.transportFactory
         sess.chainedProtocolFactory = self.chainedProtocolFactory
 
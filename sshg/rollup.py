@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+"""
+    sshg.rollup
+    ~~~~~~~~~~~
+
+    This module sums up the raw repository traffic into hourly and daily
+    tables, per repository and user, so that reports over long periods
+    don't have to go through every raw entry.
+
+    Raw entries are marked once summed up and deleted after the configured
+    retention.
+
+    :copyright: © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+from datetime import datetime, timedelta
+
+from twisted.internet import task
+
+from sshg import logger, database as db
+
+log = logger.getLogger(__name__)
+
+#: Raw entries summed up per database transaction
+BATCH_SIZE = 5000
+
+
+class TrafficRollup(object):
+
+    def __init__(self, interval=300, raw_retention_days=30):
+        self.interval = interval
+        self.raw_retention = timedelta(days=raw_retention_days)
+        self._task = task.LoopingCall(self.run)
+
+    def start(self):
+        self._task.start(self.interval, now=False)
+
+    def stop(self):
+        if self._task.running:
+            self._task.stop()
+
+    def run(self):
+        d = db.run_in_session(self._rollup)
+        d.addCallback(self._cbRollup)
+        d.addErrback(self._ebRollup)
+        return d
+
+    def _cbRollup(self, count):
+        if count:
+            log.debug("Rolled up %d raw traffic entries", count)
+        if count == BATCH_SIZE:
+            # There's more to go
+            return self.run()
+
+    def _ebRollup(self, failure):
+        log.error("Failed to roll up the repositories traffic: %s",
+                  failure.getErrorMessage())
+
+    def _rollup(self, session):
+        # Runs on the database thread pool
+        raw = db.RepositoryTraffic.__table__
+        rows = session.execute(
+            db.select([raw.c.id, raw.c.stamp, raw.c.repo_id, raw.c.user_id,
+                       raw.c.incoming, raw.c.outgoing],
+                      raw.c.rolled_up==False).order_by(raw.c.id).limit(
+                                                                BATCH_SIZE)
+        ).fetchall()
+
+        if rows:
+            hourly = {}
+            daily = {}
+            for row in rows:
+                hour = row.stamp.replace(minute=0, second=0, microsecond=0)
+                day = hour.replace(hour=0)
+                for totals, period in ((hourly, hour), (daily, day)):
+                    counters = totals.setdefault(
+                        (period, row.repo_id, row.user_id), [0, 0])
+                    counters[0] += row.incoming or 0
+                    counters[1] += row.outgoing or 0
+            self._merge(session, db.RepositoryTrafficHourly, hourly)
+            self._merge(session, db.RepositoryTrafficDaily, daily)
+
+            ids = [row.id for row in rows]
+            for index in xrange(0, len(ids), 500):
+                session.execute(raw.update(
+                    raw.c.id.in_(ids[index:index+500]),
+                    values={raw.c.rolled_up: True}))
+
+        session.execute(raw.delete(db.and_(
+            raw.c.rolled_up==True,
+            raw.c.stamp<datetime.utcnow()-self.raw_retention)))
+        return len(rows)
+
+    def _merge(self, session, model, totals):
+        """Add `totals`, keyed by ``(period, repo_id, user_id)``, to the
+        matching rows of `model`, creating missing ones."""
+        periods = set(period for period, _, _ in totals)
+        existing = session.query(model).filter(
+            model.period.in_(list(periods))).all()
+        for entry in existing:
+            counters = totals.pop((entry.period, entry.repo_id,
+                                   entry.user_id), None)
+            if counters is not None:
+                entry.incoming += counters[0]
+                entry.outgoing += counters[1]
+        for (period, repo_id, user_id), (incoming, outgoing) in \
+                                                        totals.iteritems():
+            session.add(model(period, repo_id, user_id, incoming, outgoing))
@@ -15,7 +15,7 @@ import sys
 from ConfigParser import SafeConfigParser, NoSectionError
 import getpass
 from datetime import datetime, timedelta
-from os import makedirs
+from os import makedirs, open as os_open, fdopen, O_WRONLY, O_CREAT, O_EXCL
 from os.path import abspath, basename, expanduser, isdir, isfile, join
 from types import ModuleType
 
@@ -31,14 +31,25 @@ from zope.interface import implements
 
 
 from sshg import (__version__, __summary__, application, config, database as db,
-                  upgrades, logger)
+                  upgrades, logger, metrics)
+from sshg.accesslog import AccessLog
+from sshg.admission import AdmissionScheduler
+from sshg.authguard import AuthGuard
+from sshg.bundlecache import BundleCache
 from sshg.checkers import MercurialAuthenticationChekers
 from sshg.factories import MercurialReposFactory
+from sshg.loginstamps import LoginStamps
 from sshg.notification import NotificationSystem
 from sshg.portals import MercurialRepositoriesPortal
-from sshg.utils.crypto import gen_secret_key
+from sshg.utils.crypto import (gen_secret_key, gen_host_key,
+                               configure_pwhash, PWHASH_SCHEME, PWHASH_SCHEMES)
 from sshg.realms import MercurialRepositoriesRealm
+from sshg.rollup import TrafficRollup
+from sshg.sizetracker import SizeTracker
+from sshg.throttle import Throttles
+from sshg.traffic import TrafficAccountant
 from sshg.web.wsgi import WSGIApplication
+from sshg.workers import InProcessPool, WorkerPools
 
 
 try:
@@ -58,6 +69,122 @@ def required_imports_ok():
         return False
     return True
 
+#: Configuration sections which might not exist on configuration files written
+#: by older versions. Missing options are set to their defaults.
+OPTIONAL_SECTIONS = [
+    ('main', [
+        ('runtime_dir', '%(here)s/run'),
+        # Host keys offered along with the private_key, empty disables them
+        ('ed25519_key', '%(here)s/host_ed25519_key'),
+        ('ecdsa_key', '%(here)s/host_ecdsa_key'),
+    ]),
+    # Threads running the SSH server's database work
+    ('database', [
+        ('min_threads', '1'),
+        ('max_threads', '4'),
+    ]),
+    # Pre-started `hg serve --stdio` workers
+    ('workers', [
+        ('enabled', 'false'),
+        ('pool_size', '2'),
+        ('idle_timeout', '300'),
+        ('warm', ''),
+    ]),
+    # Long lived processes serving repositories in-process
+    ('inprocess', [
+        ('enabled', 'false'),
+        ('pool_size', '2'),
+        ('repositories', ''),
+    ]),
+    # Concurrency limits, 0 means unlimited
+    ('admission', [
+        ('max_total', '0'),
+        ('max_per_user', '0'),
+        ('max_per_repository', '0'),
+        ('queue_timeout', '60'),
+    ]),
+    # Traffic accounting, written to the database in batches
+    ('traffic', [
+        ('flush_interval', '30'),   # In seconds
+        ('max_pending', '500'),
+        ('rollup_interval', '300'), # In seconds
+        ('raw_retention_days', '30'),
+    ]),
+    # Hashing of new and upgraded passwords. The cost of pbkdf2_sha256 is
+    # it's iterations, the cost of scrypt, which needs the scrypt package, is
+    # log2 of it's N parameter. Passwords are checked on their own threads.
+    ('passwords', [
+        ('scheme', PWHASH_SCHEME),
+        ('pbkdf2_sha256_cost', '100000'),
+        ('scrypt_cost', '14'),
+        ('hash_threads', '2'),
+    ]),
+    # Refusing logins of unknown users, and backing off after failed ones.
+    # The delay doubles with each failure past the threshold.
+    ('authguard', [
+        ('unknown_ttl', '300'),     # In seconds
+        ('threshold', '5'),
+        ('base_delay', '1'),        # In seconds
+        ('max_delay', '600'),       # In seconds
+        ('reset_after', '3600'),    # In seconds
+    ]),
+    # Keys last used and users last login stamps, written in batches
+    ('logins', [
+        ('flush_interval', '30'),   # In seconds
+    ]),
+    # Repositories sizes are updated after pushes; they can also be
+    # periodically walked, 0 disables it
+    ('sizes', [
+        ('full_walk_interval', '0'),    # In seconds
+    ]),
+    # Whether the repositories bandwidth limits apply to each of their
+    # users separately, instead of to all of them together
+    ('throttle', [
+        ('per_user', 'false'),
+    ]),
+    # The web interface's /metrics page, only served to the listed addresses
+    ('metrics', [
+        ('allow_from', '127.0.0.1, ::1'),
+        ('lag_interval', '1'),      # In seconds
+    ]),
+    # Log levels are debug, info, warning, error or critical. Modules can be
+    # given levels of their own, like "sshg.sessions:debug, sqlalchemy:error".
+    # Logs go to standard error unless a file is set.
+    ('logging', [
+        ('level', 'info'),
+        ('modules', ''),
+        ('file', ''),
+    ]),
+    # One JSON object per line for each session channel. The file is rotated
+    # once over max_size, in MB, or rotate_interval old, 0 disabling either,
+    # and so many rotated files are kept, 0 keeping them all.
+    ('access_log', [
+        ('enabled', 'false'),
+        ('file', '%(here)s/access.log'),
+        ('max_size', '100'),        # In MB
+        ('rotate_interval', '86400'),  # In seconds
+        ('backups', '14'),
+        ('compress', 'true'),
+    ]),
+    # Changegroups cache, used by the in-process workers
+    ('bundle_cache', [
+        ('enabled', 'false'),
+        ('path', '%(here)s/bundles'),
+        ('max_size', '1024'),   # In MB
+    ]),
+]
+
+def set_optional_defaults(parser):
+    for section, options in OPTIONAL_SECTIONS:
+        if not parser.has_section(section):
+            parser.add_section(section)
+        for option, value in options:
+            if not parser.has_option(section, option):
+                parser.set(section, option, value)
+
+def parse_list(value):
+    return [entry.strip() for entry in value.split(',') if entry.strip()]
+
 class PasswordsDoNotMatch(Exception):
     """Simple exception to catch non-matching passwords"""
 
@@ -97,7 +224,7 @@ class SetupOptions(BaseOptions):
             print "Generating the SSH Private Key"
             from OpenSSL import crypto
             privateKey = crypto.PKey()
-            privateKey.generate_key(crypto.TYPE_RSA, 1024)
+            privateKey.generate_key(crypto.TYPE_RSA, 2048)
             password = ''
             while not password:
                 try:
@@ -133,6 +260,18 @@ class SetupOptions(BaseOptions):
             print "just point to the correct paths on the configuration file."
             print
 
+        for key_type, path in sorted(config.host_keys.iteritems()):
+            if isfile(path):
+                continue
+            print "Generating the SSH %s host key" % key_type.upper()
+            keyData = gen_host_key(key_type)
+            if keyData is None:
+                print "Skipped, it needs the cryptography package installed."
+                continue
+            fdopen(os_open(path, O_WRONLY|O_CREAT|O_EXCL, 0600),
+                   'w').write(keyData)
+            print
+
 
         print "Creating Database"
         application.database_engine = db.create_engine()
@@ -259,10 +398,94 @@ class ServiceOptions(BaseOptions):
             if schema_version.version < UPGRADES_REPO.latest:
                 upgrade_required()
 
+        metrics.watch_threadpool('database', db.start_pool(
+            config.db.min_threads, config.db.max_threads))
+        lag_probe = metrics.ReactorLagProbe(config.metrics.lag_interval)
+        reactor.callWhenRunning(lag_probe.start)
+        reactor.addSystemEventTrigger('before', 'shutdown', lag_probe.stop)
+
         realm = MercurialRepositoriesRealm()
         portal = MercurialRepositoriesPortal(realm)
-        portal.registerChecker(MercurialAuthenticationChekers())
+        checker = MercurialAuthenticationChekers(config.passwords.hash_threads)
+        reactor.callWhenRunning(checker.start)
+        reactor.addSystemEventTrigger('after', 'shutdown', checker.stop)
+        metrics.watch_threadpool('passwords', checker.threadpool)
+        portal.registerChecker(checker)
         factory = MercurialReposFactory(realm, portal)
+
+        application.admission = AdmissionScheduler(
+            config.admission.max_total, config.admission.max_per_user,
+            config.admission.max_per_repository,
+            config.admission.queue_timeout)
+
+        application.throttles = Throttles(config.throttle.per_user)
+
+        application.traffic = TrafficAccountant(config.traffic.flush_interval,
+                                                config.traffic.max_pending)
+        reactor.callWhenRunning(application.traffic.start)
+        reactor.addSystemEventTrigger('before', 'shutdown',
+                                      application.traffic.stop)
+
+        application.authguard = AuthGuard(
+            config.authguard.unknown_ttl, config.authguard.threshold,
+            config.authguard.base_delay, config.authguard.max_delay,
+            config.authguard.reset_after)
+        reactor.callWhenRunning(application.authguard.start)
+        reactor.addSystemEventTrigger('before', 'shutdown',
+                                      application.authguard.stop)
+
+        application.stamps = LoginStamps(config.logins.flush_interval)
+        reactor.callWhenRunning(application.stamps.start)
+        reactor.addSystemEventTrigger('before', 'shutdown',
+                                      application.stamps.stop)
+
+        if config.access_log.enabled:
+            application.access_log = AccessLog(
+                config.access_log.file, config.access_log.max_size,
+                config.access_log.rotate_interval, config.access_log.backups,
+                config.access_log.compress)
+            reactor.addSystemEventTrigger('after', 'shutdown',
+                                          application.access_log.stop)
+
+        application.sizes = SizeTracker(config.sizes.full_walk_interval)
+        reactor.callWhenRunning(application.sizes.start)
+        reactor.addSystemEventTrigger('after', 'shutdown',
+                                      application.sizes.stop)
+
+        if config.workers.enabled or config.inprocess.enabled:
+            if not isdir(config.runtime_dir):
+                makedirs(config.runtime_dir, 0700)
+
+        if config.bundle_cache.enabled:
+            if not isdir(config.bundle_cache.path):
+                makedirs(config.bundle_cache.path, 0700)
+            application.bundle_cache = BundleCache(config.bundle_cache.path,
+                                                   config.bundle_cache.max_size)
+
+        if config.inprocess.enabled:
+            application.inprocess = InProcessPool(
+                config.inprocess.pool_size, config.runtime_dir,
+                config.inprocess.repositories,
+                getattr(application, 'bundle_cache', None))
+            reactor.callWhenRunning(application.inprocess.start)
+            reactor.addSystemEventTrigger('before', 'shutdown',
+                                          application.inprocess.stop)
+
+        if config.workers.enabled:
+            warm = []
+            for name, size in config.workers.warm:
+                repo = session.query(db.Repository).get(name)
+                if not repo:
+                    log.warning("Not keeping unknown repository %s warm", name)
+                    continue
+                warm.append((repo.name, str(repo.path), size))
+            application.workers = WorkerPools(config.workers.pool_size,
+                                              config.workers.idle_timeout,
+                                              config.runtime_dir)
+            reactor.callWhenRunning(application.workers.start, warm)
+            reactor.addSystemEventTrigger('before', 'shutdown',
+                                          application.workers.stop)
+        session.close()
         return internet.TCPServer(config.port, factory)
 
 class SSHgOptions(BaseOptions):
@@ -338,20 +561,46 @@ class SSHgOptions(BaseOptions):
             parser.set('notification', 'reply_to', '')
             parser.set('notification', 'use_tls', 'false')
 
+            set_optional_defaults(parser)
             parser.write(open(configfile, 'w'))
             print "Please check configuration and run the setup command again"
             sys.exit(0)
 
         parser.read([configfile])
         parser.set('DEFAULT', 'here', configdir)
+        set_optional_defaults(parser)
 
         config.dir = configdir
         config.file = configfile
         config.parser = parser
 
+        config.logging = ModuleType('config.logging')
+        config.logging.file = parser.get('logging', 'file')
+        config.logging.modules = []
+        try:
+            config.logging.level = logger.parse_level(
+                                            parser.get('logging', 'level'))
+            for entry in parse_list(parser.get('logging', 'modules')):
+                name, _, level = entry.partition(':')
+                config.logging.modules.append((name.strip(),
+                                               logger.parse_level(level)))
+        except ValueError, err:
+            print "Bad logging configuration: %s" % err
+            sys.exit(1)
+        if config.logging.file:
+            config.logging.file = abspath(config.logging.file)
+        logger.setup(config.logging.level, config.logging.modules,
+                     config.logging.file)
+
         config.port = parser.getint('main', 'port')
         config.private_key = abspath(parser.get('main', 'private_key'))
         config.app_manager = parser.get('main', 'app_manager')
+        config.runtime_dir = abspath(parser.get('main', 'runtime_dir'))
+        config.host_keys = {}
+        for key_type in ('ed25519', 'ecdsa'):
+            path = parser.get('main', key_type + '_key')
+            if path:
+                config.host_keys[key_type] = abspath(path)
 
         motd = abspath(parser.get('main', 'motd_file'))
         if isfile(motd):
@@ -371,6 +620,99 @@ class SSHgOptions(BaseOptions):
         config.db.username = parser.get('database', 'username')
         config.db.password = parser.get('database', 'password')
         config.db.name = parser.get('database', 'name')
+        config.db.min_threads = parser.getint('database', 'min_threads')
+        config.db.max_threads = parser.getint('database', 'max_threads')
+
+        config.workers = ModuleType('config.workers')
+        config.workers.enabled = parser.getboolean('workers', 'enabled')
+        config.workers.pool_size = parser.getint('workers', 'pool_size')
+        config.workers.idle_timeout = parser.getint('workers', 'idle_timeout')
+        config.workers.warm = []
+        for entry in parse_list(parser.get('workers', 'warm')):
+            # Entries are either "name" or "name:size"
+            name, _, size = entry.partition(':')
+            size = size and int(size) or config.workers.pool_size
+            config.workers.warm.append((name.strip(), size))
+
+        config.inprocess = ModuleType('config.inprocess')
+        config.inprocess.enabled = parser.getboolean('inprocess', 'enabled')
+        config.inprocess.pool_size = parser.getint('inprocess', 'pool_size')
+        config.inprocess.repositories = parse_list(
+            parser.get('inprocess', 'repositories'))
+
+        config.admission = ModuleType('config.admission')
+        config.admission.max_total = parser.getint('admission', 'max_total')
+        config.admission.max_per_user = parser.getint('admission',
+                                                      'max_per_user')
+        config.admission.max_per_repository = parser.getint(
+                                        'admission', 'max_per_repository')
+        config.admission.queue_timeout = parser.getint('admission',
+                                                       'queue_timeout')
+
+        config.traffic = ModuleType('config.traffic')
+        config.traffic.flush_interval = parser.getint('traffic',
+                                                      'flush_interval')
+        config.traffic.max_pending = parser.getint('traffic', 'max_pending')
+        config.traffic.rollup_interval = parser.getint('traffic',
+                                                       'rollup_interval')
+        config.traffic.raw_retention_days = parser.getint(
+                                            'traffic', 'raw_retention_days')
+
+        config.passwords = ModuleType('config.passwords')
+        config.passwords.scheme = parser.get('passwords', 'scheme')
+        config.passwords.hash_threads = parser.getint('passwords',
+                                                      'hash_threads')
+        costs = {}
+        for scheme in PWHASH_SCHEMES:
+            if parser.has_option('passwords', scheme + '_cost'):
+                costs[scheme] = parser.getint('passwords', scheme + '_cost')
+        try:
+            configure_pwhash(config.passwords.scheme, costs)
+        except ValueError:
+            print "Password hash scheme %r not available" % \
+                                                    config.passwords.scheme
+            sys.exit(1)
+
+        config.authguard = ModuleType('config.authguard')
+        for option in ('unknown_ttl', 'threshold', 'base_delay', 'max_delay',
+                       'reset_after'):
+            setattr(config.authguard, option,
+                    parser.getint('authguard', option))
+
+        config.logins = ModuleType('config.logins')
+        config.logins.flush_interval = parser.getint('logins',
+                                                     'flush_interval')
+
+        config.throttle = ModuleType('config.throttle')
+        config.throttle.per_user = parser.getboolean('throttle', 'per_user')
+
+        config.sizes = ModuleType('config.sizes')
+        config.sizes.full_walk_interval = parser.getint('sizes',
+                                                        'full_walk_interval')
+
+        config.metrics = ModuleType('config.metrics')
+        config.metrics.allow_from = parse_list(parser.get('metrics',
+                                                          'allow_from'))
+        config.metrics.lag_interval = parser.getfloat('metrics',
+                                                      'lag_interval')
+
+        config.access_log = ModuleType('config.access_log')
+        config.access_log.enabled = parser.getboolean('access_log', 'enabled')
+        config.access_log.file = abspath(parser.get('access_log', 'file'))
+        config.access_log.max_size = parser.getint('access_log',
+                                                    'max_size') * 1024 * 1024
+        config.access_log.rotate_interval = parser.getint('access_log',
+                                                          'rotate_interval')
+        config.access_log.backups = parser.getint('access_log', 'backups')
+        config.access_log.compress = parser.getboolean('access_log',
+                                                       'compress')
+
+        config.bundle_cache = ModuleType('config.bundle_cache')
+        config.bundle_cache.enabled = parser.getboolean('bundle_cache',
+                                                        'enabled')
+        config.bundle_cache.path = abspath(parser.get('bundle_cache', 'path'))
+        config.bundle_cache.max_size = parser.getint('bundle_cache',
+                                                     'max_size') * 1024 * 1024
 
         try:
             config.web = ModuleType('config.web')
@@ -443,6 +785,7 @@ class SSHgService(object):
         threadpool = ThreadPool(config.web.min_threads, config.web.max_threads)
         threadpool.start()
         reactor.addSystemEventTrigger('after', 'shutdown', threadpool.stop)
+        metrics.watch_threadpool('web', threadpool)
         root = wsgi.WSGIResource(reactor, threadpool, wsgi_app)
         factory = server.Site(root)
         if isfile(config.web.certificate):
@@ -464,5 +807,11 @@ class SSHgService(object):
         clean_changes_task.start(5*60, now=True) # Every 5 minutes
         reactor.addSystemEventTrigger('after', 'shutdown',
                                       clean_changes_task.stop)
+
+        traffic_rollup = TrafficRollup(config.traffic.rollup_interval,
+                                       config.traffic.raw_retention_days)
+        traffic_rollup.start()
+        reactor.addSystemEventTrigger('before', 'shutdown',
+                                      traffic_rollup.stop)
         return services
 
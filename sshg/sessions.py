@@ -13,13 +13,20 @@
 import shlex
 import simplejson
 from os import environ
+from time import time
 from twisted.conch.manhole_ssh import TerminalSession
-from twisted.conch.ssh import session, channel
+from twisted.conch.ssh import session, channel, common
+from twisted.conch.ssh.session import ISession
 from twisted.conch.ssh.connection import EXTENDED_DATA_STDERR
 from twisted.conch.error import NotEnoughAuthentication
-from twisted.internet import reactor, defer
-from twisted.python import components
-from sshg import logger, database as db
+from twisted.internet import reactor, defer, threads
+from twisted.python import components, log as twlog
+from sshg import application, logger, metrics, database as db
+from sshg.admission import AdmissionTimeout
+from sshg.authcache import authorizations, RepositoryAuthorization
+from sshg.throttle import Throttles
+from sshg.utils import changelog_stamp
+from sshg.utils.crypto import openssh_key_fingerprint
 from sshg.terminal import AdminTerminal
 
 log = logger.getLogger(__name__)
@@ -27,19 +34,91 @@ log = logger.getLogger(__name__)
 class StopProcessing(Exception):
     """Exception for when we prohibit something"""
 
+class MercurialProcessProtocol(session.SSHSessionProcessProtocol):
+    """Process protocol bridging a session channel and the process serving
+    it. Flow control is handled by the session channel.
+    """
+    started = False
+
+    def connectionMade(self):
+        self.started = True
+        metrics.hg_processes.inc()
+        self.session.processStarted(self.transport)
+
+    def processEnded(self, reason):
+        if self.started:
+            # Not if handing the session over to a worker failed
+            metrics.hg_processes.dec()
+        self.session.exit_status = reason.value.exitCode
+        self.session.exit_signal = getattr(reason.value, 'signal', None)
+        session.SSHSessionProcessProtocol.processEnded(self, reason)
+
+
 class FixedSSHSession(session.SSHSession):
+    """Session channel which bridges the SSH client and the process serving
+    it with flow control on both directions, so that the memory used by
+    a connection stays bounded no matter the size of the repository.
+
+    Data from the process is only read while the client has window space
+    left to receive it. Data from the client is only accepted, ie, the
+    channel's window re-opened, while the process keeps up consuming it.
+    """
     in_counter = 0
     out_counter = 0
 
     reponame = None
-    callbacks = defer.Deferred()
-
-    def _errorCallBack(self, failure):
-        if failure.check(StopProcessing):
-            self.writeExtended(EXTENDED_DATA_STDERR, "FOO")
-            self.loseConnection()
+    repository_path = None
+    initial_stamp = None
+    isClosed = False
+    ticket = None
+
+    # For the access log, see `sshg.accesslog`
+    command = None
+    requested = started = None
+    exit_status = exit_signal = None
+
+    # Bandwidth limits' token buckets, see `sshg.throttle`
+    inBucket = outBucket = None
+    _inThrottleCall = _outThrottleCall = None
+
+    def __init__(self, *args, **kwargs):
+        session.SSHSession.__init__(self, *args, **kwargs)
+        self.opened = time()
+        self._pending = []
+        self._inputPauses = set()
+        self._outputPauses = set()
+
+    def request_exec(self, data):
+        # Same as SSHSession.request_exec but using our process protocol
+        if not self.session:
+            self.session = ISession(self.avatar)
+        command = common.getNS(data)[0]
+        self.command = command
+        self.requested = time()
+        # Client data is held until the process is spawned
+        self.pauseInput('spawn')
+        try:
+            protocol = MercurialProcessProtocol(self)
+            self.session.execCommand(protocol, command)
+        except:
+            twlog.deferr()
+            return 0
+        self.client = protocol
+        return 1
+
+    def processStarted(self, transport):
+        if self.isClosed:
+            # Closed while handing the session over to a worker
+            transport.loseConnection()
             return
-        log.exception(failure)
+        self.started = time()
+        transport.registerProducer(self, True)
+        if self._pending:
+            transport.write(''.join(self._pending))
+            self._pending = []
+        if self._outputPauses:
+            transport.pauseProducing()
+        self.resumeInput('spawn')
 
     def loseConnection(self):
         log.debug("On loseConnection")
@@ -54,54 +133,183 @@ class FixedSSHSession(session.SSHSession):
 
     def closed(self):
         log.debug("on closed()")
+        self.isClosed = True
+        self._pending = []
+        if self.ticket is not None:
+            self.ticket.release()
+        for call in self._inThrottleCall, self._outThrottleCall:
+            if call is not None and call.active():
+                call.cancel()
+        if self.repository_path and \
+                changelog_stamp(self.repository_path) != self.initial_stamp:
+            self.repositoryChanged()
         if self.reponame:
-            self.callbacks.addCallback(self._update_database)
-            self.callbacks.addErrback(self._errorCallBack)
-            if not self.callbacks.called:
-                self.callbacks.callback(None)
+            traffic = getattr(application, 'traffic', None)
+            if traffic is not None:
+                traffic.record(self.reponame, self.avatar.username,
+                               self.in_counter, self.out_counter)
+            metrics.repository_bytes.inc(self.in_counter,
+                                         (self.reponame, 'incoming'))
+            metrics.repository_bytes.inc(self.out_counter,
+                                         (self.reponame, 'outgoing'))
+        access_log = getattr(application, 'access_log', None)
+        if access_log is not None:
+            self.logAccess(access_log)
         session.SSHSession.closed(self)
+        if self.client and self.client.transport:
+            # The session only half-closes an in-process worker's connection
+            # on EOF; nobody is left to read what it's still sending
+            self.client.transport.loseConnection()
+
+    def logAccess(self, access_log):
+        now = time()
+        login_key = getattr(self.avatar, 'login_key', None)
+        peer = self.conn.transport.transport.getPeer()
+        spawn = None
+        if self.started is not None:
+            # Includes authorizing and waiting to be admitted
+            spawn = round(self.started - self.requested, 4)
+        access_log.record(
+            time=round(now, 3),
+            user=self.avatar.username,
+            key=login_key and openssh_key_fingerprint(login_key) or None,
+            address=getattr(peer, 'host', None),
+            repository=self.reponame,
+            command=self.command,
+            spawn=spawn,
+            duration=round(now - self.opened, 4),
+            bytes_in=self.in_counter,
+            bytes_out=self.out_counter,
+            exit=self.exit_status,
+            signal=self.exit_signal,
+        )
 
-    @defer.inlineCallbacks
+    def repositoryChanged(self):
+        """Called when the session added changesets to the repository."""
+        bundle_cache = getattr(application, 'bundle_cache', None)
+        if bundle_cache is not None:
+            # Walks and removes files, keep it off the reactor
+            d = threads.deferToThread(bundle_cache.invalidate,
+                                      self.repository_path)
+            d.addErrback(self._ebInvalidateBundles)
+        sizes = getattr(application, 'sizes', None)
+        if sizes is not None:
+            sizes.pushed(self.reponame, self.repository_path)
+
+    def _ebInvalidateBundles(self, failure):
+        log.error("Failed to invalidate the cached bundles of %s: %s",
+                  self.reponame, failure.getErrorMessage())
+
+    # Client -> process flow control. While input is paused the channel's
+    # window is not re-opened, see `FlowControlledSSHConnection`, so the
+    # client can't send more than what's left of it.
+    @property
+    def inputPaused(self):
+        return bool(self._inputPauses)
+
+    def pauseInput(self, reason):
+        self._inputPauses.add(reason)
+
+    def resumeInput(self, reason):
+        self._inputPauses.discard(reason)
+        if self._inputPauses or self.closing:
+            return
+        if self.localWindowLeft < self.localWindowSize // 2:
+            self.conn.adjustWindow(self,
+                                   self.localWindowSize - self.localWindowLeft)
+
+    # IPushProducer, registered on the process' standard input
+    def pauseProducing(self):
+        self.pauseInput('consumer')
+
+    def resumeProducing(self):
+        self.resumeInput('consumer')
+
+    def stopProducing(self):
+        # The process closed it's standard input. The process protocol takes
+        # care of closing the channel once the process ends.
+        self._pending = []
+
+    # Process -> client flow control. Output is paused while the client's
+    # window is exhausted.
+    def pauseOutput(self, reason):
+        if not self._outputPauses:
+            transport = self.client and self.client.transport
+            if transport is not None and hasattr(transport, 'pauseProducing'):
+                transport.pauseProducing()
+        self._outputPauses.add(reason)
+
+    def resumeOutput(self, reason):
+        self._outputPauses.discard(reason)
+        if not self._outputPauses:
+            transport = self.client and self.client.transport
+            if transport is not None and hasattr(transport, 'resumeProducing'):
+                transport.resumeProducing()
+
+    def stopWriting(self):
+        self.pauseOutput('window')
+
+    def startWriting(self):
+        self.resumeOutput('window')
+
+    # Bandwidth limits. Going over them pauses the respective direction
+    # until the token bucket refills.
+    def throttleInput(self, amount):
+        delay = self.inBucket.consume(amount)
+        if delay and self._inThrottleCall is None:
+            self.pauseInput('throttle')
+            self._inThrottleCall = reactor.callLater(delay,
+                                                     self._unthrottleInput)
+
+    def _unthrottleInput(self):
+        self._inThrottleCall = None
+        self.resumeInput('throttle')
+
+    def throttleOutput(self, amount):
+        delay = self.outBucket.consume(amount)
+        if delay and self._outThrottleCall is None:
+            self.pauseOutput('throttle')
+            self._outThrottleCall = reactor.callLater(delay,
+                                                      self._unthrottleOutput)
+
+    def _unthrottleOutput(self):
+        self._outThrottleCall = None
+        self.resumeOutput('throttle')
+
+    # The following three methods sit on the data path of every clone, pull
+    # and push. They're called once per SSH packet or per pipe read, so keep
+    # them plain synchronous calls: no deferreds, no logging.
     def dataReceived(self, data):
-        self.in_counter += yield len(data)
-        yield log.debug("Current In Counter: %s", self.in_counter)
-        if not self.client:
-            yield self.conn.sendClose(self)
-            self.buf += yield data
-        if self.client.transport:
-            # Only write if we have a transport set up
-            yield self.client.transport.write(data)
-
-    @defer.inlineCallbacks
+        self.in_counter += len(data)
+        client = self.client
+        if client is None:
+            # Data before any command was executed; nowhere to send it to
+            self.conn.sendClose(self)
+            return
+        transport = client.transport
+        if transport is None:
+            # Process not spawned yet. How much can pile up here is bounded
+            # by the channel's window since input is paused meanwhile.
+            self._pending.append(data)
+            return
+        transport.write(data)
+        if self.inBucket is not None:
+            self.throttleInput(len(data))
+
     def write(self, data):
-        self.out_counter += yield len(data)
-#        yield log.debug("Current Out Counter: %s", self.out_counter)
-        yield session.SSHSession.write(self, data)
+        self.out_counter += len(data)
+        session.SSHSession.write(self, data)
+        if self.outBucket is not None:
+            self.throttleOutput(len(data))
 
-    @defer.inlineCallbacks
     def writeExtended(self, dataType, data):
-        yield log.debug("EXTENDED - Current Out Counter: %s  DataType: %r  "
-                        "Data: %r", self.out_counter, dataType, data)
-        yield session.SSHSession.writeExtended(self, dataType, data)
-
-    def _update_database(self, previous_result):
-        session = db.session()
-        repo = session.query(db.Repository).get(self.reponame)
-        if not repo:
-            log.error("Could not found repo %r on database", self.reponame)
-        repo.calculate_size()
-        repo.traffic.append(db.RepositoryTraffic(self.in_counter,
-                                                 self.out_counter))
-        try:
-            session.commit()
-        except Exception, err:
-            log.error("Rolling back session: %r", err)
-            session.rollback()
+        session.SSHSession.writeExtended(self, dataType, data)
 
 
 class MercurialSession(TerminalSession):
 
     hg_process_pid = None
+    eof_pending = False
 
     def __init__(self, original, avatar):
         log.debug("Initiated Mercurial Session: %s" % avatar.username)
@@ -119,12 +327,13 @@ class MercurialSession(TerminalSession):
 
     def execCommand(self, protocol, cmd):
         log.debug(protocol)
-        d = defer.maybeDeferred(db.session)
-        d.addCallback(self._cbExecCommand, protocol, cmd)
+        d = defer.maybeDeferred(self._parseCommand, cmd)
+        d.addCallback(self._cbParseCommand)
+        d.addCallback(self._cbExecCommand, protocol)
         d.addErrback(self._ebExecCommand, protocol)
         return d
 
-    def _cbExecCommand(self, session, protocol, cmd):
+    def _parseCommand(self, cmd):
         args = shlex.split(cmd)
         if args.pop(0) != 'hg':
             log.warning("User %s trying to run a command(%s) other than a "
@@ -137,7 +346,27 @@ class MercurialSession(TerminalSession):
         # Get repository name
         repository_name = args.pop(0)
 
-        # Make avatar load stuff from database
+        serve = args.pop(0)
+        stdio = args.pop(0)
+        if serve != 'serve' or stdio != '--stdio':
+            # Client is not trying to run an HG repository through ssh
+            raise StopProcessing("StopProcessing")
+
+        log.debug("Are there any args left? %s", args)
+        return repository_name
+
+    def _cbParseCommand(self, repository_name):
+        repo = authorizations.get(self.avatar.username, repository_name)
+        if repo is not None:
+            return repo
+        d = db.run_in_session(self._authorize, repository_name)
+        d.addCallback(self._cbAuthorize, repository_name)
+        return d
+
+    def _authorize(self, session, repository_name):
+        """Look up on the database what the user is allowed to do on the
+        repository. Returns a `RepositoryAuthorization`. Runs on the database
+        thread pool."""
         user = session.query(db.User).get(self.avatar.username)
         log.debug("User: %r  Reponame: %r", user, repository_name)
         if user.is_admin:
@@ -152,56 +381,108 @@ class MercurialSession(TerminalSession):
             log.error("Repository %s not found!", repository_name)
             raise StopProcessing("Repository not found!")
 
+        rules = repo.rules.filter(db.AclRule.user==user).all()
+        log.debug('Rules: %r', rules)
+        return RepositoryAuthorization(
+            repo.name, str(repo.path), repo.size, repo.quota,
+            [entry.sources for entry in rules if entry.sources],
+            [entry.allow for entry in rules if entry.allow],
+            [entry.deny for entry in rules if entry.deny],
+            repo.incoming_quota or 0, repo.outgoing_quota or 0
+        )
+
+    def _cbAuthorize(self, repo, repository_name):
+        authorizations.set(self.avatar.username, repository_name, repo)
+        return repo
+
+    def _cbExecCommand(self, repo, protocol):
+        if protocol.session.isClosed:
+            # The client went away while we were looking it up
+            return
+
         log.debug("Got Repository: %r", repo)
 
-        if repo.size > repo.quota:
+        if repo.over_quota:
             log.error("Repository %s over quota.", repo.name)
             raise StopProcessing("Repository over quota.")
 
+        admission = getattr(application, 'admission', None)
+        if admission is None:
+            return self._cbAdmitted(None, repo, protocol)
+        ticket = protocol.session.ticket = admission.request(
+                                            self.avatar.username, repo.name)
+        ticket.deferred.addCallback(self._cbAdmitted, repo, protocol)
+        return ticket.deferred
+
+    def _cbAdmitted(self, ticket, repo, protocol):
+        if protocol.session.isClosed:
+            # Closing the session already released the ticket
+            return
+
         # Set repository name in ssh's session channel so that
         # database updates can occur
-        protocol.session.reponame = repository_name
-
-        serve = args.pop(0)
-        stdio = args.pop(0)
-        if serve != 'serve' or stdio != '--stdio':
-            # Client is not trying to run an HG repository through ssh
-            raise StopProcessing("StopProcessing")
-
-        log.debug("Are there any args left? %s", args)
-
-        repository_path = str(repo.path)
-        process_args = ['hg', '-R', repository_path, serve, stdio]
-        #process_args.append('--debug')
-
-        rules = repo.rules.filter(db.AclRule.user==user).all()
-
-        log.debug('Rules: %r', rules)
-        source = [entry.sources for entry in rules if entry.sources]
-        allow = [entry.allow for entry in rules if entry.allow]
-        deny = [entry.deny for entry in rules if entry.deny]
+        protocol.session.reponame = repo.name
+
+        throttles = getattr(application, 'throttles', None)
+        if throttles is not None:
+            protocol.session.inBucket = throttles.bucket(
+                Throttles.INCOMING, repo.name, self.avatar.username,
+                repo.incoming_quota)
+            protocol.session.outBucket = throttles.bucket(
+                Throttles.OUTGOING, repo.name, self.avatar.username,
+                repo.outgoing_quota)
+
+        repository_path = repo.path
+        protocol.session.repository_path = repository_path
+        protocol.session.initial_stamp = changelog_stamp(repository_path)
+
+        source, allow, deny = repo.sources, repo.allow, repo.deny
         log.debug('SOURCE: %r  Allow: %r  Deny: %r', source, allow, deny)
-        self.hg_process_pid = reactor.spawnProcess(
+        env = {'SSHg.ALLOW': simplejson.dumps(allow),
+               'SSHg.DENY': simplejson.dumps(deny),
+               'SSHg.SOURCES': simplejson.dumps(source),
+               'SSHg.USERNAME': self.avatar.username}
+
+        self.hg_process_pid = self._serve(repo, protocol, env)
+        if self.eof_pending:
+            # The client finished sending before we got here
+            self.eofReceived()
+
+    def _serve(self, repo, protocol, env):
+        inprocess = getattr(application, 'inprocess', None)
+        if inprocess is not None and inprocess.serves(repo.name):
+            process = inprocess.handOver(repo.path, protocol, env)
+            if process:
+                log.debug("Handed session over to an in-process worker")
+                return process
+
+        workers = getattr(application, 'workers', None)
+        if workers is not None:
+            process = workers.handOver(
+                repo.name, repo.path, protocol,
+                {'allow': repo.allow, 'deny': repo.deny,
+                 'sources': repo.sources, 'username': self.avatar.username}
+            )
+            if process:
+                log.debug("Handed session over to a warm worker")
+                return process
+
+        # Spawning hg is the fallback. Opening the repositories ourselves
+        # is left to the optional in-process workers, see sshg.hgworker,
+        # which use mercurial's own sshserver so that we don't have to keep
+        # up with changes to it.
+        env['PATH'] = environ.get('PATH')
+        process_args = ['hg', '-R', repo.path, 'serve', '--stdio']
+        #process_args.append('--debug')
+        return reactor.spawnProcess(
             processProtocol=protocol,
             executable='hg', args=process_args,
-            path=repository_path,
-            env = {'SSHg.ALLOW': simplejson.dumps(allow),
-                   'SSHg.DENY': simplejson.dumps(deny),
-                   'SSHg.SOURCES': simplejson.dumps(source),
-                   'SSHg.USERNAME': self.avatar.username,
-                   'PATH': environ.get('PATH')
-            }
+            path=repo.path,
+            env=env
         )
-        # Above, one could try instead to open the mercurial repository
-        # ourselves and pipe data back and forth, but, twisted can do that
-        # for us :)
-        # I think I should let this for mercurial itself, whenever mercurial
-        # changed it's sshserver code, we would have to change the twisted
-        # protocol implementing it
-
 
     def _ebExecCommand(self, failure, protocol):
-        if failure.check(StopProcessing):
+        if failure.check(StopProcessing, AdmissionTimeout):
             message = "SSHg -> %s\n\r" % failure.value.message.strip()
             protocol.session.writeExtended(EXTENDED_DATA_STDERR, message)
             protocol.loseConnection()
@@ -213,6 +494,8 @@ class MercurialSession(TerminalSession):
         if self.hg_process_pid:
             self.hg_process_pid.loseConnection()
             self.hg_process_pid = None
+        else:
+            self.eof_pending = True
     closed = eofReceived
 
     def openShell(self, protocol):
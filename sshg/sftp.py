@@ -6,59 +6,319 @@
 
     This module implements the SFTP protocol.
 
+    What users see through it is a single directory, held in memory, with
+    the ``authorized_keys`` file they manage their public keys through.
+    Nothing touches the disk; uploaded keys are parsed as they come in and
+    checked before the upload is accepted.
+
     :copyright: © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
     :license: BSD, see LICENSE for more details.
 """
 
 import struct
-from os import rename
-from os.path import join, basename
-from twisted.conch import unix
-from twisted.conch.ssh import filetransfer
+import time
+from os.path import basename
+from twisted.conch.interfaces import ISFTPServer, ISFTPFile
+from twisted.conch.ssh import filetransfer, keys
 from twisted.python import log
 from twisted.internet import defer
-
-from twisted.conch.unix import UnixSFTPFile, UnixSFTPDirectory
+from zope.interface import implements
 
 # SSH_FX_NO_SPACE_ON_FILESYSTEM = 14
 # SSH_FX_QUOTA_EXCEEDED = 15
 
-class LimittedUnixSFTPFile(UnixSFTPFile):
-    file_size = 0
+#: The file holding the user's public keys
+AUTHORIZED_KEYS = 'authorized_keys'
+
+
+def parse_key_line(line):
+    """Return the key on `line` on the OpenSSH format, `None` if it's a blank
+    or comment line, or `False` if it's not a valid public key."""
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    try:
+        return keys.Key.fromString(data=line).toString('OPENSSH')
+    except Exception:
+        return False
+
+
+class KeysFile(object):
+    """A file of the keys directory, held in memory.
+
+    Lines are parsed as they're written, so by the time the file is closed
+    only the last one, if it's not ended by a newline, is left to check.
+    """
+
+    def __init__(self, data=''):
+        self.data = bytearray(data)
+        self.mtime = int(time.time())
+        # The end offset and key, see `parse_key_line`, of each parsed line
+        self.lines = []
+        self.parsed = 0
+        self._parse()
+
+    @classmethod
+    def from_keys(cls, user_keys):
+        """Return a file holding `user_keys`, as stored on the database,
+        which are known to be valid and aren't parsed again."""
+        keys_file = cls()
+        for key in user_keys:
+            keys_file.data.extend(key + '\n')
+            keys_file.lines.append((len(keys_file.data), key))
+        keys_file.parsed = len(keys_file.data)
+        return keys_file
+
+    def copy(self):
+        other = KeysFile()
+        other.data = bytearray(self.data)
+        other.lines = list(self.lines)
+        other.parsed = self.parsed
+        return other
+
+    def read(self, offset, length):
+        return str(self.data[offset:offset + length])
+
+    def write(self, offset, data):
+        size = len(self.data)
+        if offset > size:
+            self.data.extend('\0' * (offset - size))
+        self.data[offset:offset + len(data)] = data
+        self.mtime = int(time.time())
+        if offset < self.parsed:
+            # Lines already parsed were written over, parse them again
+            while self.lines and self.lines[-1][0] > offset:
+                self.lines.pop()
+            self.parsed = self.lines and self.lines[-1][0] or 0
+        self._parse()
+
+    def _parse(self):
+        while True:
+            end = self.data.find('\n', self.parsed)
+            if end == -1:
+                break
+            self.lines.append(
+                (end + 1, parse_key_line(str(self.data[self.parsed:end]))))
+            self.parsed = end + 1
+
+    def entries(self):
+        """Return the key of each line, see `parse_key_line`."""
+        entries = [key for end, key in self.lines]
+        if self.parsed < len(self.data):
+            entries.append(parse_key_line(str(self.data[self.parsed:])))
+        return entries
+
+    def keys(self):
+        return [key for key in self.entries() if key]
+
+    def invalid_lines(self):
+        return [lineno for lineno, key in enumerate(self.entries(), 1)
+                if key is False]
+
+    def getAttrs(self):
+        return {'size': len(self.data), 'permissions': 0100600,
+                'atime': self.mtime, 'mtime': self.mtime}
+
+    def __len__(self):
+        return len(self.data)
+
+
+class KeysDirectory(object):
+    """The single directory users see through SFTP, held in memory. It holds
+    the ``authorized_keys`` file, populated with the user's keys, and
+    whatever other files are uploaded, like partial uploads to be renamed.
+
+    At most `max_files` files and files open for writing, each of which
+    holds a copy being written, are allowed.
+    """
+    max_files = 10
+
+    def __init__(self, user_keys):
+        self.files = {
+            AUTHORIZED_KEYS: KeysFile.from_keys(user_keys)
+        }
+        self.writers = 0
+        self._initial = self.files[AUTHORIZED_KEYS]
+        self.mtime = int(time.time())
+
+    def changed(self):
+        """Whether ``authorized_keys`` was written or replaced."""
+        return self.files.get(AUTHORIZED_KEYS) is not self._initial
+
+    def authorized_keys(self):
+        """Return the keys on ``authorized_keys``, or `None` if there's no
+        such file anymore."""
+        keys_file = self.files.get(AUTHORIZED_KEYS)
+        if keys_file is None:
+            return None
+        return keys_file.keys()
+
+    def getAttrs(self):
+        return {'size': 0, 'permissions': 040700,
+                'atime': self.mtime, 'mtime': self.mtime}
+
+
+class KeysSFTPFile(object):
+    """An open file of the keys directory.
+
+    Files opened for writing get a copy to write to, which replaces the
+    directory's one when closed if it only holds valid public keys.
+    """
+    implements(ISFTPFile)
+
     file_limit = 51200 # Approximately 130 lines of pub keys; more than enough
+    closed = False
+
+    def __init__(self, directory, name, flags):
+        self.directory = directory
+        self.name = name
+        self.append = flags & filetransfer.FXF_APPEND
+        self.writable = flags & (filetransfer.FXF_WRITE |
+                                 filetransfer.FXF_APPEND)
+        existing = directory.files.get(name)
+        if existing is not None and flags & filetransfer.FXF_EXCL:
+            raise filetransfer.SFTPError(filetransfer.FX_FAILURE,
+                                         "File already exists")
+        elif existing is None:
+            if not flags & filetransfer.FXF_CREAT:
+                raise filetransfer.SFTPError(filetransfer.FX_NO_SUCH_FILE,
+                                             "No such file")
+        if self.writable:
+            if len(directory.files) + directory.writers >= \
+                                                        directory.max_files:
+                raise filetransfer.SFTPError(
+                    filetransfer.FX_PERMISSION_DENIED, "Too many files")
+            directory.writers += 1
+        if existing is None or flags & filetransfer.FXF_TRUNC:
+            self.file = KeysFile()
+        elif self.writable:
+            self.file = existing.copy()
+        else:
+            self.file = existing
+
+    def readChunk(self, offset, length):
+        return self.file.read(offset, length)
 
     def writeChunk(self, offset, data):
-        if self.file_size > self.file_limit:
+        if not self.writable:
+            raise filetransfer.SFTPError(filetransfer.FX_PERMISSION_DENIED,
+                                         "File not opened for writing")
+        if self.append:
+            offset = len(self.file)
+        if offset + len(data) > self.file_limit:
             raise filetransfer.SFTPError(
                 filetransfer.FX_PERMISSION_DENIED,
                 "File size limit of %i bytes reached" % self.file_limit)
-        uploaded = UnixSFTPFile.writeChunk(self, offset, data)
-        self.file_size += uploaded
-        return uploaded
+        self.file.write(offset, data)
+
+    def getAttrs(self):
+        return self.file.getAttrs()
+
+    def setAttrs(self, attrs):
+        # Nothing worth changing
+        pass
+
+    def close(self):
+        if not self.writable or self.closed:
+            return
+        self.abandon()
+        invalid = self.file.invalid_lines()
+        if invalid:
+            raise filetransfer.SFTPError(
+                filetransfer.FX_FAILURE, "Invalid public key on line%s %s" % (
+                    len(invalid) > 1 and 's' or '',
+                    ', '.join(str(lineno) for lineno in invalid)))
+        self.directory.files[self.name] = self.file
+
+    def abandon(self):
+        """Close without storing what was written."""
+        if self.writable and not self.closed:
+            self.closed = True
+            self.directory.writers -= 1
+
 
-class SFTPFileTransfer(unix.SFTPServerForUnixConchUser):
+class KeysSFTPDirectory(object):
+    """Listing of the keys directory."""
+
+    def __init__(self, directory, owner):
+        entries = [('.', directory.getAttrs())] + [
+            (name, directory.files[name].getAttrs())
+            for name in sorted(directory.files)]
+        self.entries = iter([(name, self._longname(name, attrs, owner), attrs)
+                             for name, attrs in entries])
+
+    def _longname(self, name, attrs, owner):
+        return '%s    1 %-8s %-8s %8d %s %s' % (
+            attrs['permissions'] & 040000 and 'drwx------' or '-rw-------',
+            owner, owner, attrs['size'],
+            time.strftime('%b %d %H:%M', time.localtime(attrs['mtime'])),
+            name)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.entries.next()
+
+    def close(self):
+        pass
+
+
+class SFTPFileTransfer(object):
     """Custom SFTP file transfer.
-    Provides fixed size upload limit and disallows some unsafe and unneeded
-    operations for what sshg is intended for.
+    Serves the user's keys directory, which is held in memory, and
+    disallows some unsafe and unneeded operations for what sshg is intended
+    for.
     """
+    implements(ISFTPServer)
 
     def __init__(self, avatar):
-        unix.SFTPServerForUnixConchUser.__init__(self, avatar)
+        self.avatar = avatar
 
     def gotVersion(self, version, extData):
         return {}
 
+    def _name(self, path):
+        # Everything is done on the single keys directory
+        name = basename(path.rstrip('/'))
+        if name in ('', '.'):
+            return None
+        return name
+
+    def _file(self, directory, name):
+        keys_file = directory.files.get(name)
+        if keys_file is None:
+            raise filetransfer.SFTPError(filetransfer.FX_NO_SUCH_FILE,
+                                         "No such file")
+        return keys_file
+
     def openFile(self, filename, flags, attrs):
-        """Overridden method to provide our own limited size uploads."""
-        return LimittedUnixSFTPFile(self, self._absPath(filename), flags, attrs)
+        name = self._name(filename)
+        if name is None:
+            self._notimpl()
+        d = self.avatar.getKeysDirectory()
+        d.addCallback(KeysSFTPFile, name, flags)
+        return d
 
     def openDirectory(self, path):
-        """Overridden method to disallow writing or opening files outside
-        the created temporary directory.
-        """
-        # Ignore any path passed, everything will be done on users home dir
-        path = self.avatar.getHomeDir()
-        return UnixSFTPDirectory(self, path)
+        # Ignore any path passed, there's only the keys directory
+        d = self.avatar.getKeysDirectory()
+        d.addCallback(KeysSFTPDirectory, self.avatar.username)
+        return d
+
+    def getAttrs(self, path, followLinks):
+        d = self.avatar.getKeysDirectory()
+        d.addCallback(self._cbGetAttrs, self._name(path))
+        return d
+
+    def _cbGetAttrs(self, directory, name):
+        if name is None:
+            return directory.getAttrs()
+        return self._file(directory, name).getAttrs()
+
+    def setAttrs(self, path, attrs):
+        # Nothing worth changing
+        pass
 
     def realPath(self, path):
         path = '/' # Fake the path
@@ -69,20 +329,21 @@ class SFTPFileTransfer(unix.SFTPServerForUnixConchUser):
                                      "Operation Not Supported")
 
     def renameFile(self, oldpath, newpath):
-        """Overridden method to disallow writing or opening files outside
-        the created temporary directory.
+        """We support renaming because some clients first upload a *.part
+        file and then rename it.
         """
-        # We support renaming because some clients first upload a *.part
-        # file and then rename it
-        oldpath = join(self.avatar.getHomeDir(), basename(oldpath))
-        newpath = join(self.avatar.getHomeDir(), basename(newpath))
-        log.msg("Trying to rename file: %r -> %r" % (oldpath, newpath))
-        try:
-            rename(oldpath, newpath)
-        except:
-            log.err()
-            raise filetransfer.SFTPError(filetransfer.FX_PERMISSION_DENIED,
-                                         "Operation Failed")
+        d = self.avatar.getKeysDirectory()
+        d.addCallback(self._cbRenameFile, self._name(oldpath),
+                      self._name(newpath))
+        return d
+
+    def _cbRenameFile(self, directory, oldname, newname):
+        log.msg("Trying to rename file: %r -> %r" % (oldname, newname))
+        if newname is None:
+            self._notimpl()
+        directory.files[newname] = self._file(directory, oldname)
+        if newname != oldname:
+            del directory.files[oldname]
 
     makeDirectory = removeDirectory = readLink = makeLink = _notimpl
     removeFile = extendedRequest = _notimpl
@@ -94,9 +355,35 @@ class FileTransferServer(filetransfer.FileTransferServer):
     operation for what sshg is intended for.
     """
 
+    def packet_CLOSE(self, data):
+        """Overridden method to forget files whose close failed, because
+        what was written to them was refused.
+        """
+        requestId = data[:4]
+        handle, rest = filetransfer.getNS(data[4:])
+        if handle not in self.openFiles:
+            return filetransfer.FileTransferServer.packet_CLOSE(self, data)
+        assert rest == '', 'still have data in CLOSE: %s' % repr(rest)
+        d = defer.maybeDeferred(self.openFiles[handle].close)
+        d.addCallback(self._cbClose, handle, requestId)
+        d.addErrback(self._ebCloseFile, handle, requestId)
+
+    def _ebCloseFile(self, reason, handle, requestId):
+        self.openFiles.pop(handle, None)
+        self._ebStatus(reason, requestId, "close failed")
+
+    def connectionLost(self, reason):
+        """Overridden method to drop, instead of store, files which were
+        still being written.
+        """
+        for fileObj in self.openFiles.values():
+            fileObj.abandon()
+        self.openFiles.clear()
+        filetransfer.FileTransferServer.connectionLost(self, reason)
+
     def packet_OPEN(self, data):
         """Overridden method to disallow writing or opening files outside
-        the created temporary directory.
+        the keys directory.
         """
         requestId = data[:4]
         data = data[4:]
@@ -114,7 +401,7 @@ class FileTransferServer(filetransfer.FileTransferServer):
 
     def packet_OPENDIR(self, data):
         """Overridden method to disallow writing or opening files outside
-        the created temporary directory.
+        the keys directory.
         """
         requestId = data[:4]
         data = data[4:]
@@ -128,7 +415,7 @@ class FileTransferServer(filetransfer.FileTransferServer):
 
     def packet_STAT(self, data, followLinks = 1):
         """Overridden method to disallow writing or opening files outside
-        the created temporary directory.
+        the keys directory.
         """
         followLinks = 0 # Don't follow links
         requestId = data[:4]
@@ -146,7 +433,7 @@ class FileTransferServer(filetransfer.FileTransferServer):
 
     def packet_SETSTAT(self, data):
         """Overridden method to disallow writing or opening files outside
-        the created temporary directory.
+        the keys directory.
         """
         requestId = data[:4]
         data = data[4:]
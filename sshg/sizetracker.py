@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+"""
+    sshg.sizetracker
+    ~~~~~~~~~~~~~~~~
+
+    This module keeps the repositories sizes up to date without walking
+    their whole directory trees after each session.
+
+    Sizes are only updated after pushes. Mercurial leaves the list of files
+    written by it's last transaction, along with their sizes before it, on
+    the store's ``undo`` file; the size difference of those files is what
+    the push added. When that can't be trusted, for example if another push
+    sneaked in meanwhile, the repository is walked instead.
+
+    Since not everything changing a repository is seen by SSHg, all
+    repositories can optionally be walked periodically.
+
+    All the work happens on a single background thread, one repository at a
+    time.
+
+    :copyright: © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import os
+from os.path import exists, getsize, isdir, join
+
+from twisted.internet import reactor, task, threads
+from twisted.python.threadpool import ThreadPool
+
+from sshg import logger, database as db
+from sshg.authcache import authorizations
+from sshg.utils import directory_size
+
+log = logger.getLogger(__name__)
+
+def _store_encoders():
+    """Functions mapping the file names recorded on mercurial's journal to
+    the file names on the store."""
+    try:
+        from mercurial import store
+    except ImportError:
+        return []
+    encoders = []
+    for name in ('hybridencode', 'encodefilename'):
+        if hasattr(store, name):
+            encoders.append(getattr(store, name))
+    if hasattr(store, '_hybridencode'):
+        encoders.append(lambda name: store._hybridencode(name, True))
+        encoders.append(lambda name: store._hybridencode(name, False))
+    return encoders
+
+STORE_ENCODERS = _store_encoders()
+
+
+class SizeTracker(object):
+
+    def __init__(self, full_walk_interval=0):
+        self.full_walk_interval = full_walk_interval
+        # Per repository path, the last accounted transaction's undo file
+        # identity and the changelog size it left. Only used on our thread.
+        self.transactions = {}
+        self._threadpool = ThreadPool(1, 1, 'sshg.sizetracker')
+        self._walk_task = task.LoopingCall(self.walkAll)
+
+    def start(self):
+        self._threadpool.start()
+        if self.full_walk_interval:
+            self._walk_task.start(self.full_walk_interval, now=False)
+
+    def stop(self):
+        if self._walk_task.running:
+            self._walk_task.stop()
+        self._threadpool.stop()
+
+    def pushed(self, reponame, path):
+        """Update the size of a repository which was pushed to."""
+        return self._run(self._pushed, reponame, path)
+
+    def walk(self, reponame, path):
+        """Update the size of a repository by walking it."""
+        return self._run(self._walk, reponame, path)
+
+    def walkAll(self):
+        d = db.run_in_session(lambda session: [
+            (repo.name, str(repo.path))
+            for repo in session.query(db.Repository).all()
+        ])
+        d.addCallback(self._cbWalkAll)
+        d.addErrback(self._ebWalkAll)
+        return d
+
+    def _cbWalkAll(self, repositories):
+        if not repositories:
+            return
+        # One at a time, there's no rush
+        reponame, path = repositories.pop(0)
+        d = self.walk(reponame, path)
+        d.addCallback(lambda _: self._cbWalkAll(repositories))
+        return d
+
+    def _ebWalkAll(self, failure):
+        log.error("Failed to walk the repositories: %s",
+                  failure.getErrorMessage())
+
+    def _run(self, func, reponame, path):
+        d = threads.deferToThreadPool(reactor, self._threadpool, func,
+                                      reponame, path)
+        d.addCallback(self._cbUpdated, reponame)
+        d.addErrback(self._ebUpdate, reponame)
+        return d
+
+    def _cbUpdated(self, size, reponame):
+        if size is not None:
+            authorizations.update_size(reponame, size)
+
+    def _ebUpdate(self, failure, reponame):
+        log.error("Failed to update the size of repository %s: %s",
+                  reponame, failure.getErrorMessage())
+
+    # Everything below runs on our thread
+    def _pushed(self, reponame, path):
+        delta = self._transaction_delta(path)
+        if delta is None:
+            log.debug("Walking repository %s to find it's size", reponame)
+            return self._store(reponame, size=directory_size(path))
+        if delta:
+            return self._store(reponame, delta=delta)
+
+    def _walk(self, reponame, path):
+        return self._store(reponame, size=directory_size(path))
+
+    def _transaction_delta(self, path):
+        """Return how much the repository's last transaction grew it, 0 if
+        it was already accounted, or `None` if it can't be told."""
+        store = join(path, '.hg', 'store')
+        if not isdir(store):
+            store = join(path, '.hg')
+        try:
+            info = os.stat(join(store, 'undo'))
+        except OSError:
+            return None
+        identity = (info.st_ino, info.st_mtime, info.st_size)
+        previous = self.transactions.get(path)
+        if previous is not None and previous[0] == identity:
+            return 0
+
+        delta = 0
+        changelog = None
+        missing = False
+        for line in open(join(store, 'undo')):
+            fields = line.rstrip('\n').split('\0')
+            if len(fields) < 2:
+                continue
+            name, offset = fields[0], int(fields[1])
+            filepath = self._store_path(store, name)
+            if filepath is None:
+                missing = True
+                continue
+            size = getsize(filepath)
+            if name == '00changelog.i':
+                changelog = (offset, size)
+            delta += size - offset
+
+        self.transactions[path] = (identity, changelog and changelog[1])
+        if missing:
+            return None
+        if previous is not None and changelog is not None and \
+                                    previous[1] != changelog[0]:
+            # There were other transactions since the one we accounted last
+            return None
+        return delta
+
+    def _store_path(self, store, name):
+        filepath = join(store, name)
+        if exists(filepath):
+            return filepath
+        for encode in STORE_ENCODERS:
+            try:
+                filepath = join(store, encode(name))
+            except Exception:
+                continue
+            if exists(filepath):
+                return filepath
+        return None
+
+    def _store(self, reponame, size=None, delta=None):
+        """Store the repository's new `size`, or add `delta` to it. Returns
+        the stored size."""
+        table = db.Repository.__table__
+        if delta is not None:
+            size = table.c.size + delta
+        session = db.session()
+        try:
+            session.execute(table.update(table.c.name==reponame,
+                                         values={table.c.size: size}))
+            size = session.execute(db.select([table.c.size],
+                                             table.c.name==reponame)).scalar()
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        return size
@@ -94,9 +94,10 @@ class AdminTerminal(HistoricRecvLine):
         self.drawInputLine()
 
     def drawInputLine(self):
+        parts = filter(None, self.selectedCommand.cmdpath())
         ps =  self.selectedCommand is self.defaultCommand and '' or '/'
-        ps += '/'.join(filter(None, self.selectedCommand.cmdpath()))
-        log.debug("Parts: %r PS: %r", list(self.selectedCommand.cmdpath()), ps)
+        ps += '/'.join(parts)
+        log.debug("Parts: %r PS: %r", parts, ps)
         self.write(self.psc % ps + ''.join(self.lineBuffer))
 
     def keystrokeReceived(self, key_id, modifier):
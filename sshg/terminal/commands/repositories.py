@@ -8,6 +8,7 @@
 
 import os.path
 from sshg.terminal.commands import *
+from sshg.authcache import authorizations
 
 log = logger.getLogger(__name__)
 
@@ -84,6 +85,7 @@ class RepositoryManagersCommands(BaseRepositoryCommands):
             return
         repo.managers.append(user)
         session.commit()
+        authorizations.invalidate(username, reponame)
         yield "User %s added to the %s repository managers" % (username,
                                                                reponame)
 
@@ -105,6 +107,7 @@ class RepositoryManagersCommands(BaseRepositoryCommands):
             return
         repo.managers.pop(repo.managers.index(user))
         session.commit()
+        authorizations.invalidate(username, reponame)
         yield "User %s deleted from the %s repository managers" % (username,
                                                                    reponame)
 
@@ -168,7 +171,41 @@ class RepositoriesCommands(BaseRepositoryCommands):
         if quota:
             repo.quota = int(quota)
             session.commit()
+            authorizations.invalidate(reponame=reponame)
             return "Repository quota updated to %s" % (repo.quota==0 and
                                                        'unlimited' or
                                                        repo.quota)
         return "Quota: %s" % (repo.quota==0 and 'unlimited' or repo.quota)
+
+    def do_bandwidth(self, reponame, incoming=None, outgoing=None):
+        """Check or set the repository's bandwidth limits, in bytes/second"""
+        session = db.session()
+        repo = self._exists(session, reponame)
+        if not repo:
+            yield "A repository by the name of %s was not found." % reponame
+            return
+        if not self.check_perms(session, repo):
+            yield "%(LR)sError:%(RST)s You don't have the required permissions."
+            return
+        if incoming is not None or outgoing is not None:
+            if not self.check_perms(session):
+                # Like the quota, only admins can change it
+                yield ("%(LR)sError:%(RST)s You don't have the required "
+                       "permissions.")
+                return
+            try:
+                if incoming is not None:
+                    repo.incoming_quota = int(incoming)
+                if outgoing is not None:
+                    repo.outgoing_quota = int(outgoing)
+            except ValueError:
+                yield "%(LR)sError:%(RST)s Limits must be integers."
+                return
+            session.commit()
+            authorizations.invalidate(reponame=reponame)
+            yield "Repository bandwidth limits updated."
+            yield self.nextLine
+        limit = lambda value: value and '%s bytes/s' % value or 'unlimited'
+        yield "Incoming: %s" % limit(repo.incoming_quota)
+        yield self.nextLine
+        yield "Outgoing: %s" % limit(repo.outgoing_quota)
@@ -8,6 +8,7 @@
 
 from sshg.terminal.commands import *
 from sshg.terminal.commands.repositories import RepositoriesCommands
+from sshg.terminal.commands.server import ServerCommands
 from sshg.terminal.commands.users import UserCommands
 
 
@@ -15,7 +16,7 @@ class RootAdminCommands(BaseCommand):
     """Administration Basic Commands"""
     cmdname = None
 
-    __commands__ = [UserCommands, RepositoriesCommands]
+    __commands__ = [UserCommands, RepositoriesCommands, ServerCommands]
 
     def do_exit(self):
         """Exit admin shell."""
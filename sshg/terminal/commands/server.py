@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+from sshg import application
+from sshg.terminal.commands import *
+
+log = logger.getLogger(__name__)
+
+class ServerCommands(BaseCommand):
+    """Server Status Commands"""
+
+    cmdname = 'server'
+
+    def do_admission(self):
+        """Show the concurrency limits, running and queued requests."""
+        session = db.session()
+        if not self.check_perms(session):
+            yield "%(LR)sError:%(RST)s You don't have the required permissions."
+            return
+        admission = getattr(application, 'admission', None)
+        if admission is None:
+            yield "Admission control is not running."
+            return
+        stats = admission.stats()
+        limit = lambda value: value and str(value) or 'unlimited'
+        yield "%%(HI)s          Limits%%(RST)s: total %s, per user %s, " \
+              "per repository %s" % (limit(admission.max_total),
+                                     limit(admission.max_per_user),
+                                     limit(admission.max_per_repository))
+        yield self.nextLine
+        yield "%%(HI)s         Running%%(RST)s: %d" % stats['running']
+        yield self.nextLine
+        yield "%%(HI)s          Queued%%(RST)s: %d" % stats['queued']
+        yield self.nextLine
+        yield "%%(HI)s        Admitted%%(RST)s: %d (%d had to wait)" % (
+                                    stats['admitted'], stats['queued_total'])
+        yield self.nextLine
+        yield "%%(HI)s       Timed Out%%(RST)s: %d" % stats['timeouts']
+        yield self.nextLine
+        yield "%%(HI)s Wait Avg / Max%%(RST)s: %.3fs / %.3fs" % (
+                                    stats['average_wait'], stats['max_wait'])
+        yield self.nextLine
+        for title, key in (("Running per user", 'running_per_user'),
+                           ("Running per repository", 'running_per_repository'),
+                           ("Queued per user", 'queued_per_user')):
+            if not stats[key]:
+                continue
+            yield "%%(HI)s %s:" % title
+            yield self.nextLine
+            for name, count in sorted(stats[key].iteritems()):
+                yield "  %s: %d" % (name, count)
+                yield self.nextLine
+
+    def do_authguard(self):
+        """Show the remembered unknown users and the failed logins."""
+        session = db.session()
+        if not self.check_perms(session):
+            yield "%(LR)sError:%(RST)s You don't have the required permissions."
+            return
+        authguard = getattr(application, 'authguard', None)
+        if authguard is None:
+            yield "The authentication guard is not running."
+            return
+        stats = authguard.stats()
+        yield "%%(HI)s         Refused%%(RST)s: %d" % stats['refused']
+        yield self.nextLine
+        yield "%%(HI)s   Unknown Users%%(RST)s: %d" % stats['unknown']
+        yield self.nextLine
+        yield "%%(HI)s Failing Addresses%%(RST)s: %d" % stats['addresses']
+        yield self.nextLine
+        yield "%%(HI)s   Failing Users%%(RST)s: %d" % stats['users']
+        yield self.nextLine
+        for title, key in (("Blocked addresses", 'blocked_addresses'),
+                           ("Blocked users", 'blocked_users')):
+            if not stats[key]:
+                continue
+            yield "%%(HI)s %s:" % title
+            yield self.nextLine
+            for name, (count, remaining) in sorted(stats[key].iteritems()):
+                yield "  %s: %d failures, %.0fs left" % (name, count,
+                                                          remaining)
+                yield self.nextLine
+
+    def do_unblock(self, name=None):
+        """Forget the failed logins of an address or user, or all of them."""
+        session = db.session()
+        if not self.check_perms(session):
+            yield "%(LR)sError:%(RST)s You don't have the required permissions."
+            return
+        authguard = getattr(application, 'authguard', None)
+        if authguard is None:
+            yield "The authentication guard is not running."
+            return
+        authguard.forget(name)
+        yield "Unblocked %s" % (name or "everyone")
@@ -6,7 +6,10 @@
 # License: BSD - Please view the LICENSE file for additional information.
 # ==============================================================================
 
+from sshg import application
 from sshg.terminal.commands import *
+from sshg.authcache import authorizations
+from sshg.keycache import parsed_keys
 
 log = logger.getLogger(__name__)
 
@@ -34,6 +37,10 @@ class UserCommands(BaseCommand):
         user = db.User(username, password, bool(is_admin))
         session.add(user)
         session.commit()
+        authguard = getattr(application, 'authguard', None)
+        if authguard is not None:
+            # It might have been remembered as unknown
+            authguard.forget(username)
         yield "User %s added" % username
 
     def do_add_pubkey(self, username, public_key):
@@ -81,8 +88,11 @@ class UserCommands(BaseCommand):
         if not user:
             yield "User '%s' is not known" % username
             return
+        for pubkey in user.keys:
+            parsed_keys.invalidate(pubkey.key)
         session.delete(user)
         session.commit()
+        authorizations.invalidate(username=username)
         yield "User %s deleted" % username
 
     def do_password(self, username, password):
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+"""
+    sshg.throttle
+    ~~~~~~~~~~~~~
+
+    This module implements the repositories bandwidth limits, their
+    ``incoming_quota`` and ``outgoing_quota``, in bytes per second, where 0
+    means unlimited.
+
+    Each repository has a token bucket per direction, shared by all of it's
+    sessions, or one per user of the repository if so configured. Sessions
+    going over the limit are paused until the bucket refills, so nothing is
+    dropped; the SSH channel's flow control holds the data back meanwhile.
+
+    :copyright: © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+from time import time
+
+
+class TokenBucket(object):
+    """Token bucket allowing `rate` bytes per second, with bursts of up to
+    a second worth of data."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time()
+
+    def consume(self, amount):
+        """Take `amount` bytes from the bucket. Returns for how long, in
+        seconds, whoever is sending should pause; 0 if it can go on."""
+        now = time()
+        self.tokens = min(self.rate,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / float(self.rate)
+
+
+class Throttles(object):
+    """The token buckets of the rate limited repositories."""
+
+    INCOMING, OUTGOING = 'incoming', 'outgoing'
+
+    def __init__(self, per_user=False):
+        self.per_user = per_user
+        self.buckets = {}
+
+    def bucket(self, direction, reponame, username, rate):
+        """Return the bucket to use for `direction` traffic of `username` on
+        `reponame`, or `None` if it's not limited."""
+        key = (direction, reponame, self.per_user and username or None)
+        if not rate:
+            self.buckets.pop(key, None)
+            return None
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(rate)
+        elif bucket.rate != rate:
+            # The limit was changed
+            bucket.rate = rate
+            bucket.tokens = min(bucket.tokens, rate)
+        return bucket
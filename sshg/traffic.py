@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+"""
+    sshg.traffic
+    ~~~~~~~~~~~~
+
+    This module accounts the traffic of the served repositories.
+
+    Counters are aggregated in memory per repository and user, and written
+    to the database in bulk, periodically or once enough of them piled up,
+    instead of once per closed session. Whatever is pending gets written
+    before the server shuts down.
+
+    :copyright: © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+from datetime import datetime
+
+from twisted.internet import defer, task
+
+from sshg import logger, database as db
+
+log = logger.getLogger(__name__)
+
+
+class TrafficAccountant(object):
+
+    def __init__(self, flush_interval=30, max_pending=500):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = {}
+        self._flush_task = task.LoopingCall(self.flush)
+
+    def start(self):
+        self._flush_task.start(self.flush_interval, now=False)
+
+    def stop(self):
+        if self._flush_task.running:
+            self._flush_task.stop()
+        d = self.flush()
+        d.addCallback(self._cbStop)
+        return d
+
+    def _cbStop(self, result):
+        if self.pending:
+            log.error("Lost the traffic of %d repositories/users",
+                      len(self.pending))
+
+    def record(self, reponame, username, incoming, outgoing):
+        key = (reponame, username)
+        counters = self.pending.get(key)
+        if counters is None:
+            self.pending[key] = [incoming, outgoing]
+            if len(self.pending) >= self.max_pending:
+                self.flush()
+        else:
+            counters[0] += incoming
+            counters[1] += outgoing
+
+    def flush(self):
+        """Write the pending counters to the database. Returns a deferred
+        which fires once they're written."""
+        if not self.pending:
+            return defer.succeed(None)
+        pending, self.pending = self.pending, {}
+        d = db.run_in_session(self._insert, pending, datetime.utcnow())
+        d.addErrback(self._ebFlush, pending)
+        return d
+
+    def _insert(self, session, pending, stamp):
+        # Runs on the database thread pool
+        session.execute(db.RepositoryTraffic.__table__.insert(), [
+            {'stamp': stamp, 'repo_id': reponame, 'user_id': username,
+             'incoming': incoming, 'outgoing': outgoing}
+            for (reponame, username), (incoming, outgoing)
+            in pending.iteritems()
+        ])
+
+    def _ebFlush(self, failure, pending):
+        log.error("Failed to write the traffic of %d repositories/users, "
+                  "will retry: %s", len(pending), failure.getErrorMessage())
+        # Merge them back so they're written on the next flush
+        for (reponame, username), (incoming, outgoing) in pending.iteritems():
+            counters = self.pending.setdefault((reponame, username), [0, 0])
+            counters[0] += incoming
+            counters[1] += outgoing
@@ -0,0 +1,96 @@
+migrate_engine = object     # Make PyDev Happy
+from sshg.upgrades.versions import *
+
+DeclarativeBase1 = declarative_base()
+DeclarativeBase1.__table__ = None    # Make PyDev Happy
+metadata1 = DeclarativeBase1.metadata
+
+DeclarativeBase2 = declarative_base()
+DeclarativeBase2.__table__ = None    # Make PyDev Happy
+metadata2 = DeclarativeBase2.metadata
+
+# Referenced tables, so that the foreign keys can be created
+for metadata in metadata1, metadata2:
+    db.Table('repositories', metadata,
+             db.Column('name', db.String, primary_key=True))
+    db.Table('repousers', metadata,
+             db.Column('username', db.String, primary_key=True))
+del metadata
+
+class RepositoryTrafficOld(DeclarativeBase1):
+    """Repository Traffic"""
+
+    __tablename__ = 'repository_traffic'
+    stamp    = db.Column(db.DateTime, default=datetime.utcnow,
+                         primary_key=True)
+    incoming = db.Column(db.Integer, default=0)
+    outgoing = db.Column(db.Integer, default=0)
+    repo_id  = db.Column(db.String, db.ForeignKey('repositories.name'))
+
+    def __init__(self, stamp, incoming, outgoing, repo_id):
+        self.stamp = stamp
+        self.incoming = incoming
+        self.outgoing = outgoing
+        self.repo_id = repo_id
+
+class RepositoryTrafficNew(DeclarativeBase2):
+    """Repository Traffic"""
+
+    __tablename__ = 'repository_traffic'
+    id       = db.Column(db.Integer, primary_key=True)
+    stamp    = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    incoming = db.Column(db.Integer, default=0)
+    outgoing = db.Column(db.Integer, default=0)
+    repo_id  = db.Column(db.String, db.ForeignKey('repositories.name'))
+    user_id  = db.Column(db.String, db.ForeignKey('repousers.username',
+                                                  ondelete='SET NULL'))
+
+    def __init__(self, stamp, incoming, outgoing, repo_id):
+        self.stamp = stamp
+        self.incoming = incoming
+        self.outgoing = outgoing
+        self.repo_id = repo_id
+
+
+def rename_primary_key(table, new_table):
+    # PostgreSQL names the primary key's index after the table and doesn't
+    # rename it along with it, it would clash with the new table's
+    if migrate_engine.name in ('postgres', 'postgresql'):
+        migrate_engine.execute('ALTER INDEX %s_pkey RENAME TO %s_pkey' %
+                               (table, new_table))
+
+
+def upgrade():
+    # Upgrade operations go here. Don't create your own engine; use the engine
+    # named 'migrate_engine' imported from migrate.
+    metadata1.bind = migrate_engine # bind the engine
+    metadata2.bind = migrate_engine # bind the engine
+
+    RepositoryTrafficOld.__table__.rename('repository_traffic_old')
+    rename_primary_key('repository_traffic', 'repository_traffic_old')
+    RepositoryTrafficNew.__table__.create(migrate_engine)
+
+    # Copy the entries on the database itself, there might be lots of them
+    migrate_engine.execute(
+        "INSERT INTO repository_traffic (stamp, incoming, outgoing, repo_id) "
+        "SELECT stamp, incoming, outgoing, repo_id FROM repository_traffic_old"
+    )
+    RepositoryTrafficOld.__table__.drop(migrate_engine)
+
+
+def downgrade():
+    # Operations to reverse the above upgrade go here.
+    metadata1.bind = migrate_engine # bind the engine
+    metadata2.bind = migrate_engine # bind the engine
+
+    RepositoryTrafficNew.__table__.rename('repository_traffic_new')
+    rename_primary_key('repository_traffic', 'repository_traffic_new')
+    RepositoryTrafficOld.__table__.create(migrate_engine)
+
+    # The old table's primary key is the stamp; merge entries which share it
+    migrate_engine.execute(
+        "INSERT INTO repository_traffic (stamp, incoming, outgoing, repo_id) "
+        "SELECT stamp, SUM(incoming), SUM(outgoing), MIN(repo_id) "
+        "FROM repository_traffic_new GROUP BY stamp"
+    )
+    RepositoryTrafficNew.__table__.drop(migrate_engine)
@@ -0,0 +1,77 @@
+migrate_engine = object     # Make PyDev Happy
+from sshg.upgrades.versions import *
+
+DeclarativeBase = declarative_base()
+DeclarativeBase.__table__ = None    # Make PyDev Happy
+metadata = DeclarativeBase.metadata
+
+# Referenced tables, so that the foreign keys can be created
+db.Table('repositories', metadata,
+         db.Column('name', db.String, primary_key=True))
+db.Table('repousers', metadata,
+         db.Column('username', db.String, primary_key=True))
+
+class RepositoryTraffic(DeclarativeBase):
+    """Repository Traffic"""
+
+    __tablename__ = 'repository_traffic'
+    id       = db.Column(db.Integer, primary_key=True)
+    stamp    = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    incoming = db.Column(db.Integer, default=0)
+    outgoing = db.Column(db.Integer, default=0)
+    repo_id  = db.Column(db.String, db.ForeignKey('repositories.name'))
+    user_id  = db.Column(db.String, db.ForeignKey('repousers.username',
+                                                  ondelete='SET NULL'))
+    rolled_up = db.Column(db.Boolean, default=False)
+
+class RepositoryTrafficHourly(DeclarativeBase):
+    """Repository Traffic per hour and user"""
+
+    __tablename__ = 'repository_traffic_hourly'
+    __table_args__ = (db.UniqueConstraint('period', 'repo_id', 'user_id'), {})
+    id       = db.Column(db.Integer, primary_key=True)
+    period   = db.Column(db.DateTime, index=True)
+    incoming = db.Column(db.Integer, default=0)
+    outgoing = db.Column(db.Integer, default=0)
+    repo_id  = db.Column(db.String, db.ForeignKey('repositories.name'))
+    user_id  = db.Column(db.String, db.ForeignKey('repousers.username',
+                                                  ondelete='SET NULL'))
+
+class RepositoryTrafficDaily(DeclarativeBase):
+    """Repository Traffic per day and user"""
+
+    __tablename__ = 'repository_traffic_daily'
+    __table_args__ = (db.UniqueConstraint('period', 'repo_id', 'user_id'), {})
+    id       = db.Column(db.Integer, primary_key=True)
+    period   = db.Column(db.DateTime, index=True)
+    incoming = db.Column(db.Integer, default=0)
+    outgoing = db.Column(db.Integer, default=0)
+    repo_id  = db.Column(db.String, db.ForeignKey('repositories.name'))
+    user_id  = db.Column(db.String, db.ForeignKey('repousers.username',
+                                                  ondelete='SET NULL'))
+
+rolled_up_index = db.Index('ix_repository_traffic_rolled_up',
+                           RepositoryTraffic.__table__.c.rolled_up)
+
+
+def upgrade():
+    # Upgrade operations go here. Don't create your own engine; use the engine
+    # named 'migrate_engine' imported from migrate.
+    metadata.bind = migrate_engine # We need to bind the engine
+    traffic = RepositoryTraffic.__table__
+    traffic.c.rolled_up.create(traffic)
+    rolled_up_index.create(migrate_engine)
+    RepositoryTrafficHourly.__table__.create(migrate_engine)
+    RepositoryTrafficDaily.__table__.create(migrate_engine)
+    # Existing entries are rolled up by the server
+    migrate_engine.execute(traffic.update(values={traffic.c.rolled_up: False}))
+
+
+def downgrade():
+    # Operations to reverse the above upgrade go here.
+    metadata.bind = migrate_engine # We need to bind the engine
+    traffic = RepositoryTraffic.__table__
+    RepositoryTrafficDaily.__table__.drop(migrate_engine)
+    RepositoryTrafficHourly.__table__.drop(migrate_engine)
+    rolled_up_index.drop(migrate_engine)
+    traffic.c.rolled_up.drop(traffic)
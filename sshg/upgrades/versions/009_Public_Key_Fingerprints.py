@@ -0,0 +1,49 @@
+migrate_engine = object     # Make PyDev Happy
+from base64 import b64decode
+from hashlib import sha256
+from sshg.upgrades.versions import *
+
+DeclarativeBase = declarative_base()
+DeclarativeBase.__table__ = None    # Make PyDev Happy
+metadata = DeclarativeBase.metadata
+
+# Referenced tables, so that the foreign keys can be created
+db.Table('repousers', metadata,
+         db.Column('username', db.String, primary_key=True))
+
+class PublicKey(DeclarativeBase):
+    """Users Public Keys"""
+
+    __tablename__ = 'pubkeys'
+
+    key         = db.Column(db.String, primary_key=True)
+    fingerprint = db.Column(db.String(64))
+    added_on    = db.Column(db.DateTime, default=datetime.utcnow)
+    used_on     = db.Column(db.DateTime, default=datetime.utcnow)
+    user_id     = db.Column(db.String, db.ForeignKey('repousers.username'))
+
+fingerprint_index = db.Index('ix_pubkeys_fingerprint',
+                             PublicKey.__table__.c.fingerprint)
+
+
+def upgrade():
+    # Upgrade operations go here. Don't create your own engine; use the engine
+    # named 'migrate_engine' imported from migrate.
+    metadata.bind = migrate_engine # We need to bind the engine
+    pubkeys = PublicKey.__table__
+    pubkeys.c.fingerprint.create(pubkeys)
+    fingerprint_index.create(migrate_engine)
+    # Keys are stored in the OpenSSH format, their middle field is the blob
+    for row in migrate_engine.execute(db.select([pubkeys.c.key])).fetchall():
+        migrate_engine.execute(pubkeys.update(
+            pubkeys.c.key==row.key,
+            values={pubkeys.c.fingerprint:
+                    sha256(b64decode(row.key.split()[1])).hexdigest()}))
+
+
+def downgrade():
+    # Operations to reverse the above upgrade go here.
+    metadata.bind = migrate_engine # We need to bind the engine
+    pubkeys = PublicKey.__table__
+    fingerprint_index.drop(migrate_engine)
+    pubkeys.c.fingerprint.drop(pubkeys)
@@ -9,3 +9,29 @@
     :copyright: © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
     :license: BSD, see LICENSE for more details.
 """
+
+from os import stat, walk
+from os.path import getsize, isfile, join
+
+def changelog_stamp(repo_path):
+    """Return a cheap stamp of the repository's changelog, which changes
+    whenever changesets are added to the repository. `None` is returned if
+    the changelog can't be found."""
+    for relpath in ('.hg/store/00changelog.i', '.hg/00changelog.i'):
+        filepath = join(repo_path, relpath)
+        if isfile(filepath):
+            info = stat(filepath)
+            return info.st_size, info.st_mtime
+    return None
+
+def directory_size(path):
+    """Return the sum of the sizes of all files under `path`. Files removed
+    while walking are ignored."""
+    size = 0
+    for dirname, _, files in walk(path):
+        for filename in files:
+            try:
+                size += getsize(join(dirname, filename))
+            except OSError:
+                pass
+    return size
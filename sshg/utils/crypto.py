@@ -6,12 +6,79 @@
 # License: BSD - Please view the LICENSE file for additional information.
 # ==============================================================================
 import string
+from base64 import b64decode
+from binascii import hexlify
 from random import choice
-from hashlib import sha1, md5
+from hashlib import sha1, sha256, md5
+try:
+    from hashlib import pbkdf2_hmac
+except ImportError:
+    # Python < 2.7.8
+    pbkdf2_hmac = None
+try:
+    import scrypt
+except ImportError:
+    scrypt = None
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+except ImportError:
+    # Needs cryptography >= 2.6
+    serialization = None
+try:
+    from hmac import compare_digest
+except ImportError:
+    # Python < 2.7.7
+    def compare_digest(a, b):
+        if len(a) != len(b):
+            return False
+        result = 0
+        for x, y in zip(a, b):
+            result |= ord(x) ^ ord(y)
+        return result == 0
 
 SALT_CHARS = string.ascii_lowercase + string.digits
 SECRET_KEY_CHARS = string.ascii_letters + string.digits + string.punctuation
 
+def _pbkdf2_sha256(password, salt, cost):
+    # The cost is the number of iterations
+    return hexlify(pbkdf2_hmac('sha256', password, salt, cost))
+
+def _scrypt(password, salt, cost):
+    # The cost is log2 of scrypt's N
+    return hexlify(scrypt.hash(password, salt, 1 << cost, 8, 1, 32))
+
+#: Password hashing schemes with a tunable cost, by name. Each has the
+#: function hashing a password and a salt at a given cost, and the default
+#: cost. Hashes are stored as ``scheme$cost$salt$hash``.
+PWHASH_SCHEMES = {}
+
+def register_pwhash_scheme(name, func, default_cost):
+    PWHASH_SCHEMES[name] = (func, default_cost)
+
+if pbkdf2_hmac is not None:
+    register_pwhash_scheme('pbkdf2_sha256', _pbkdf2_sha256, 100000)
+if scrypt is not None:
+    register_pwhash_scheme('scrypt', _scrypt, 14)
+
+#: The scheme new password hashes use, and the cost of each scheme, see
+#: :func:`configure_pwhash`
+PWHASH_SCHEME = 'pbkdf2_sha256' in PWHASH_SCHEMES and 'pbkdf2_sha256' or 'sha'
+PWHASH_COSTS = dict((name, cost) for name, (func, cost)
+                    in PWHASH_SCHEMES.iteritems())
+
+def configure_pwhash(scheme, costs=None):
+    """Set the `scheme` new password hashes use and, optionally, the
+    `costs` of the schemes, by name."""
+    global PWHASH_SCHEME
+    if scheme != 'sha' and scheme not in PWHASH_SCHEMES:
+        raise ValueError('unknown password hash scheme %r' % scheme)
+    PWHASH_SCHEME = scheme
+    for name, cost in (costs or {}).iteritems():
+        if name in PWHASH_SCHEMES:
+            PWHASH_COSTS[name] = cost
+
 def gen_salt(length=6):
     """Generate a random string of SALT_CHARS with specified ``length``."""
     if length <= 0:
@@ -22,15 +89,63 @@ def gen_secret_key():
     """Generate a new secret key."""
     return ''.join(choice(SECRET_KEY_CHARS) for _ in xrange(64))
 
-def gen_pwhash(password):
-    """Return a the password encrypted in sha format with a random salt."""
+def gen_host_key(key_type):
+    """Return a new unencrypted ``ed25519`` or ``ecdsa`` (NIST P-256) host
+    key, or `None` if the cryptography package is not available."""
+    if serialization is None:
+        return None
+    if key_type == 'ed25519':
+        key = ed25519.Ed25519PrivateKey.generate()
+        key_format = serialization.PrivateFormat.OpenSSH
+    elif key_type == 'ecdsa':
+        key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        key_format = serialization.PrivateFormat.TraditionalOpenSSL
+    else:
+        raise ValueError('unknown host key type %r' % key_type)
+    return key.private_bytes(serialization.Encoding.PEM, key_format,
+                             serialization.NoEncryption())
+
+def key_fingerprint(blob):
+    """Return the fingerprint of a public key given it's ``blob``, the
+    decoded middle field of it's OpenSSH representation."""
+    return sha256(blob).hexdigest()
+
+def openssh_key_blob(key):
+    """Return the blob of a public key in the OpenSSH format, without
+    parsing the key itself."""
+    return b64decode(key.split()[1])
+
+def openssh_key_fingerprint(key):
+    """Return the fingerprint of a public key in the OpenSSH format, without
+    parsing the key itself."""
+    return key_fingerprint(openssh_key_blob(key))
+
+def gen_pwhash(password, scheme=None, cost=None):
+    """Return a the password hashed with a random salt, using `scheme` at
+    `cost`, or the configured ones."""
     if isinstance(password, unicode):
         password = password.encode('utf-8')
-    salt = gen_salt(6)
-    h = sha1()
-    h.update(salt)
-    h.update(password)
-    return 'sha$%s$%s' % (salt, h.hexdigest())
+    scheme = scheme or PWHASH_SCHEME
+    if scheme == 'sha':
+        salt = gen_salt(6)
+        h = sha1()
+        h.update(salt)
+        h.update(password)
+        return 'sha$%s$%s' % (salt, h.hexdigest())
+    func = PWHASH_SCHEMES[scheme][0]
+    cost = cost or PWHASH_COSTS[scheme]
+    salt = gen_salt(16)
+    return '%s$%d$%s$%s' % (scheme, cost, salt, func(password, salt, cost))
+
+def pwhash_outdated(pwhash):
+    """Whether a password hash doesn't use the configured scheme and cost,
+    and should be replaced next time the password is known."""
+    method = pwhash.split('$', 1)[0]
+    if method != PWHASH_SCHEME:
+        return True
+    if method in PWHASH_SCHEMES:
+        return pwhash.split('$', 2)[1] != str(PWHASH_COSTS[method])
+    return False
 
 def check_pwhash(pwhash, password):
     """Check a password against a given hash value. Since many forums save md5
@@ -51,12 +166,24 @@ def check_pwhash(pwhash, password):
     sha passwords::
 
         sha$123456$118083bd04c79ab51944a9ef863efcd9c048dd9a
+
+    and the passwords hashed with one of the :data:`PWHASH_SCHEMES`, along
+    with the cost used::
+
+        pbkdf2_sha256$100000$0a1b2c3d4e5f6g7h$5d2f...
     """
     if isinstance(password, unicode):
         password = password.encode('utf-8')
     if pwhash.count('$') < 2:
         return False
     method, salt, hashval = pwhash.split('$', 2)
+    if method in PWHASH_SCHEMES:
+        if hashval.count('$') != 1 or not salt.isdigit():
+            return False
+        cost = int(salt)
+        salt, hashval = hashval.split('$')
+        func = PWHASH_SCHEMES[method][0]
+        return compare_digest(func(password, salt, cost), hashval)
     if method == 'plain':
         return hashval == password
     elif method == 'md5':
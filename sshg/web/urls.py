@@ -8,11 +8,12 @@
 
 from werkzeug.routing import Map, Rule, Submount
 from sshg.web.utils import require_admin, require_manager
-from sshg.web.views import account, accounts, admin, repos
+from sshg.web.views import account, accounts, admin, metrics, repos
 
 url_map = Map([
     Rule('/', endpoint='admin'),
     Rule('/shared/<file>', endpoint='shared', build_only=True),
+    Rule('/metrics', endpoint='metrics'),
     Submount('/account', [
         Rule('/', endpoint="account.prefs"),
         Rule('/login', endpoint="account.login"),
@@ -36,6 +37,7 @@ url_map = Map([
 
 handlers = {
     'admin': admin.index,
+    'metrics': metrics.index,
 
     # Authentication/Prefs Views
     'account.login':    account.login,
@@ -6,7 +6,11 @@
 # License: BSD - Please view the LICENSE file for additional information.
 # ==============================================================================
 
+from twisted.internet import reactor
+
+from sshg import application
 from sshg.web.views import *
+from sshg.keycache import parsed_keys
 from sshg.utils.crypto import gen_pwhash
 
 log = logger.getLogger(__name__)
@@ -85,6 +89,7 @@ def preferences(request):
             for key in request.values.getlist('sel'):
                 pubkey = session.query(db.PublicKey).get(key)
                 session.delete(pubkey)
+                parsed_keys.invalidate(pubkey.key)
             session.commit()
         new_keys = request.values.get('new_keys')
         for line, key_contents in enumerate(new_keys.splitlines()):
@@ -153,6 +158,10 @@ def confirm(request, confirm_hash=None):
             session.delete(change)
             flash("Account created. Please reset your password now.", msg=True)
             session.commit()
+            authguard = getattr(application, 'authguard', None)
+            if authguard is not None:
+                # It might have been remembered as unknown
+                reactor.callFromThread(authguard.forget, new_account.username)
             return redirect(url_for('account.reset', email='pa@ufsoft.org'))
 
         for key, value in change.changes.iteritems():
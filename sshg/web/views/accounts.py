@@ -6,8 +6,13 @@
 # License: BSD - Please view the LICENSE file for additional information.
 # ==============================================================================
 
+from twisted.internet import reactor
+
+from sshg import application
 from sshg.web.views import *
 from sshg.utils.crypto import gen_salt
+from sshg.authcache import authorizations
+from sshg.keycache import parsed_keys
 
 log = logger.getLogger(__name__)
 
@@ -22,6 +27,8 @@ def index(request):
         for username in selection:
             log.debug("Deleting user %s", username)
             user = session.query(db.User).get(username)
+            for pubkey in user.keys:
+                parsed_keys.invalidate(pubkey.key)
             session.delete(user)
         if selection:
             flash("Account(s) %s deleted" % ', '.join(
@@ -43,6 +50,9 @@ def index(request):
             flash("Account(s) %s un-locked" % ', '.join(
                     '"%s"' % u.encode('utf-8') for u in selection), msg=True)
     session.commit()
+    # Only once committed, or SSH logins could cache what's being changed
+    for username in selection:
+        authorizations.invalidate(username=username)
     accounts = session.query(db.User).all()
     return generate_template('accounts/index.html', accounts=accounts)
 
@@ -73,6 +83,10 @@ def new(request):
 
     session.add(change)
     session.commit()
+    authguard = getattr(application, 'authguard', None)
+    if authguard is not None:
+        # It might have been remembered as unknown
+        reactor.callFromThread(authguard.forget, username)
     request.notification.sendmail("Account Create Confirmation",
                                   'new_account.txt', {'change': change},
                                   email)
@@ -91,12 +105,17 @@ def edit(request, username):
         for key in selection:
             pubkey = session.query(db.PublicKey).get(key)
             account.keys.remove(pubkey)
+            parsed_keys.invalidate(pubkey.key)
         session.commit()
         if selection:
             flash("Public Key(s) deleted.", msg=True)
         return generate_template('accounts/edit.html', account=account)
     elif 'delete' in request.values:
+        for pubkey in account.keys:
+            parsed_keys.invalidate(pubkey.key)
         session.delete(account)
+        session.commit()
+        authorizations.invalidate(username=username)
         flash("Account deleted.", msg=True)
         return redirect(url_for('accounts.index'))
 
@@ -116,5 +135,7 @@ def edit(request, username):
             account.keys.append(pubkey)
             flash("Public Key(s) added.", msg=True)
     session.commit()
+    # Admins can use any repository, locked out users none
+    authorizations.invalidate(username=username)
     flash("Account details updated.", msg=True)
     return generate_template('accounts/edit.html', account=account)
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+from twisted.internet import reactor, threads
+from werkzeug.exceptions import Forbidden
+
+from sshg import config
+from sshg.metrics import registry
+from sshg.web.utils import Response
+
+def index(request):
+    allowed = config.metrics.allow_from
+    if '*' not in allowed and request.remote_addr not in allowed:
+        raise Forbidden()
+    # Collect on the reactor thread, where most counters are updated
+    text = threads.blockingCallFromThread(reactor, registry.render)
+    return Response(text, mimetype='text/plain; version=0.0.4')
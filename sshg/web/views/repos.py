@@ -7,6 +7,7 @@
 # ==============================================================================
 
 from sshg.web.views import *
+from sshg.authcache import authorizations
 
 log = logger.getLogger(__name__)
 
@@ -23,6 +24,9 @@ def index(request):
             flash("The repository by the name %s is no "
                   "longer managed." % reponame, msg=True)
         session.commit()
+        # Only once committed, or SSH sessions could cache what's deleted
+        for reponame in selection:
+            authorizations.invalidate(reponame=reponame)
 
     repos = request.user.manages.all()
     return generate_template('repos/index.html', repos=repos)
@@ -72,7 +76,16 @@ def edit(request, reponame):
         return generate_template('repos/edit.html', repo=repo, users=users)
 
     if 'update' in request.values:
-        repo.quota = int(request.values.get('quota', repo.quota))
+        # The form only lets administrators change the limits, the fields
+        # are still posted, hidden, by managers
+        if request.user.is_admin:
+            repo.quota = int(request.values.get('quota', repo.quota))
+            repo.incoming_quota = int(request.values.get('incoming_quota',
+                                                         repo.incoming_quota))
+            repo.outgoing_quota = int(request.values.get('outgoing_quota',
+                                                         repo.outgoing_quota))
+        session.commit()
+        authorizations.invalidate(reponame=reponame)
         flash("Updated repository details", msg=True)
 
     elif 'update_users' in request.values:
@@ -133,6 +146,7 @@ def edit(request, reponame):
         if added_managers:
             flash("Added managers: %s" % ', '.join(added_managers), msg=True)
 
+        authorizations.invalidate(reponame=reponame)
 
     users = session.query(db.User).all()
     return generate_template('repos/edit.html', repo=repo, users=users)
@@ -69,9 +69,9 @@ class WSGIApplication(object):
             try:
                 request.load_persistent_sessions()
             except Unauthorized:
-                # Allow login's; raise on everything else
+                # Allow login's and metrics; raise on everything else
                 if endpoint not in ('account.login', 'account.reset',
-                                    'account.confirm'):
+                                    'account.confirm', 'metrics'):
                     raise
             request.endpoint = endpoint
             action = handlers[endpoint]
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+"""
+    sshg.workers
+    ~~~~~~~~~~~~
+
+    This module is responsible for keeping pre-started ``hg serve --stdio``
+    processes around, so that clones, pulls and pushes don't pay for the
+    python interpreter startup plus mercurial's imports and extensions
+    loading.
+
+    ``hg serve --stdio`` binds to it's repository when it starts, so workers
+    are pooled per repository. Repositories listed on the configuration are
+    always kept warm; any other repository gets a pool when it's used, which
+    is dropped after being unused for the configured idle timeout.
+
+    Since a worker is started before knowing who it will serve, the ACL rules
+    can't be passed on it's environment. Each worker gets a file path on the
+    ``SSHg.ACL_FILE`` environment variable instead, which is filled with the
+    user's rules when the worker is handed to a session.
+
+    Alternatively, repositories can be served by a pool of long lived
+    :mod:`sshg.hgworker` processes, which keep the repositories open across
+    requests. Sessions are handed to an idle one over an unix socket. These
+    can also serve changegroups from a :mod:`sshg.bundlecache`.
+
+    :copyright: © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import simplejson
+import struct
+import sys
+from os import environ, remove, rename
+from os.path import join
+from time import time
+from uuid import uuid4
+
+from twisted.internet import error, protocol, reactor, task
+from twisted.python import failure
+
+from sshg import logger
+
+log = logger.getLogger(__name__)
+
+
+class WorkerProtocol(protocol.ProcessProtocol):
+    """Process protocol of a pre-started worker. Once the worker is handed
+    to a session, everything is relayed to the session's process protocol.
+    """
+    client = None
+
+    def __init__(self, pool, acl_file):
+        self.pool = pool
+        self.acl_file = acl_file
+        self.started = time()
+
+    def attach(self, client):
+        self.client = client
+        client.makeConnection(self.transport)
+
+    def childDataReceived(self, childFD, data):
+        if self.client is not None:
+            self.client.childDataReceived(childFD, data)
+
+    def childConnectionLost(self, childFD):
+        if self.client is not None:
+            self.client.childConnectionLost(childFD)
+
+    def processEnded(self, reason):
+        self.pool.workerEnded(self)
+        try:
+            remove(self.acl_file)
+        except OSError:
+            pass
+        if self.client is not None:
+            self.client.processEnded(reason)
+
+
+class WorkerPool(object):
+    """Pre-started ``hg serve --stdio`` workers for a single repository."""
+
+    def __init__(self, manager, path, size, persistent=False):
+        self.manager = manager
+        self.path = path
+        self.size = size
+        self.persistent = persistent
+        self.idle = []
+        self.last_used = time()
+
+    def fill(self):
+        while len(self.idle) < self.size:
+            self.spawn()
+
+    def spawn(self):
+        acl_file = join(self.manager.runtime_dir, '%s.acl' % uuid4().hex)
+        worker = WorkerProtocol(self, acl_file)
+        reactor.spawnProcess(
+            worker, 'hg', args=['hg', '-R', self.path, 'serve', '--stdio'],
+            path=self.path,
+            env={'SSHg.ACL_FILE': acl_file, 'PATH': environ.get('PATH')}
+        )
+        self.idle.append(worker)
+
+    def lease(self, acl):
+        self.last_used = time()
+        if not self.idle:
+            self.fill()
+            return None
+        worker = self.idle.pop(0)
+        # Write the rules file atomically, the worker might already be
+        # looking for it
+        tmpfile = worker.acl_file + '.tmp'
+        fd = open(tmpfile, 'w')
+        try:
+            simplejson.dump(acl, fd)
+        finally:
+            fd.close()
+        rename(tmpfile, worker.acl_file)
+        self.fill()
+        return worker
+
+    def retire(self, max_age):
+        """Stop idle workers started more than `max_age` seconds ago, so that
+        changes to the repository's configuration get picked up."""
+        now = time()
+        for worker in self.idle[:]:
+            if now - worker.started > max_age:
+                self.idle.remove(worker)
+                worker.transport.loseConnection()
+
+    def workerEnded(self, worker):
+        if worker in self.idle:
+            # Died before being used; it will be replaced on the next lease
+            log.warning("Worker for repository %s exited while idle",
+                        self.path)
+            self.idle.remove(worker)
+
+    def stop(self):
+        self.size = 0
+        while self.idle:
+            self.idle.pop().transport.loseConnection()
+
+
+class WorkerPools(object):
+    """All the worker pools, keyed by repository name."""
+
+    def __init__(self, size, idle_timeout, runtime_dir):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.runtime_dir = runtime_dir
+        self.pools = {}
+        self._expire_task = task.LoopingCall(self.expire)
+
+    def start(self, warm_repositories):
+        """Start the pools of the repositories always kept warm.
+        `warm_repositories` is a list of ``(name, path, size)`` tuples."""
+        for name, path, size in warm_repositories:
+            log.info("Keeping %d workers warm for repository %s", size, name)
+            pool = self.pools[name] = WorkerPool(self, path, size,
+                                                 persistent=True)
+            pool.fill()
+        self._expire_task.start(max(self.idle_timeout // 2, 1), now=False)
+
+    def handOver(self, name, path, client, acl):
+        """Hand `client`, a process protocol, to a ready worker of the
+        repository. Returns the worker's process transport or `None` if there
+        was no ready worker, in which case the caller should spawn a process
+        itself."""
+        pool = self.pools.get(name)
+        if pool is None:
+            if not self.size:
+                return None
+            pool = self.pools[name] = WorkerPool(self, path, self.size)
+        if pool.path != path:
+            # Repository moved
+            size, persistent = pool.size, pool.persistent
+            pool.stop()
+            pool = self.pools[name] = WorkerPool(self, path, size, persistent)
+        worker = pool.lease(acl)
+        if worker is None:
+            return None
+        worker.attach(client)
+        return worker.transport
+
+    def expire(self):
+        now = time()
+        for name, pool in self.pools.items():
+            if not pool.persistent and now - pool.last_used > self.idle_timeout:
+                log.debug("Dropping idle worker pool of repository %s", name)
+                pool.stop()
+                del self.pools[name]
+                continue
+            pool.retire(self.idle_timeout)
+            pool.fill()
+
+    def stop(self):
+        if self._expire_task.running:
+            self._expire_task.stop()
+        for pool in self.pools.itervalues():
+            pool.stop()
+        self.pools.clear()
+
+
+class WireClientProtocol(protocol.Protocol):
+    """Talks to an in-process worker on behalf of a session's process
+    protocol, de-multiplexing the worker's framed output."""
+    exit_code = None
+    eof_pending = False
+
+    def __init__(self, worker, client, header):
+        self.worker = worker
+        self.client = client
+        self.header = header
+        self.buffer = ''
+
+    def connectionMade(self):
+        self.transport.write(simplejson.dumps(self.header) + '\n')
+        self.client.makeConnection(self.transport)
+        if self.eof_pending and not self.transport.disconnecting:
+            # The client finished sending before we got connected
+            self.transport.loseWriteConnection()
+
+    def dataReceived(self, data):
+        buffer = self.buffer + data
+        offset = 0
+        while len(buffer) - offset >= 5:
+            channel, length = struct.unpack('>cI', buffer[offset:offset+5])
+            end = offset + 5 + length
+            if len(buffer) < end:
+                break
+            payload = buffer[offset+5:end]
+            if channel == 'o':
+                self.client.outReceived(payload)
+            elif channel == 'e':
+                self.client.errReceived(payload)
+            elif channel == 'r':
+                self.exit_code = struct.unpack('>I', payload)[0]
+            offset = end
+        self.buffer = buffer[offset:]
+
+    def loseConnection(self):
+        # The client is done sending; let the worker finish answering
+        if self.transport is None:
+            self.eof_pending = True
+        else:
+            self.transport.loseWriteConnection()
+
+    def connectionLost(self, reason):
+        self.worker.release()
+        if self.exit_code == 0:
+            reason = failure.Failure(error.ProcessDone(0))
+        else:
+            reason = failure.Failure(error.ProcessTerminated(
+                exitCode=self.exit_code is None and 255 or self.exit_code))
+        self.client.processEnded(reason)
+
+
+class InProcessWorker(protocol.ProcessProtocol):
+    """Process protocol of a :mod:`sshg.hgworker` process."""
+    ready = busy = False
+
+    def __init__(self, pool, socket_path):
+        self.pool = pool
+        self.socket_path = socket_path
+
+    def outReceived(self, data):
+        if not self.ready and 'ready' in data:
+            self.ready = True
+
+    def errReceived(self, data):
+        log.error("In-process worker %s: %s", self.socket_path, data.rstrip())
+
+    def release(self):
+        self.busy = False
+
+    def processEnded(self, reason):
+        self.ready = False
+        self.pool.workerEnded(self)
+
+
+class InProcessPool(object):
+    """Pool of :mod:`sshg.hgworker` processes serving the configured
+    repositories; ``*`` means all of them."""
+
+    def __init__(self, size, runtime_dir, repositories, bundle_cache=None):
+        self.size = size
+        self.runtime_dir = runtime_dir
+        self.repositories = set(repositories)
+        self.bundle_cache = bundle_cache
+        self.workers = []
+        self.stopping = False
+
+    def start(self):
+        for index in xrange(self.size):
+            self.spawn(join(self.runtime_dir, 'hgworker-%d.sock' % index))
+
+    def spawn(self, socket_path):
+        if self.stopping:
+            return
+        worker = InProcessWorker(self, socket_path)
+        args = [sys.executable, '-m', 'sshg.hgworker', socket_path]
+        if self.bundle_cache is not None:
+            args.extend([self.bundle_cache.path,
+                         str(self.bundle_cache.max_size)])
+        reactor.spawnProcess(worker, sys.executable, args=args,
+                             env=environ.copy())
+        self.workers.append(worker)
+
+    def serves(self, name):
+        return '*' in self.repositories or name in self.repositories
+
+    def handOver(self, path, client, env):
+        """Hand `client`, a process protocol, to an idle worker. Returns an
+        object whose ``loseConnection`` ends the client's input or `None` if
+        all workers are busy, in which case the caller should spawn a process
+        itself."""
+        for worker in self.workers:
+            if worker.ready and not worker.busy:
+                break
+        else:
+            return None
+        worker.busy = True
+        wire = WireClientProtocol(worker, client, {'path': path, 'env': env})
+        d = protocol.ClientCreator(reactor, lambda: wire).connectUNIX(
+                                                            worker.socket_path)
+        d.addErrback(self._ebHandOver, worker, client)
+        return wire
+
+    def _ebHandOver(self, reason, worker, client):
+        log.error("Failed to connect to in-process worker %s: %s",
+                  worker.socket_path, reason.getErrorMessage())
+        worker.release()
+        client.errReceived("SSHg -> Failed to serve repository.\n")
+        client.processEnded(failure.Failure(error.ProcessTerminated(
+                                                                exitCode=255)))
+
+    def workerEnded(self, worker):
+        self.workers.remove(worker)
+        if not self.stopping:
+            log.warning("In-process worker %s exited; restarting it",
+                        worker.socket_path)
+            reactor.callLater(1, self.spawn, worker.socket_path)
+
+    def stop(self):
+        self.stopping = True
+        for worker in self.workers:
+            try:
+                worker.transport.signalProcess('TERM')
+            except error.ProcessExitedAlready:
+                pass
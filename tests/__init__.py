@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+"""
+    tests
+    ~~~~~
+
+    SSHg's tests, run them with ``trial tests``.
+
+    :copyright: © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import sqlalchemy
+from sqlalchemy import orm
+from twisted.trial import unittest
+
+from sshg import database
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """Gives each test an in-memory SQLite database with SSHg's tables, and
+    a session on it, as `self.session`."""
+
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine('sqlite://')
+        database.metadata.create_all(self.engine)
+        self.session = self.newSession()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def newSession(self):
+        return orm.create_session(self.engine, autoflush=True,
+                                  autocommit=False)
+
+    def insert(self, table, *rows):
+        for row in rows:
+            self.session.execute(table.insert(), row)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+
+from base64 import b64encode
+
+from twisted.python import components
+
+from sshg import database as db
+from sshg.avatars import MercurialUser
+from sshg.checkers import AvatarId
+from sshg.utils.crypto import openssh_key_fingerprint
+
+from tests import DatabaseTestCase
+
+
+def make_key(name):
+    return 'ssh-ed25519 %s %s@example.org' % (b64encode('blob of ' + name),
+                                               name)
+
+
+class KeysTestCase(DatabaseTestCase):
+
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        self.insert(db.User.__table__, {'username': 'alice'},
+                    {'username': 'bob'})
+
+    def addKeys(self, username, *keys):
+        self.insert(db.PublicKey.__table__, *[
+            {'key': key, 'fingerprint': openssh_key_fingerprint(key),
+             'user_id': username} for key in keys])
+
+    def getAvatar(self, username):
+        return MercurialUser(components.Componentized(), username)
+
+
+class LoadKeysTestCase(KeysTestCase):
+
+    def test_load_keys(self):
+        self.addKeys('alice', make_key('alice1'), make_key('alice2'))
+        self.addKeys('bob', make_key('bob'))
+        keys = self.getAvatar('alice')._loadKeys(self.session)
+        self.assertEqual(sorted(keys),
+                         [make_key('alice1'), make_key('alice2')])
+
+
+class LogoutTestCase(KeysTestCase):
+
+    def getKeys(self, username):
+        table = db.PublicKey.__table__
+        return sorted(row.key for row in self.session.execute(
+            db.select([table.c.key], table.c.user_id==username)))
+
+    def test_reconcile(self):
+        login, kept, deleted = (make_key('login'), make_key('kept'),
+                                make_key('deleted'))
+        added, taken = make_key('added'), make_key('taken')
+        self.addKeys('alice', login, kept, deleted)
+        self.addKeys('bob', taken)
+        avatar = self.getAvatar(AvatarId('alice', login))
+        # The login key is gone from the uploaded file but must stay
+        avatar._logout(self.session, [kept, added, taken])
+        self.assertEqual(self.getKeys('alice'), sorted([login, kept, added]))
+        self.assertEqual(self.getKeys('bob'), [taken])
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+
+from datetime import datetime
+
+from sshg import database as db
+from sshg.loginstamps import LoginStamps
+
+from tests import DatabaseTestCase
+
+
+class UpdateTestCase(DatabaseTestCase):
+
+    def test_update(self):
+        self.insert(db.User.__table__, {'username': 'alice'})
+        self.insert(db.PublicKey.__table__,
+                    {'key': 'ssh-ed25519 AAAA alice', 'user_id': 'alice'})
+        stamp = datetime(2009, 6, 1, 12, 30)
+        LoginStamps()._update(self.session,
+                              {'ssh-ed25519 AAAA alice': stamp},
+                              {'alice': stamp})
+        self.assertEqual(self.session.query(db.PublicKey).one().used_on,
+                         stamp)
+        self.assertEqual(self.session.query(db.User).one().last_login, stamp)
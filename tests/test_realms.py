@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+
+from sshg import database as db
+from sshg.authcache import REGULAR, MANAGER, ADMIN
+from sshg.realms import MercurialRepositoriesRealm
+
+from tests import DatabaseTestCase
+
+
+class LookupRoleTestCase(DatabaseTestCase):
+
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        self.insert(db.User.__table__,
+                    {'username': 'admin', 'is_admin': True},
+                    {'username': 'manager'},
+                    {'username': 'user'},
+                    {'username': 'locked', 'is_admin': True,
+                     'locked_out': True})
+        self.insert(db.Repository.__table__,
+                    {'name': 'repo', 'path': '/srv/hg/repo'})
+        self.insert(db.repomanagers_association,
+                    {'user_id': 'manager', 'repo_id': 'repo'})
+        self.realm = MercurialRepositoriesRealm()
+
+    def test_roles(self):
+        lookup = self.realm._lookupRole
+        self.assertEqual(lookup(self.session, 'admin'), ADMIN)
+        self.assertEqual(lookup(self.session, 'manager'), MANAGER)
+        self.assertEqual(lookup(self.session, 'user'), REGULAR)
+
+    def test_locked_out(self):
+        error = self.assertRaises(Exception, self.realm._lookupRole,
+                                  self.session, 'locked')
+        self.assertEqual(str(error), "User locked out")
+
+    def test_unknown(self):
+        error = self.assertRaises(Exception, self.realm._lookupRole,
+                                  self.session, 'nobody')
+        self.assertEqual(str(error), "User is not known")
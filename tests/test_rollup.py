@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+
+from datetime import datetime, timedelta
+
+from sshg import database as db
+from sshg.rollup import TrafficRollup
+
+from tests import DatabaseTestCase
+
+
+class RollupTestCase(DatabaseTestCase):
+
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        self.insert(db.User.__table__, {'username': 'alice'})
+        self.insert(db.Repository.__table__,
+                    {'name': 'repo', 'path': '/srv/hg/repo'})
+        self.raw = db.RepositoryTraffic.__table__
+
+    def addTraffic(self, stamp, incoming, outgoing, rolled_up=False):
+        self.insert(self.raw, {'stamp': stamp, 'repo_id': 'repo',
+                               'user_id': 'alice', 'incoming': incoming,
+                               'outgoing': outgoing, 'rolled_up': rolled_up})
+
+    def getTotals(self, model):
+        return sorted((entry.period, entry.incoming, entry.outgoing)
+                      for entry in self.session.query(model))
+
+    def test_rollup(self):
+        day = datetime.utcnow().replace(hour=10, minute=0, second=0,
+                                        microsecond=0) - timedelta(days=1)
+        self.addTraffic(day.replace(minute=5), 10, 100)
+        self.addTraffic(day.replace(minute=55), 20, 200)
+        self.addTraffic(day.replace(hour=11, minute=30), 30, 300)
+        # Already summed up into an existing hourly entry
+        self.session.add(db.RepositoryTrafficHourly(
+                            day.replace(hour=11), 'repo', 'alice', 1, 1))
+        # Summed up and past the retention
+        self.addTraffic(day - timedelta(days=60), 1, 1, rolled_up=True)
+
+        self.assertEqual(TrafficRollup()._rollup(self.session), 3)
+        self.session.flush()
+
+        self.assertEqual(self.getTotals(db.RepositoryTrafficHourly), [
+            (day, 30, 300), (day.replace(hour=11), 31, 301)])
+        self.assertEqual(self.getTotals(db.RepositoryTrafficDaily), [
+            (day.replace(hour=0), 60, 600)])
+        self.assertEqual(
+            [row.rolled_up for row in self.session.execute(
+                db.select([self.raw.c.rolled_up]))], [True] * 3)
+        # Nothing left to roll up
+        self.assertEqual(TrafficRollup()._rollup(self.session), 0)
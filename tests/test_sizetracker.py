@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+
+from sshg import database as db
+from sshg.sizetracker import SizeTracker
+
+from tests import DatabaseTestCase
+
+
+class StoreTestCase(DatabaseTestCase):
+
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        # `_store` opens sessions of it's own
+        self.patch(db, 'session', self.newSession)
+        self.insert(db.Repository.__table__,
+                    {'name': 'repo', 'path': '/srv/hg/repo', 'size': 1000})
+        self.session.commit()
+        self.tracker = SizeTracker()
+
+    def test_store_size(self):
+        self.assertEqual(self.tracker._store('repo', size=2000), 2000)
+
+    def test_store_delta(self):
+        self.assertEqual(self.tracker._store('repo', delta=-200), 800)
+        self.assertEqual(self.tracker._store('repo', delta=500), 1300)